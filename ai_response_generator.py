@@ -2,6 +2,7 @@ import os
 import logging
 import requests
 import json
+from http_clients import get_session
 from language_handler import LanguageHandler
 
 class AIResponseGenerator:
@@ -61,7 +62,7 @@ class AIResponseGenerator:
                 "temperature": 0.7
             }
             
-            response = requests.post(self.api_url, headers=headers, json=payload, timeout=30)
+            response = get_session().post(self.api_url, headers=headers, json=payload, timeout=30)
             
             if response.status_code == 200:
                 result = response.json()
@@ -0,0 +1,238 @@
+"""
+回答キャッシュ（完全一致）
+テナント・言語・正規化した質問文・ドキュメントバージョンをキーにAI回答を保存し、
+同じ質問にはOpenAIを呼ばずに回答する
+SQLiteテーブル（ワーカー間で共有）+ メモリ上のフロントキャッシュ（LRU・TTL付き）
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def _is_dropped(ch: str) -> bool:
+    """正規化で除去する文字か（P: 句読点, Z: 空白, C: 制御文字, So: 絵文字などの記号）"""
+    category = unicodedata.category(ch)
+    return category[0] in 'PZC' or category == 'So'
+
+
+def normalize_question(text: str) -> str:
+    """
+    質問文を正規化（NFKCで全角・半角を統一、小文字化、句読点・記号・空白を除去）
+
+    例: 「チェックインは何時？」「ﾁｪｯｸｲﾝは何時?」→「チェックインは何時」
+    数字に挟まれた句読点・空白は残す（「3.5階」と「35階」、「10:30」と「1030」を区別する）
+    """
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    result = []
+    i = 0
+    while i < len(text):
+        if not _is_dropped(text[i]):
+            result.append(text[i])
+            i += 1
+            continue
+        end = i
+        while end < len(text) and _is_dropped(text[end]):
+            end += 1
+        if 0 < i and end < len(text) and text[i - 1].isdigit() and text[end].isdigit():
+            # 数字の区切り: 句読点があればそれを、空白だけなら空白1つを残す
+            marks = ''.join(ch for ch in text[i:end] if unicodedata.category(ch)[0] == 'P')
+            result.append(marks or ' ')
+        i = end
+    return ''.join(result)
+
+
+class AnswerCache:
+    """質問の完全一致によるAI回答キャッシュ"""
+
+    def __init__(self, db_path: str, ttl: float = 86400.0, memory_size: int = 5000,
+                 purge_interval: float = 3600.0):
+        """
+        キャッシュ初期化
+
+        Args:
+            db_path: SQLiteデータベースのパス
+            ttl: 回答の有効期間（秒）
+            memory_size: メモリに保持する最大件数
+            purge_interval: 期限切れレコードを削除する間隔（秒）
+        """
+        self.db_path = db_path
+        self.ttl = ttl
+        self.memory_size = memory_size
+        self.purge_interval = purge_interval
+
+        self._entries = OrderedDict()  # key -> (answer, expires_at)
+        self._lock = threading.Lock()
+        self._last_purge = time.time()
+        self._stats = {
+            'memory_hits': 0,
+            'db_hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'invalidations': 0,
+        }
+
+        self._init_table()
+
+    def _get_connection(self):
+        """データベース接続取得"""
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def _init_table(self):
+        """回答キャッシュテーブル初期化"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS answer_cache (
+                user_id INTEGER NOT NULL,
+                language TEXT NOT NULL,
+                question_key TEXT NOT NULL,
+                doc_version INTEGER NOT NULL,
+                question TEXT,
+                answer TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (user_id, language, question_key, doc_version)
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_answer_cache_expires_at ON answer_cache(expires_at)')
+        conn.commit()
+        conn.close()
+
+    def _remember(self, key, answer: str, expires_at: float):
+        self._entries[key] = (answer, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.memory_size:
+            self._entries.popitem(last=False)
+
+    def get(self, user_id, language: str, question: str, doc_version) -> Optional[str]:
+        """
+        キャッシュ済みの回答を取得
+
+        Args:
+            user_id: テナント（ユーザー）ID
+            language: 回答言語
+            question: 質問文（正規化前）
+            doc_version: テナントのドキュメントバージョン
+
+        Returns:
+            str: キャッシュされた回答（なければNone）
+        """
+        question_key = normalize_question(question)
+        if not question_key:
+            return None
+        key = (user_id, language, question_key, doc_version or 0)
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(key)
+                    self._stats['memory_hits'] += 1
+                    return entry[0]
+                del self._entries[key]
+
+        conn = self._get_connection()
+        try:
+            row = conn.execute('''
+                SELECT answer, expires_at FROM answer_cache
+                WHERE user_id = ? AND language = ? AND question_key = ? AND doc_version = ? AND expires_at > ?
+            ''', (*key, now)).fetchone()
+        finally:
+            conn.close()
+
+        with self._lock:
+            if row is None:
+                self._stats['misses'] += 1
+                return None
+            self._remember(key, row[0], row[1])
+            self._stats['db_hits'] += 1
+        return row[0]
+
+    def put(self, user_id, language: str, question: str, doc_version, answer: str):
+        """
+        回答を保存
+
+        Args:
+            user_id: テナント（ユーザー）ID
+            language: 回答言語
+            question: 質問文（正規化前）
+            doc_version: 回答生成時のドキュメントバージョン
+            answer: AI回答
+        """
+        question_key = normalize_question(question)
+        if not question_key or not answer:
+            return
+        key = (user_id, language, question_key, doc_version or 0)
+        now = time.time()
+        expires_at = now + self.ttl
+
+        conn = self._get_connection()
+        try:
+            conn.execute('''
+                INSERT OR REPLACE INTO answer_cache
+                (user_id, language, question_key, doc_version, question, answer, created_at, expires_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (*key, question, answer, now, expires_at))
+            conn.commit()
+        finally:
+            conn.close()
+
+        with self._lock:
+            self._remember(key, answer, expires_at)
+            self._stats['stores'] += 1
+
+        self._maybe_purge(now)
+
+    def invalidate(self, user_id):
+        """
+        テナントの回答をすべて削除（ファイルのアップロード・削除時に呼ぶ）
+
+        Args:
+            user_id: テナント（ユーザー）ID
+        """
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == user_id]:
+                del self._entries[key]
+            self._stats['invalidations'] += 1
+
+        conn = self._get_connection()
+        try:
+            conn.execute('DELETE FROM answer_cache WHERE user_id = ?', (user_id,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _maybe_purge(self, now: float):
+        """期限切れレコードを定期的に削除"""
+        with self._lock:
+            if now - self._last_purge < self.purge_interval:
+                return
+            self._last_purge = now
+
+        try:
+            conn = self._get_connection()
+            conn.execute('DELETE FROM answer_cache WHERE expires_at < ?', (now,))
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            logger.warning(f"期限切れ回答キャッシュの削除に失敗しました: {e}")
+
+    def stats(self) -> Dict:
+        """統計情報を取得"""
+        with self._lock:
+            hits = self._stats['memory_hits'] + self._stats['db_hits']
+            total = hits + self._stats['misses']
+            return {
+                **self._stats,
+                'hit_rate': round(hits / total * 100, 1) if total else 0.0,
+                'memory_entries': len(self._entries),
+                'ttl': self.ttl,
+            }
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+埋め込みバックエンドのベンチマーク
+マニュアルのパッセージと、正解のパッセージがわかっている質問を使って、
+バックエンドごとの質問の埋め込み時間（p50/p95）と recall@k を比較する
+OPENAI_API_KEY があれば openai も計測し、local の上位k件が openai の上位k件とどれだけ一致するかも出す
+
+使い方:
+    python bench_embeddings.py --k 3
+    python bench_embeddings.py --corpus manual.txt --queries queries.jsonl --backends local
+    （queries.jsonl は1行に {"query": 質問, "passage": 正解のパッセージ番号（0始まり）}）
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from embedding_backends import BACKEND_LOCAL, BACKEND_OPENAI, get_backend
+
+PASSAGES = [
+    "チェックインは15時から、チェックアウトは11時までです。アーリーチェックインは空室がある場合のみ承ります。",
+    "朝食は1階レストランで7時から10時まで提供しています。和食と洋食のビュッフェです。",
+    "駐車場はホテル裏に20台分あり、1泊1000円です。予約はできません。",
+    "Wi-Fiは館内全域で無料です。パスワードは客室のカードに記載しています。",
+    "大浴場は地下1階にあり、15時から翌1時まで、朝は6時から9時まで利用できます。",
+    "ペットの同伴はできません。ただし盲導犬・介助犬はご利用いただけます。",
+    "キャンセル料は前日50%、当日100%です。連絡なしの不泊も100%となります。",
+    "空港までのシャトルバスは毎時0分に正面玄関から出発します。予約は不要です。",
+    "客室の冷蔵庫は空です。1階の売店は24時間営業しています。",
+    "荷物はチェックイン前・チェックアウト後もフロントで無料でお預かりします。",
+    "クリーニングサービスは10時までにフロントへお出しいただくと当日18時にお届けします。",
+    "全館禁煙です。喫煙所は1階正面玄関の外にあります。",
+]
+
+QUERIES = [
+    ("チェックアウトは何時ですか", 0),
+    ("何時から部屋に入れますか", 0),
+    ("朝ごはんは何時から", 1),
+    ("朝食の会場はどこ", 1),
+    ("車を停める場所はありますか", 2),
+    ("駐車料金はいくら", 2),
+    ("wifiのパスワードを教えて", 3),
+    ("インターネットは使えますか", 3),
+    ("お風呂は何時まで入れますか", 4),
+    ("大浴場の場所", 4),
+    ("犬を連れて行けますか", 5),
+    ("当日キャンセルの料金は", 6),
+    ("空港へのバスはありますか", 7),
+    ("飲み物を買える店はありますか", 8),
+    ("チェックアウトの後に荷物を預けたい", 9),
+    ("洗濯をお願いできますか", 10),
+    ("たばこを吸える場所は", 11),
+]
+
+
+def load_corpus(args):
+    """パッセージと質問（指定がなければ組み込みのホテルのマニュアル）"""
+    if not args.corpus:
+        return PASSAGES, QUERIES
+    with open(args.corpus, encoding='utf-8') as f:
+        passages = [block.strip() for block in f.read().split('\n\n') if block.strip()]
+    queries = []
+    with open(args.queries, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                queries.append((item['query'], int(item['passage'])))
+    return passages, queries
+
+
+def normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def run_backend(backend, passages, queries, k, repeat):
+    """パッセージを埋め込み、各質問の埋め込み時間と上位k件を求める"""
+    started = time.perf_counter()
+    matrix = normalize(np.asarray(backend.embed_documents(passages), dtype=np.float32))
+    index_seconds = time.perf_counter() - started
+
+    latencies, rankings = [], []
+    for query, _ in queries:
+        for attempt in range(repeat):
+            started = time.perf_counter()
+            vector = np.asarray(backend.embed_query(query), dtype=np.float32)
+            latencies.append(time.perf_counter() - started)
+        vector = vector / (np.linalg.norm(vector) or 1.0)
+        rankings.append(list(np.argsort(-(matrix @ vector))[:k]))
+
+    hits = sum(1 for (_, answer), ranking in zip(queries, rankings) if answer in ranking)
+    samples = sorted(latencies)
+    return {
+        'index_ms': round(index_seconds * 1000, 1),
+        'query_p50_ms': round(samples[len(samples) // 2] * 1000, 3),
+        'query_p95_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 3),
+        'recall': round(hits / len(queries), 3),
+        'rankings': rankings,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Embedding backend benchmark')
+    parser.add_argument('--k', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=5, help='質問ごとの埋め込み回数（local のみ）')
+    parser.add_argument('--backends', default='local,openai')
+    parser.add_argument('--corpus', help='パッセージ（空行区切り）のテキストファイル')
+    parser.add_argument('--queries', help='質問と正解のパッセージ番号のJSONLファイル')
+    args = parser.parse_args()
+
+    passages, queries = load_corpus(args)
+    api_key = os.getenv('OPENAI_API_KEY')
+    results = {}
+    for name in [name.strip() for name in args.backends.split(',') if name.strip()]:
+        if name == BACKEND_OPENAI and not api_key:
+            print("openai : skipped (OPENAI_API_KEY is not set)")
+            continue
+        backend = get_backend(name, api_key)
+        # API呼び出しは質問ごとに1回だけ計測する
+        repeat = args.repeat if name == BACKEND_LOCAL else 1
+        results[name] = run_backend(backend, passages, queries, args.k, repeat)
+
+    print(f"passages: {len(passages)}, queries: {len(queries)}, k: {args.k}")
+    for name, result in results.items():
+        print(f"{name:7s}: recall@{args.k}={result['recall']:.3f}, "
+              f"query p50={result['query_p50_ms']:.3f} ms, p95={result['query_p95_ms']:.3f} ms, "
+              f"index={result['index_ms']:.1f} ms")
+
+    if BACKEND_LOCAL in results and BACKEND_OPENAI in results:
+        overlap = np.mean([len(set(local) & set(remote)) / args.k for local, remote in
+                           zip(results[BACKEND_LOCAL]['rankings'], results[BACKEND_OPENAI]['rankings'])])
+        speedup = results[BACKEND_OPENAI]['query_p50_ms'] / max(results[BACKEND_LOCAL]['query_p50_ms'], 1e-6)
+        print(f"local top-{args.k} overlap with openai: {overlap:.3f}, query latency speedup: {speedup:.0f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+使用量メーターのベンチマーク
+1メッセージあたり check_usage_limit + update_usage×2 を
+従来の方式（毎回接続・UPSERT・コミット）と UsageMeter で比較する
+
+使い方:
+    python bench_usage_meter.py --messages 2000 --users 20
+"""
+
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+from datetime import datetime
+
+from usage_meter import UsageMeter
+
+PLANS = {
+    'starter': {'files': 5, 'api_calls': 1000, 'messages': 5000},
+    'pro': {'files': 20, 'api_calls': 5000, 'messages': 20000},
+    'enterprise': {'files': -1, 'api_calls': -1, 'messages': -1},
+}
+
+
+def create_db(path, users):
+    conn = sqlite3.connect(path)
+    conn.execute('''CREATE TABLE users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        plan TEXT DEFAULT 'starter'
+    )''')
+    conn.execute('''CREATE TABLE usage_tracking (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        month TEXT NOT NULL,
+        files_uploaded INTEGER DEFAULT 0,
+        api_calls_made INTEGER DEFAULT 0,
+        messages_sent INTEGER DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(user_id, month)
+    )''')
+    conn.executemany('INSERT INTO users (plan) VALUES (?)', [('pro',)] * users)
+    conn.commit()
+    conn.close()
+
+
+def legacy_check(db_path, user_id, limit_type):
+    """main.check_usage_limit の従来実装と同じクエリ"""
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    cursor.execute('SELECT plan FROM users WHERE id = ?', (user_id,))
+    user = cursor.fetchone()
+    limits = PLANS[user['plan']]
+    current_month = datetime.now().strftime('%Y-%m')
+    cursor.execute('''
+        SELECT files_uploaded, api_calls_made, messages_sent
+        FROM usage_tracking
+        WHERE user_id = ? AND month = ?
+    ''', (user_id, current_month))
+    usage = cursor.fetchone()
+    conn.close()
+    if not usage:
+        return True
+    return usage['messages_sent'] < limits[limit_type]
+
+
+def legacy_update(db_path, user_id, column, amount=1):
+    """main.update_usage の従来実装と同じクエリ"""
+    conn = sqlite3.connect(db_path)
+    current_month = datetime.now().strftime('%Y-%m')
+    conn.execute(f'''
+        INSERT INTO usage_tracking (user_id, month, {column})
+        VALUES (?, ?, ?)
+        ON CONFLICT(user_id, month) DO UPDATE SET
+        {column} = {column} + ?,
+        updated_at = CURRENT_TIMESTAMP
+    ''', (user_id, current_month, amount, amount))
+    conn.commit()
+    conn.close()
+
+
+def total_messages(db_path):
+    conn = sqlite3.connect(db_path)
+    total = conn.execute('SELECT COALESCE(SUM(messages_sent), 0) FROM usage_tracking').fetchone()[0]
+    conn.close()
+    return total
+
+
+def run_legacy(db_path, messages, users):
+    started = time.perf_counter()
+    for i in range(messages):
+        user_id = i % users + 1
+        if legacy_check(db_path, user_id, 'messages'):
+            legacy_update(db_path, user_id, 'messages_sent')
+            legacy_update(db_path, user_id, 'api_calls_made')
+    return time.perf_counter() - started
+
+
+def run_meter(db_path, messages, users, flush_interval):
+    meter = UsageMeter(db_path, PLANS, flush_interval=flush_interval)
+    started = time.perf_counter()
+    for i in range(messages):
+        user_id = i % users + 1
+        if meter.check(user_id, 'messages'):
+            meter.record(user_id, 'messages', 1)
+            meter.record(user_id, 'api_calls', 1)
+    meter.shutdown()
+    return time.perf_counter() - started, meter.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='UsageMeter benchmark')
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--flush-interval', type=float, default=5.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_db = os.path.join(tmp, 'legacy.db')
+        meter_db = os.path.join(tmp, 'meter.db')
+        create_db(legacy_db, args.users)
+        create_db(meter_db, args.users)
+
+        legacy_time = run_legacy(legacy_db, args.messages, args.users)
+        meter_time, stats = run_meter(meter_db, args.messages, args.users, args.flush_interval)
+
+        print(f"messages: {args.messages}, users: {args.users}")
+        print(f"legacy : {legacy_time:.3f}s ({legacy_time / args.messages * 1000:.3f} ms/msg), "
+              f"messages_sent={total_messages(legacy_db)}")
+        print(f"meter  : {meter_time:.3f}s ({meter_time / args.messages * 1000:.3f} ms/msg), "
+              f"messages_sent={total_messages(meter_db)}")
+        print(f"speedup: {legacy_time / meter_time:.1f}x")
+        print(f"meter stats: {stats}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""
+サーキットブレーカー
+外部API（OpenAI）呼び出しの直近のエラー率と遅延率を監視し、劣化時は呼び出しを止めて即座にフォールバックさせる
+- CLOSED: 通常。直近 window 秒の呼び出しのうち失敗（エラーまたは slow_call_ms 超過）の割合が
+  しきい値を超えたら OPEN
+- OPEN: 呼び出しを拒否。open_seconds 経過後に HALF_OPEN
+- HALF_OPEN: 試験的に probes 件だけ通し、成功すれば CLOSED、失敗すれば再び OPEN
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """ブレーカーが開いているため呼び出しを拒否した"""
+
+
+class CircuitBreaker:
+    """エラー率・遅延率によるサーキットブレーカー"""
+
+    def __init__(self, name: str, window: float = 60.0, min_calls: int = 10, failure_rate: float = 0.5,
+                 slow_call_ms: float = 15000.0, open_seconds: float = 30.0, probes: int = 1):
+        """
+        ブレーカー初期化
+
+        Args:
+            name: ログ・統計に使う名前
+            window: エラー率を計算する期間（秒）
+            min_calls: OPEN と判定するのに必要な期間内の最小呼び出し数
+            failure_rate: OPEN にする失敗率（0〜1、遅い呼び出しも失敗に数える）
+            slow_call_ms: これを超えた呼び出しは成功しても失敗扱い（ミリ秒）
+            open_seconds: OPEN から HALF_OPEN に移るまでの秒数
+            probes: HALF_OPEN で同時に通す試験呼び出しの数
+        """
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_ms = slow_call_ms
+        self.open_seconds = open_seconds
+        self.probes = probes
+
+        self._state = CLOSED
+        self._calls = deque()  # (時刻, 失敗したか, 遅かったか)
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            'allowed': 0,
+            'rejected': 0,
+            'opened': 0,
+            'closed': 0,
+        }
+
+    def _prune(self, now: float):
+        while self._calls and self._calls[0][0] < now - self.window:
+            self._calls.popleft()
+
+    def _open(self, now: float, reason: str):
+        self._state = OPEN
+        self._opened_at = now
+        self._probes_in_flight = 0
+        self._stats['opened'] += 1
+        logger.warning(f"Circuit '{self.name}' opened: {reason}")
+
+    def _refresh(self, now: float):
+        """OPEN の待機時間が過ぎていれば HALF_OPEN に移る"""
+        if self._state == OPEN and now - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._probes_in_flight = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._refresh(time.monotonic())
+            return self._state
+
+    def is_open(self) -> bool:
+        """呼び出しを確実に拒否する状態か（試験呼び出しの枠は消費しない）"""
+        with self._lock:
+            self._refresh(time.monotonic())
+            return self._state == OPEN
+
+    def allow(self) -> bool:
+        """
+        呼び出してよいか判定（True の場合は結果を必ず record、記録しない場合は release すること）
+
+        Returns:
+            bool: 呼び出してよければTrue
+        """
+        with self._lock:
+            self._refresh(time.monotonic())
+            if self._state == CLOSED:
+                self._stats['allowed'] += 1
+                return True
+            if self._state == HALF_OPEN and self._probes_in_flight < self.probes:
+                self._probes_in_flight += 1
+                self._stats['allowed'] += 1
+                return True
+            self._stats['rejected'] += 1
+            return False
+
+    def release(self):
+        """allow() で許可した呼び出しを結果を記録せずに終える（OpenAIに届く前に中止した場合など）"""
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+
+    def record(self, success: bool, seconds: float):
+        """
+        呼び出し結果を記録
+
+        Args:
+            success: 呼び出しが成功したか
+            seconds: 所要時間（秒）
+        """
+        now = time.monotonic()
+        slow = seconds * 1000 > self.slow_call_ms
+        failed = not success or slow
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                if failed:
+                    self._open(now, 'probe failed' if not success else f'probe took {seconds:.1f}s')
+                else:
+                    self._state = CLOSED
+                    self._calls.clear()
+                    self._stats['closed'] += 1
+                    logger.info(f"Circuit '{self.name}' closed after a successful probe")
+                return
+            if self._state == OPEN:
+                # OPEN になる前に始まった呼び出しの結果
+                return
+
+            self._calls.append((now, failed, slow))
+            self._prune(now)
+            calls = len(self._calls)
+            failures = sum(1 for _, call_failed, _ in self._calls if call_failed)
+            if calls >= self.min_calls and failures / calls >= self.failure_rate:
+                self._open(now, f'{failures}/{calls} failed or slow calls in the last {self.window:.0f}s')
+
+    def stats(self) -> Dict:
+        """状態と直近の失敗率"""
+        now = time.monotonic()
+        with self._lock:
+            self._refresh(now)
+            self._prune(now)
+            calls = len(self._calls)
+            failures = sum(1 for _, failed, _ in self._calls if failed)
+            slow = sum(1 for _, _, call_slow in self._calls if call_slow)
+            return {
+                **self._stats,
+                'state': self._state,
+                'recent_calls': calls,
+                'recent_failure_rate': round(failures / calls, 3) if calls else 0.0,
+                'recent_slow_rate': round(slow / calls, 3) if calls else 0.0,
+                'retry_in_seconds': round(max(0.0, self._opened_at + self.open_seconds - now), 1)
+                if self._state == OPEN else 0.0,
+            }
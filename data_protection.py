@@ -225,6 +225,10 @@ def gdpr_delete_data():
     ''', (user_id,))
     
     cursor.execute('DELETE FROM files WHERE user_id = ?', (user_id,))
+    # file_chunks is created by the passage index on first use and may not exist yet
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'file_chunks'")
+    if cursor.fetchone():
+        cursor.execute('DELETE FROM file_chunks WHERE user_id = ?', (user_id,))
     
     cursor.execute('''
         INSERT INTO audit_logs (user_id, action, details)
@@ -0,0 +1,114 @@
+"""
+テナント別ドキュメントセットのバージョン管理
+ファイルのアップロード・削除・PDF変換のたびにテナントのバージョンを1つ上げる
+プロンプト・回答などのキャッシュはこのバージョンをキーに含めることで、ドキュメント変更時に自動で無効になる
+他ワーカーでの変更は ttl 秒以内に反映される
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+
+class DocumentVersions:
+    """テナント（ユーザー）ごとのドキュメントセットのバージョン"""
+
+    def __init__(self, db_path: str, ttl: float = 5.0):
+        """
+        初期化
+
+        Args:
+            db_path: SQLiteデータベースのパス
+            ttl: バージョンをメモリにキャッシュする期間（秒）。他ワーカーでの更新はこの時間内に反映
+        """
+        self.db_path = db_path
+        self.ttl = ttl
+
+        self._versions = {}  # user_id -> (version, expires_at)
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'bumps': 0}
+
+        self._init_table()
+
+    def _get_connection(self):
+        """データベース接続取得"""
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def _init_table(self):
+        """バージョンテーブル初期化"""
+        conn = self._get_connection()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS document_versions (
+                user_id INTEGER PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        conn.commit()
+        conn.close()
+
+    def get(self, user_id) -> int:
+        """
+        現在のバージョンを取得（未登録のテナントは0）
+
+        Args:
+            user_id: テナント（ユーザー）ID
+
+        Returns:
+            int: バージョン
+        """
+        now = time.monotonic()
+        with self._lock:
+            cached = self._versions.get(user_id)
+            if cached and cached[1] > now:
+                self._stats['hits'] += 1
+                return cached[0]
+            self._stats['misses'] += 1
+
+        conn = self._get_connection()
+        try:
+            row = conn.execute('SELECT version FROM document_versions WHERE user_id = ?', (user_id,)).fetchone()
+        finally:
+            conn.close()
+
+        version = row[0] if row else 0
+        with self._lock:
+            self._versions[user_id] = (version, now + self.ttl)
+        return version
+
+    def bump(self, user_id) -> int:
+        """
+        バージョンを1つ上げる（ファイルの追加・削除時に呼ぶ）
+
+        Args:
+            user_id: テナント（ユーザー）ID
+
+        Returns:
+            int: 新しいバージョン
+        """
+        conn = self._get_connection()
+        try:
+            conn.execute('''
+                INSERT INTO document_versions (user_id, version) VALUES (?, 1)
+                ON CONFLICT(user_id) DO UPDATE SET
+                version = version + 1,
+                updated_at = CURRENT_TIMESTAMP
+            ''', (user_id,))
+            version = conn.execute('SELECT version FROM document_versions WHERE user_id = ?', (user_id,)).fetchone()[0]
+            conn.commit()
+        finally:
+            conn.close()
+
+        with self._lock:
+            self._versions[user_id] = (version, time.monotonic() + self.ttl)
+            self._stats['bumps'] += 1
+        return version
+
+    def stats(self) -> Dict:
+        """統計情報を取得"""
+        with self._lock:
+            return {**self._stats, 'cached_tenants': len(self._versions), 'ttl': self.ttl}
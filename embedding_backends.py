@@ -0,0 +1,131 @@
+"""
+埋め込みバックエンド
+RAGSystem のチャンク・検索クエリの埋め込みを計算する実装を切り替える
+- openai: OpenAI Embeddings API（text-embedding-3-small、ネットワークが必要）
+- local: 文字n-gramのハッシュによるCPU上の埋め込み（ネットワーク不要、テスト・閉域環境向け）
+バックエンドはプロセスごとに1回だけ作って共有し、テナントごとに選べる
+（RAG_EMBEDDING_BACKEND が既定、RAG_TENANT_EMBEDDING_BACKENDS='12=local,34=openai' でテナント別に指定）
+"""
+
+import os
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from http_clients import get_openai_client
+from semantic_cache import LocalHashEmbedder
+
+BACKEND_OPENAI = 'openai'
+BACKEND_LOCAL = 'local'
+BACKENDS = (BACKEND_OPENAI, BACKEND_LOCAL)
+
+
+class OpenAIEmbeddingBackend:
+    """OpenAI Embeddings API による埋め込み"""
+
+    name = BACKEND_OPENAI
+
+    def __init__(self, api_key: str, model: str = 'text-embedding-3-small', base_url: Optional[str] = None,
+                 batch_size: int = 1000):
+        """
+        Args:
+            api_key: OpenAI APIキー
+            model: 埋め込みモデル
+            base_url: APIのベースURL（省略時は既定）
+            batch_size: 1リクエストで送る最大件数
+        """
+        self.model = model
+        self.batch_size = batch_size
+        self.client = get_openai_client(api_key, base_url)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            response = self.client.embeddings.create(input=texts[start:start + self.batch_size], model=self.model)
+            vectors.extend(item.embedding for item in sorted(response.data, key=lambda item: item.index))
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        response = self.client.embeddings.create(input=[text], model=self.model)
+        return response.data[0].embedding
+
+
+class LocalHashEmbeddingBackend:
+    """文字n-gramのハッシュによるローカル埋め込み（L2正規化済み、API呼び出しなし）"""
+
+    name = BACKEND_LOCAL
+
+    def __init__(self, dim: int = 1024, ngram_range=(1, 3)):
+        """
+        Args:
+            dim: ベクトルの次元数
+            ngram_range: 使用する文字n-gramの長さの範囲
+        """
+        self.embedder = LocalHashEmbedder(dim=dim, ngram_range=ngram_range)
+        self.model = f'local-hash-{dim}-{ngram_range[0]}{ngram_range[1]}'
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = np.asarray(self.embedder.embed_query(text), dtype=np.float32)
+        norm = float(np.linalg.norm(vector))
+        # 正規化しておけばベクトルDBのL2距離の順位がコサイン類似度の順位と一致する
+        return (vector / norm).tolist() if norm else vector.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def _parse_tenant_backends(value: str) -> Dict[str, str]:
+    """'12=local,34=openai' 形式をパース"""
+    backends = {}
+    for item in (value or '').split(','):
+        if '=' in item:
+            tenant, name = item.split('=', 1)
+            backends[tenant.strip()] = name.strip()
+    return backends
+
+
+def backend_name_for(user_id) -> str:
+    """
+    テナントが使うバックエンド名
+
+    Args:
+        user_id: テナント（ユーザー）ID
+
+    Returns:
+        str: 'openai' / 'local'
+    """
+    name = _parse_tenant_backends(os.getenv('RAG_TENANT_EMBEDDING_BACKENDS', '')).get(str(user_id))
+    name = name or os.getenv('RAG_EMBEDDING_BACKEND', BACKEND_OPENAI)
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown embedding backend: {name}")
+    return name
+
+
+def get_backend(name: str, api_key: Optional[str] = None):
+    """
+    バックエンドを取得（プロセスで1回だけ作って共有）
+
+    Args:
+        name: 'openai' / 'local'
+        api_key: OpenAI APIキー（openai のみ）
+
+    Returns:
+        embed_documents(texts) / embed_query(text) / model を持つバックエンド
+    """
+    key = (name, api_key if name == BACKEND_OPENAI else None)
+    with _backends_lock:
+        backend = _backends.get(key)
+        if backend is None:
+            if name == BACKEND_OPENAI:
+                backend = OpenAIEmbeddingBackend(api_key, base_url=os.getenv('OPENAI_BASE_URL'))
+            elif name == BACKEND_LOCAL:
+                backend = LocalHashEmbeddingBackend(dim=int(os.getenv('RAG_LOCAL_EMBEDDING_DIM', 1024)))
+            else:
+                raise ValueError(f"Unknown embedding backend: {name}")
+            _backends[key] = backend
+        return backend
@@ -0,0 +1,285 @@
+"""
+埋め込みキャッシュ（コンテンツハッシュ）
+チャンク本文の埋め込みベクトルを (モデル, sha256(本文)) をキーにSQLiteへ保存し、
+同じファイルの再登録や編集したマニュアルの再変換で、変わっていないチャンクの埋め込みAPI呼び出しを省く
+- キャッシュにないチャンクだけをまとめて埋め込みAPIに送る（batch_size 件ずつ）
+- 取り込み1回ごとのヒット率と節約額（USD）を集計する
+"""
+
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 埋め込みモデルの料金（USD / 100万トークン）
+EMBEDDING_PRICES = {
+    'text-embedding-3-small': 0.02,
+    'text-embedding-3-large': 0.13,
+    'text-embedding-ada-002': 0.10,
+}
+
+
+def content_hash(text: str) -> str:
+    """チャンク本文のsha256（16進）"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def estimate_embedding_tokens(text: str) -> int:
+    """埋め込みの課金トークン数の概算（ASCIIは約4文字、それ以外は1文字で1トークン）"""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+class EmbeddingCache:
+    """(モデル, 本文ハッシュ) -> 埋め込みベクトル の永続キャッシュ"""
+
+    def __init__(self, db_path: str, recent_reports: int = 20):
+        """
+        キャッシュ初期化
+
+        Args:
+            db_path: SQLiteデータベースのパス
+            recent_reports: stats() に含める直近の取り込みレポートの件数
+        """
+        self.db_path = db_path
+
+        self._lock = threading.Lock()
+        self._reports = deque(maxlen=recent_reports)
+        self._stats = {
+            'lookups': 0,
+            'hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'tokens_saved': 0,
+            'saved_usd': 0.0,
+        }
+
+        self._init_table()
+
+    def _get_connection(self):
+        """データベース接続取得"""
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def _init_table(self):
+        """埋め込みキャッシュテーブル初期化"""
+        conn = self._get_connection()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS embedding_cache (
+                model TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                dimensions INTEGER NOT NULL,
+                vector BLOB NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (model, content_hash)
+            )
+        ''')
+        conn.commit()
+        conn.close()
+
+    def get_many(self, model: str, hashes: List[str]) -> Dict[str, List[float]]:
+        """
+        キャッシュ済みのベクトルを取得
+
+        Args:
+            model: 埋め込みモデル名
+            hashes: 本文ハッシュ
+
+        Returns:
+            dict: 本文ハッシュ -> ベクトル（キャッシュにあったものだけ）
+        """
+        found = {}
+        unique = list(dict.fromkeys(hashes))
+        conn = self._get_connection()
+        try:
+            # SQLiteの変数の上限を超えないよう分けて問い合わせる
+            for start in range(0, len(unique), 500):
+                batch = unique[start:start + 500]
+                rows = conn.execute(f'''
+                    SELECT content_hash, vector FROM embedding_cache
+                    WHERE model = ? AND content_hash IN ({','.join('?' * len(batch))})
+                ''', (model, *batch)).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+        finally:
+            conn.close()
+        return found
+
+    def put_many(self, model: str, vectors: Dict[str, List[float]]):
+        """
+        ベクトルを保存
+
+        Args:
+            model: 埋め込みモデル名
+            vectors: 本文ハッシュ -> ベクトル
+        """
+        if not vectors:
+            return
+        now = time.time()
+        rows = [(model, key, len(vector), np.asarray(vector, dtype=np.float32).tobytes(), now)
+                for key, vector in vectors.items()]
+        conn = self._get_connection()
+        try:
+            conn.executemany('''
+                INSERT OR REPLACE INTO embedding_cache (model, content_hash, dimensions, vector, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', rows)
+            conn.commit()
+        finally:
+            conn.close()
+        with self._lock:
+            self._stats['stores'] += len(rows)
+
+    def record(self, report: Dict):
+        """取り込み1回分のレポートを集計に加える"""
+        with self._lock:
+            self._stats['lookups'] += report['chunks']
+            self._stats['hits'] += report['hits']
+            self._stats['misses'] += report['misses']
+            self._stats['tokens_saved'] += report['tokens_saved']
+            self._stats['saved_usd'] += report['saved_usd']
+            self._reports.append(report)
+
+    def stats(self) -> Dict:
+        """統計情報を取得"""
+        with self._lock:
+            lookups = self._stats['lookups']
+            return {
+                **self._stats,
+                'saved_usd': round(self._stats['saved_usd'], 6),
+                'hit_rate': round(self._stats['hits'] / lookups * 100, 1) if lookups else 0.0,
+                'recent_ingests': list(self._reports),
+            }
+
+
+class CachedEmbeddings:
+    """埋め込みキャッシュを前段に置いた Embeddings（langchain の Embeddings と同じインターフェース）"""
+
+    def __init__(self, embeddings, cache: EmbeddingCache, model: str = 'text-embedding-3-small',
+                 batch_size: int = 256):
+        """
+        Args:
+            embeddings: 実際に埋め込みを計算する Embeddings（OpenAIEmbeddings など）
+            cache: 埋め込みキャッシュ
+            model: 埋め込みモデル名（キャッシュのキーと料金の計算に使用）
+            batch_size: 1回の埋め込みAPI呼び出しで送るチャンク数
+        """
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = model
+        self.batch_size = batch_size
+        self._local = threading.local()
+        self._report_lock = threading.Lock()
+
+    @staticmethod
+    def new_report(label: str = '') -> Dict:
+        """取り込み1回分の空のレポート"""
+        return {'label': label, 'chunks': 0, 'hits': 0, 'misses': 0, 'hit_ratio': 0.0,
+                'tokens_saved': 0, 'saved_usd': 0.0}
+
+    def finish_report(self, report: Dict):
+        """レポートを確定して集計に加える"""
+        report['hit_ratio'] = round(report['hits'] / report['chunks'], 3) if report['chunks'] else 0.0
+        report['saved_usd'] = round(report['saved_usd'], 6)
+        self.cache.record(report)
+        if report['label']:
+            logger.info(f"Embedding cache {report['label']}: {report['hits']}/{report['chunks']} chunks cached, "
+                        f"${report['saved_usd']:.6f} saved")
+
+    @contextmanager
+    def track(self, label: str = ''):
+        """
+        ブロック内（同じスレッド）の embed_documents の呼び出しをまとめて1回の取り込みとして集計する
+
+        Args:
+            label: レポートに付ける名前（ファイル名など）
+
+        Yields:
+            dict: chunks, hits, misses, hit_ratio, tokens_saved, saved_usd（ブロックを抜けた時点で確定）
+        """
+        report = self.new_report(label)
+        self._local.report = report
+        try:
+            yield report
+        finally:
+            self._local.report = None
+            self.finish_report(report)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        チャンクの埋め込み（キャッシュにないものだけAPIで計算して保存する）
+
+        Args:
+            texts: チャンク本文
+
+        Returns:
+            list: texts と同じ順のベクトル
+        """
+        report: Optional[Dict] = getattr(self._local, 'report', None)
+        if report is not None:
+            return self.embed_batch(texts, report)
+        report = self.new_report()
+        vectors = self.embed_batch(texts, report)
+        self.finish_report(report)
+        return vectors
+
+    def embed_batch(self, texts: List[str], report: Dict) -> List[List[float]]:
+        """
+        embed_documents と同じだが、結果を指定したレポートに加える（複数スレッドから同じレポートを渡してよい）
+
+        Args:
+            texts: チャンク本文
+            report: new_report() で作ったレポート
+
+        Returns:
+            list: texts と同じ順のベクトル
+        """
+        hashes = [content_hash(text) for text in texts]
+        vectors = self.cache.get_many(self.model, hashes)
+
+        # 同じ本文が複数回出てきても1回だけ送る
+        missing = {}
+        for key, text in zip(hashes, texts):
+            if key not in vectors and key not in missing:
+                missing[key] = text
+        if missing:
+            keys = list(missing)
+            computed = {}
+            for start in range(0, len(keys), self.batch_size):
+                batch = keys[start:start + self.batch_size]
+                for key, vector in zip(batch, self.embeddings.embed_documents([missing[key] for key in batch])):
+                    computed[key] = vector
+            self.cache.put_many(self.model, computed)
+            vectors.update(computed)
+
+        self._add_to_report(report, texts, hashes, missing)
+        return [vectors[key] for key in hashes]
+
+    def _add_to_report(self, report: Dict, texts: List[str], hashes: List[str], missing: Dict[str, str]):
+        price = EMBEDDING_PRICES.get(self.model, 0.0)
+        sent = set()
+        hits = misses = tokens_saved = 0
+        for key, text in zip(hashes, texts):
+            if key in missing and key not in sent:
+                sent.add(key)
+                misses += 1
+            else:
+                hits += 1
+                tokens_saved += estimate_embedding_tokens(text)
+        with self._report_lock:
+            report['chunks'] += len(texts)
+            report['hits'] += hits
+            report['misses'] += misses
+            report['tokens_saved'] += tokens_saved
+            report['saved_usd'] += tokens_saved / 1_000_000 * price
+
+    def embed_query(self, text: str) -> List[float]:
+        """検索クエリの埋め込み（質問ごとに異なるのでキャッシュしない）"""
+        return self.embeddings.embed_query(text)
@@ -0,0 +1,355 @@
+"""
+共有HTTPクライアントレジストリ
+外部API呼び出し（LINE / OpenAI / 決済システム）で使うKeep-Alive接続プールをプロセス全体で共有する
+- requests.Session: ホストごとの接続数上限・デフォルトタイムアウト・リトライポリシー
+- openai.OpenAI: APIキー・ベースURLごとに1インスタンスを共有（httpx接続プール付き）
+- openai.AsyncOpenAI: 同上（llm_gateway のイベントループ上で使用、SDK側のリトライなし）
+- ホストごとのレイテンシ・エラー数・接続プール使用率を集計
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# httpx は共有OpenAIクライアントでのみ使用
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# LINE SDK（line-bot-sdk）のHTTPクライアントを共有Sessionに差し替えるため
+try:
+    from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
+except ImportError:
+    RequestsHttpClient = None
+    RequestsHttpResponse = None
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_host_limits(value: str) -> Dict[str, int]:
+    """'api.line.me=20,api.openai.com=10' 形式をパース"""
+    limits = {}
+    for item in (value or '').split(','):
+        if '=' in item:
+            host, limit = item.split('=', 1)
+            limits[host.strip()] = int(limit)
+    return limits
+
+
+class _HostStats:
+    """ホストごとの集計"""
+
+    __slots__ = ('requests', 'errors', 'in_flight', 'max_in_flight', 'latencies')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.latencies = deque(maxlen=1000)
+
+
+class _InstrumentedAdapter(HTTPAdapter):
+    """デフォルトタイムアウトの適用とレイテンシ計測を行うHTTPAdapter"""
+
+    def __init__(self, registry, default_timeout, **kwargs):
+        self._registry = registry
+        self._default_timeout = default_timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self._default_timeout
+        host = urlparse(request.url).hostname
+        with self._registry.track(host, self._pool_maxsize) as outcome:
+            response = super().send(request, **kwargs)
+            outcome['error'] = response.status_code == 429 or response.status_code >= 500
+            return response
+
+
+if httpx:
+    class _InstrumentedTransport(httpx.HTTPTransport):
+        """接続数上限付きでレイテンシを計測するhttpxトランスポート"""
+
+        def __init__(self, registry, host, limit):
+            super().__init__(limits=httpx.Limits(max_connections=limit, max_keepalive_connections=limit))
+            self._registry = registry
+            self._host = host
+
+        def handle_request(self, request):
+            with self._registry.track(self._host) as outcome:
+                response = super().handle_request(request)
+                outcome['error'] = response.status_code == 429 or response.status_code >= 500
+                return response
+
+    class _InstrumentedAsyncTransport(httpx.AsyncHTTPTransport):
+        """_InstrumentedTransport の非同期版"""
+
+        def __init__(self, registry, host, limit):
+            super().__init__(limits=httpx.Limits(max_connections=limit, max_keepalive_connections=limit))
+            self._registry = registry
+            self._host = host
+
+        async def handle_async_request(self, request):
+            with self._registry.track(self._host) as outcome:
+                response = await super().handle_async_request(request)
+                outcome['error'] = response.status_code == 429 or response.status_code >= 500
+                return response
+
+
+class HTTPClientRegistry:
+    """プロセス全体で共有するHTTPクライアントの管理"""
+
+    def __init__(self, pool_maxsize: int = 10, connect_timeout: float = 5.0,
+                 read_timeout: float = 30.0, max_retries: int = 2, backoff_factor: float = 0.5,
+                 host_limits: Optional[Dict[str, int]] = None):
+        """
+        レジストリ初期化
+
+        Args:
+            pool_maxsize: ホストごとのKeep-Alive接続数（デフォルト）
+            connect_timeout: 接続タイムアウト（秒）
+            read_timeout: 読み込みタイムアウト（秒）
+            max_retries: 接続エラー・429/5xx時の最大リトライ回数
+            backoff_factor: リトライ間隔の係数
+            host_limits: ホストごとの接続数上限（例: {'api.line.me': 20}）
+        """
+        self.pool_maxsize = pool_maxsize
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.host_limits = host_limits or {}
+
+        self._session = None
+        self._openai_clients = {}
+        self._async_openai_clients = {}
+        self._lock = threading.Lock()
+        self._stats = defaultdict(_HostStats)
+        self._pool_sizes = {}
+
+    @classmethod
+    def from_env(cls):
+        """環境変数から設定を読み込んで生成"""
+        return cls(
+            pool_maxsize=int(os.environ.get('HTTP_POOL_MAXSIZE', 10)),
+            connect_timeout=float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5)),
+            read_timeout=float(os.environ.get('HTTP_READ_TIMEOUT', 30)),
+            max_retries=int(os.environ.get('HTTP_MAX_RETRIES', 2)),
+            host_limits=_parse_host_limits(os.environ.get('HTTP_HOST_LIMITS', '')),
+        )
+
+    def _retry_policy(self) -> Retry:
+        # POSTは接続エラーのみリトライ（送信済みリクエストは再送しない）
+        return Retry(
+            total=self.max_retries,
+            connect=self.max_retries,
+            read=self.max_retries,
+            status=self.max_retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+
+    def _adapter(self, pool_maxsize: int) -> HTTPAdapter:
+        return _InstrumentedAdapter(
+            self,
+            self.timeout,
+            pool_connections=10,
+            pool_maxsize=pool_maxsize,
+            pool_block=True,
+            max_retries=self._retry_policy(),
+        )
+
+    def session(self) -> requests.Session:
+        """共有 requests.Session を取得"""
+        if self._session is not None:
+            return self._session
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                session.mount('https://', self._adapter(self.pool_maxsize))
+                session.mount('http://', self._adapter(self.pool_maxsize))
+                for host, limit in self.host_limits.items():
+                    session.mount(f'https://{host}/', self._adapter(limit))
+                    self._pool_sizes[host] = limit
+                self._session = session
+        return self._session
+
+    def openai_client(self, api_key: str, base_url: Optional[str] = None):
+        """
+        共有 openai.OpenAI クライアントを取得（APIキー・ベースURLごとに1つ）
+
+        Args:
+            api_key: OpenAI APIキー
+            base_url: APIのベースURL（省略時はOpenAIのデフォルト）
+        """
+        key = (api_key, base_url)
+        client = self._openai_clients.get(key)
+        if client is not None:
+            return client
+
+        import openai
+
+        with self._lock:
+            client = self._openai_clients.get(key)
+            if client is None and httpx is None:
+                client = openai.OpenAI(api_key=api_key, base_url=base_url)
+                self._openai_clients[key] = client
+            elif client is None:
+                host = httpx.URL(base_url or 'https://api.openai.com/v1').host
+                limit = self.host_limits.get(host, self.pool_maxsize)
+                self._pool_sizes[host] = limit
+                http_client = httpx.Client(
+                    transport=_InstrumentedTransport(self, host, limit),
+                    timeout=httpx.Timeout(self.timeout[1], connect=self.timeout[0]),
+                )
+                kwargs = {'api_key': api_key, 'http_client': http_client, 'max_retries': self.max_retries}
+                if base_url:
+                    kwargs['base_url'] = base_url
+                client = openai.OpenAI(**kwargs)
+                self._openai_clients[key] = client
+        return client
+
+    def async_openai_client(self, api_key: str, base_url: Optional[str] = None):
+        """
+        共有 openai.AsyncOpenAI クライアントを取得（APIキー・ベースURLごとに1つ）
+        リトライは呼び出し側（llm_gateway）が行うため、SDKのリトライは無効
+
+        Args:
+            api_key: OpenAI APIキー
+            base_url: APIのベースURL（省略時はOpenAIのデフォルト）
+        """
+        key = (api_key, base_url)
+        client = self._async_openai_clients.get(key)
+        if client is not None:
+            return client
+
+        import openai
+
+        with self._lock:
+            client = self._async_openai_clients.get(key)
+            if client is None:
+                kwargs = {'api_key': api_key, 'max_retries': 0}
+                if base_url:
+                    kwargs['base_url'] = base_url
+                if httpx is not None:
+                    host = httpx.URL(base_url or 'https://api.openai.com/v1').host
+                    limit = self.host_limits.get(host, self.pool_maxsize)
+                    self._pool_sizes[host] = limit
+                    kwargs['http_client'] = httpx.AsyncClient(
+                        transport=_InstrumentedAsyncTransport(self, host, limit),
+                        timeout=httpx.Timeout(self.timeout[1], connect=self.timeout[0]),
+                    )
+                client = openai.AsyncOpenAI(**kwargs)
+                self._async_openai_clients[key] = client
+        return client
+
+    @contextmanager
+    def track(self, host: str, pool_size: Optional[int] = None):
+        """リクエスト1件のレイテンシ・同時実行数を記録"""
+        with self._lock:
+            stats = self._stats[host]
+            stats.requests += 1
+            stats.in_flight += 1
+            stats.max_in_flight = max(stats.max_in_flight, stats.in_flight)
+            if pool_size and host not in self._pool_sizes:
+                self._pool_sizes[host] = pool_size
+
+        outcome = {'error': False}
+        started = time.perf_counter()
+        try:
+            yield outcome
+        except Exception:
+            outcome['error'] = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                stats.in_flight -= 1
+                stats.latencies.append(elapsed)
+                if outcome['error']:
+                    stats.errors += 1
+
+    def stats(self) -> Dict:
+        """ホストごとのレイテンシ・プール使用率"""
+        with self._lock:
+            result = {}
+            for host, stats in self._stats.items():
+                latencies = sorted(stats.latencies)
+                pool_size = self._pool_sizes.get(host, self.pool_maxsize)
+                result[host] = {
+                    'requests': stats.requests,
+                    'errors': stats.errors,
+                    'in_flight': stats.in_flight,
+                    'max_in_flight': stats.max_in_flight,
+                    'pool_size': pool_size,
+                    'pool_saturation': round(stats.max_in_flight / pool_size * 100, 1) if pool_size else 0.0,
+                    'latency_ms_p50': round(latencies[len(latencies) // 2] * 1000, 1) if latencies else 0.0,
+                    'latency_ms_p95': round(latencies[int(len(latencies) * 0.95)] * 1000, 1) if latencies else 0.0,
+                }
+            return result
+
+
+if RequestsHttpClient:
+    class SharedSessionLineHttpClient(RequestsHttpClient):
+        """共有Sessionを使うLineBotApi用HTTPクライアント（LineBotApi(http_client=...)に渡す）"""
+
+        def get(self, url, headers=None, params=None, stream=False, timeout=None):
+            response = get_session().get(url, headers=headers, params=params, stream=stream,
+                                         timeout=timeout or self.timeout)
+            return RequestsHttpResponse(response)
+
+        def post(self, url, headers=None, data=None, timeout=None):
+            response = get_session().post(url, headers=headers, data=data, timeout=timeout or self.timeout)
+            return RequestsHttpResponse(response)
+
+        def put(self, url, headers=None, data=None, timeout=None):
+            response = get_session().put(url, headers=headers, data=data, timeout=timeout or self.timeout)
+            return RequestsHttpResponse(response)
+
+        def delete(self, url, headers=None, data=None, timeout=None):
+            response = get_session().delete(url, headers=headers, data=data, timeout=timeout or self.timeout)
+            return RequestsHttpResponse(response)
+else:
+    SharedSessionLineHttpClient = None
+
+
+# プロセス全体で共有するレジストリ
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> HTTPClientRegistry:
+    """共有レジストリを取得"""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = HTTPClientRegistry.from_env()
+    return _registry
+
+
+def get_session() -> requests.Session:
+    """共有 requests.Session を取得"""
+    return get_registry().session()
+
+
+def get_openai_client(api_key: str, base_url: Optional[str] = None):
+    """共有 openai.OpenAI クライアントを取得"""
+    return get_registry().openai_client(api_key, base_url)
+
+
+def get_async_openai_client(api_key: str, base_url: Optional[str] = None):
+    """共有 openai.AsyncOpenAI クライアントを取得"""
+    return get_registry().async_openai_client(api_key, base_url)
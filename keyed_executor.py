@@ -0,0 +1,102 @@
+"""
+キー単位直列Executor
+同じキー（LINEユーザーIDなど）のタスクは投入順に1つずつ実行し、
+異なるキーのタスクはスレッドプールで並列に実行する
+"""
+
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedSerialExecutor:
+    """同一キーは直列・異なるキーは並列に実行するExecutor"""
+
+    def __init__(self, max_workers: int = 4, thread_name_prefix: str = 'keyed-worker'):
+        """
+        Executor初期化
+
+        Args:
+            max_workers: 並列実行する最大スレッド数
+            thread_name_prefix: ワーカースレッド名のプレフィックス
+        """
+        self.max_workers = max_workers
+        # ThreadPoolExecutorはスレッドを遅延生成するため、gunicornのfork前に作成しても安全
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self._lock = threading.Lock()
+        # 実行中のキー -> 待機中タスクのキュー
+        self._chains = {}
+
+    def submit(self, key: Optional[Hashable], fn: Callable, *args, **kwargs) -> Future:
+        """
+        タスクを投入
+
+        Args:
+            key: 直列化キー（Noneの場合は他と独立して実行）
+            fn: 実行する関数
+
+        Returns:
+            Future: 実行結果（プールに投入できなかった場合はそのエラー）
+        """
+        future = Future()
+        task = (future, fn, args, kwargs)
+
+        if key is None:
+            try:
+                self._pool.submit(self._run_task, task)
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        with self._lock:
+            if key in self._chains:
+                # 同じキーのタスクが実行中 → 完了後に順番に実行
+                self._chains[key].append(task)
+                return future
+            self._chains[key] = deque()
+
+        try:
+            self._pool.submit(self._run_chain, key, task)
+        except Exception as e:
+            # 停止後などで投入できなかった → キーを空けないと以降の同じキーのタスクが永久に待つ
+            with self._lock:
+                pending = self._chains.pop(key)
+            for waiting in [task, *pending]:
+                waiting[0].set_exception(e)
+        return future
+
+    def _run_task(self, task):
+        """タスク1件を実行し、結果をFutureに設定"""
+        future, fn, args, kwargs = task
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def _run_chain(self, key, task):
+        """同じキーの待機タスクがなくなるまで同一スレッドで順番に実行"""
+        while True:
+            self._run_task(task)
+            with self._lock:
+                pending = self._chains[key]
+                if not pending:
+                    del self._chains[key]
+                    return
+                task = pending.popleft()
+
+    def active_keys(self) -> int:
+        """実行中のキー数"""
+        with self._lock:
+            return len(self._chains)
+
+    def shutdown(self, wait: bool = True):
+        """Executorを停止（wait=Trueの場合は投入済みタスクの完了を待つ）"""
+        self._pool.shutdown(wait=wait)
@@ -0,0 +1,129 @@
+"""
+LINEアカウント解決キャッシュ
+LINEユーザーID → 連携済みユーザーID の対応をプロセス内にキャッシュ（TTL + LRU）
+未連携ユーザーも短いTTLでネガティブキャッシュする
+"""
+
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class LineAccountResolver:
+    """LINEユーザーID → ユーザーID の解決キャッシュ"""
+
+    def __init__(self, lookup: Callable[[str], Optional[int]], max_size: int = 10000,
+                 ttl: float = 300.0, negative_ttl: float = 30.0):
+        """
+        キャッシュ初期化
+
+        Args:
+            lookup: キャッシュミス時にDBから解決する関数（未連携ならNone）
+            max_size: 保持する最大エントリ数（超過時は最も古く使われたものから削除）
+            ttl: 連携済みエントリの有効期間（秒）
+            negative_ttl: 未連携エントリの有効期間（秒）
+        """
+        self.lookup = lookup
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        self._entries = OrderedDict()  # line_user_id -> (user_id, expires_at)
+        self._lock = threading.Lock()
+        # DB検索中に無効化されたキーの結果を書き戻さないための世代番号
+        # （キーごとの無効化世代は、そのキーの検索が実行中の間だけ保持する）
+        self._generation = 0
+        self._cleared_at = 0
+        self._invalidated_at = {}  # line_user_id -> 無効化時の世代
+        self._lookups = Counter()  # line_user_id -> 実行中のDB検索数
+        self._hits = 0
+        self._negative_hits = 0
+        self._misses = 0
+
+    def resolve(self, line_user_id: str) -> Optional[int]:
+        """
+        LINEユーザーIDから連携済みユーザーIDを取得
+
+        Args:
+            line_user_id: LINEユーザーID
+
+        Returns:
+            int: ユーザーID（未連携の場合None）
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(line_user_id, _MISSING)
+            if entry is not _MISSING:
+                user_id, expires_at = entry
+                if expires_at > now:
+                    self._entries.move_to_end(line_user_id)
+                    if user_id is None:
+                        self._negative_hits += 1
+                    else:
+                        self._hits += 1
+                    return user_id
+                del self._entries[line_user_id]
+            self._misses += 1
+            started_at = self._generation
+            self._lookups[line_user_id] += 1
+
+        try:
+            user_id = self.lookup(line_user_id)
+        finally:
+            with self._lock:
+                stale = (self._cleared_at > started_at
+                         or self._invalidated_at.get(line_user_id, 0) > started_at)
+                self._lookups[line_user_id] -= 1
+                if not self._lookups[line_user_id]:
+                    del self._lookups[line_user_id]
+                    self._invalidated_at.pop(line_user_id, None)
+
+        if stale:
+            # 検索中に連携が作成・解除された → 古いかもしれない結果はキャッシュしない
+            return user_id
+
+        with self._lock:
+            ttl = self.ttl if user_id is not None else self.negative_ttl
+            self._entries[line_user_id] = (user_id, now + ttl)
+            self._entries.move_to_end(line_user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+        return user_id
+
+    def invalidate(self, line_user_id: Optional[str] = None):
+        """
+        キャッシュを無効化（連携作成・解除時に呼ぶ）
+
+        Args:
+            line_user_id: 対象のLINEユーザーID（省略時は全件）
+        """
+        with self._lock:
+            self._generation += 1
+            if line_user_id is None:
+                self._entries.clear()
+                self._cleared_at = self._generation
+            else:
+                self._entries.pop(line_user_id, None)
+                if line_user_id in self._lookups:
+                    self._invalidated_at[line_user_id] = self._generation
+
+    def stats(self) -> Dict:
+        """ヒット率などの統計情報を取得"""
+        with self._lock:
+            hits = self._hits + self._negative_hits
+            total = hits + self._misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self._hits,
+                'negative_hits': self._negative_hits,
+                'misses': self._misses,
+                'hit_rate': round(hits / total * 100, 1) if total else 0.0,
+            }
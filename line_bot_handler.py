@@ -4,7 +4,7 @@ import hashlib
 import hmac
 import base64
 import json
-import requests
+from http_clients import get_session
 from language_handler import LanguageHandler
 
 class LineBotHandler:
@@ -74,7 +74,7 @@ class LineBotHandler:
         }
         
         try:
-            response = requests.post(url, headers=headers, json=data)
+            response = get_session().post(url, headers=headers, json=data)
             if response.status_code == 200:
                 self.logger.info("Reply sent successfully")
             else:
@@ -110,7 +110,7 @@ class LineBotHandler:
         }
         
         try:
-            response = requests.post(url, headers=headers, json=data)
+            response = get_session().post(url, headers=headers, json=data)
             if response.status_code == 200:
                 self.logger.info("Multilingual welcome sent successfully")
             else:
@@ -0,0 +1,476 @@
+"""
+LLMゲートウェイ
+OpenAI Chat Completions の呼び出しをプロセス共有のイベントループ（バックグラウンドスレッド）で実行する
+- 同時実行数の上限: セマフォで待ち行列化（APIキーをまたいでプロセス全体で共通）
+- リトライ: 429・5xx・接続エラー・タイムアウト時に指数バックオフ（フルジッター）
+  429 で Retry-After / retry-after-ms ヘッダーがあればその秒数だけ待つ
+- バックオフの待機はイベントループ上の asyncio.sleep で行い、待機中は同時実行枠を解放する
+- PDF変換などの一括処理（lane='bulk'）は同時実行枠のうち max_bulk_in_flight 件までしか使わず、
+  LINEの応答など対話的な呼び出しの枠を残す
+- ストリーミングは終わるまで枠を持ち続けるため、同時に max_streams 本までに制限する
+- 同期ファサード chat() / submit() / stream() により既存のFlaskルートから段階的に移行できる
+"""
+
+import asyncio
+import email.utils
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import AsyncIterator, Dict, Iterator, Optional
+
+import openai
+
+from http_clients import get_async_openai_client
+
+logger = logging.getLogger(__name__)
+
+_RETRYABLE_STATUS = (408, 409, 429, 500, 502, 503, 504)
+
+LANE_INTERACTIVE = 'interactive'
+LANE_BULK = 'bulk'
+LANE_STREAM = 'stream'
+
+
+def _retry_after_seconds(error) -> Optional[float]:
+    """エラーレスポンスの Retry-After（秒またはHTTP日付）/ retry-after-ms ヘッダー"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    value = headers.get('retry-after-ms')
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class GatewayTimeoutError(openai.APITimeoutError):
+    """ゲートウェイ内の待ち（同時実行枠の待ち行列など）で期限切れになった（OpenAIには送っていない）"""
+
+
+def is_local_timeout(error) -> bool:
+    """OpenAIからの応答ではなく、このプロセス内の待ちの期限切れによるエラーか"""
+    return isinstance(error, (GatewayTimeoutError, FutureTimeoutError))
+
+
+def is_transient_error(error) -> bool:
+    """リトライで回復しうるエラー（接続エラー・タイムアウト・429・5xx など）か"""
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError, asyncio.TimeoutError, TimeoutError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in _RETRYABLE_STATUS
+    return False
+
+
+class LLMGateway:
+    """同時実行数を制限し、リトライを非同期に行うOpenAI呼び出しの窓口"""
+
+    def __init__(self, max_in_flight: int = 8, max_retries: int = 3, base_delay: float = 0.5,
+                 max_delay: float = 20.0, deadline: float = 60.0, max_bulk_in_flight: int = 2,
+                 max_streams: Optional[int] = None):
+        """
+        ゲートウェイ初期化
+
+        Args:
+            max_in_flight: 同時にOpenAIへ送るリクエスト数の上限
+            max_bulk_in_flight: そのうち一括処理（lane='bulk'）が使える上限（max_in_flight 未満に丸める）
+            max_streams: そのうちストリーミングが使える上限（省略時は max_in_flight の半分、max_in_flight 未満に丸める）
+            max_retries: 1回目の失敗後の最大リトライ回数
+            base_delay: バックオフの基準秒数（attempt回目は最大 base_delay * 2**attempt 秒）
+            max_delay: バックオフ1回あたりの最大秒数（Retry-After もこの値で頭打ち）
+            deadline: 呼び出し1件の待ち行列・リトライを含めた最大秒数（既定値）
+        """
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        if max_streams is None:
+            max_streams = max_in_flight // 2
+        self.lane_limits = {
+            LANE_BULK: max(1, min(max_bulk_in_flight, max_in_flight - 1)),
+            LANE_STREAM: max(1, min(max_streams, max_in_flight - 1)),
+        }
+
+        self._loop = None
+        self._thread = None
+        self._semaphore = None
+        self._lane_semaphores = {}
+        self._start_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._waiting = 0
+        self._lane_in_flight = {lane: 0 for lane in self.lane_limits}
+        self._stats = {
+            'calls': 0,
+            'streams': 0,
+            'succeeded': 0,
+            'failed': 0,
+            'retries': 0,
+            'rate_limited': 0,
+            'retry_after_honored': 0,
+            'deadline_exceeded': 0,
+            'abandoned': 0,
+            'max_in_flight_seen': 0,
+            'max_waiting': 0,
+            'wait_ms_total': 0.0,
+            'call_ms_total': 0.0,
+        }
+
+    @classmethod
+    def from_env(cls):
+        """環境変数から設定を読み込んで生成"""
+        return cls(
+            max_in_flight=int(os.environ.get('LLM_MAX_IN_FLIGHT', 8)),
+            max_retries=int(os.environ.get('LLM_MAX_RETRIES', 3)),
+            base_delay=float(os.environ.get('LLM_BACKOFF_BASE', 0.5)),
+            max_delay=float(os.environ.get('LLM_BACKOFF_MAX', 20)),
+            deadline=float(os.environ.get('LLM_DEADLINE', 60)),
+            max_bulk_in_flight=int(os.environ.get('LLM_BULK_MAX_IN_FLIGHT', 2)),
+            max_streams=int(os.environ['LLM_MAX_STREAMS']) if os.environ.get('LLM_MAX_STREAMS') else None,
+        )
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        """バックグラウンドのイベントループを（初回のみ）起動"""
+        if self._loop is not None:
+            return self._loop
+        with self._start_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                ready = threading.Event()
+
+                def run():
+                    asyncio.set_event_loop(loop)
+                    self._semaphore = asyncio.Semaphore(self.max_in_flight)
+                    self._lane_semaphores = {lane: asyncio.Semaphore(limit)
+                                             for lane, limit in self.lane_limits.items()}
+                    loop.call_soon(ready.set)
+                    loop.run_forever()
+
+                self._thread = threading.Thread(target=run, name='llm-gateway', daemon=True)
+                self._thread.start()
+                ready.wait()
+                self._loop = loop
+        return self._loop
+
+    def backoff_delay(self, attempt: int, error=None) -> float:
+        """
+        attempt 回目の失敗後に待つ秒数
+
+        Args:
+            attempt: 0始まりの失敗回数
+            error: 直前のエラー（429 の Retry-After を参照）
+
+        Returns:
+            float: 待機秒数（max_delay 以下）
+        """
+        if isinstance(error, openai.RateLimitError):
+            retry_after = _retry_after_seconds(error)
+            if retry_after is not None:
+                with self._lock:
+                    self._stats['retry_after_honored'] += 1
+                return min(self.max_delay, retry_after)
+        # フルジッター: 同時に失敗したリクエストが同じタイミングで再送しないようにする
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    async def _acquire(self, expires_at: float, lane: str = LANE_INTERACTIVE):
+        """同時実行枠を確保（レーンに上限があればレーンの枠を先に確保、期限までに確保できなければタイムアウト）"""
+        with self._lock:
+            self._waiting += 1
+            self._stats['max_waiting'] = max(self._stats['max_waiting'], self._waiting)
+        queued_at = time.monotonic()
+        lane_semaphore = self._lane_semaphores.get(lane)
+        lane_acquired = False
+        try:
+            if lane_semaphore is not None:
+                await asyncio.wait_for(lane_semaphore.acquire(), timeout=max(0.0, expires_at - time.monotonic()))
+                lane_acquired = True
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=max(0.0, expires_at - time.monotonic()))
+        except BaseException as error:
+            # 取り消された場合も確保済みのレーンの枠を返す
+            if lane_acquired:
+                lane_semaphore.release()
+            if not isinstance(error, asyncio.TimeoutError):
+                raise
+            with self._lock:
+                self._stats['deadline_exceeded'] += 1
+                self._stats['failed'] += 1
+            raise GatewayTimeoutError(request=None) from None
+        finally:
+            with self._lock:
+                self._waiting -= 1
+                self._stats['wait_ms_total'] += (time.monotonic() - queued_at) * 1000
+
+        with self._lock:
+            self._in_flight += 1
+            self._stats['max_in_flight_seen'] = max(self._stats['max_in_flight_seen'], self._in_flight)
+            if lane in self._lane_in_flight:
+                self._lane_in_flight[lane] += 1
+        return time.monotonic()
+
+    def _release(self, call_started: float, lane: str = LANE_INTERACTIVE) -> float:
+        """同時実行枠を解放し、枠を持っていた（OpenAIを呼び出していた）秒数を返す"""
+        seconds = time.monotonic() - call_started
+        self._semaphore.release()
+        if lane in self._lane_semaphores:
+            self._lane_semaphores[lane].release()
+        with self._lock:
+            self._in_flight -= 1
+            if lane in self._lane_in_flight:
+                self._lane_in_flight[lane] -= 1
+            self._stats['call_ms_total'] += seconds * 1000
+        return seconds
+
+    def _retry_delay(self, failure, attempt: int, expires_at: float) -> float:
+        """リトライまでの待機秒数（リトライしない場合は failure を送出）"""
+        if isinstance(failure, openai.RateLimitError):
+            with self._lock:
+                self._stats['rate_limited'] += 1
+        delay = self.backoff_delay(attempt, failure) if is_transient_error(failure) else None
+        if delay is None or attempt >= self.max_retries or time.monotonic() + delay >= expires_at:
+            with self._lock:
+                self._stats['failed'] += 1
+                if delay is not None and attempt < self.max_retries:
+                    self._stats['deadline_exceeded'] += 1
+            raise failure
+
+        logger.warning(f"OpenAI call failed ({type(failure).__name__}), retry {attempt + 1} in {delay:.2f}s")
+        with self._lock:
+            self._stats['retries'] += 1
+        return delay
+
+    async def achat(self, api_key: str, base_url: Optional[str] = None, deadline: Optional[float] = None,
+                    lane: str = LANE_INTERACTIVE, timing: Optional[Dict] = None, **params):
+        """
+        Chat Completions を呼び出す（ゲートウェイのイベントループ上で実行すること）
+
+        Args:
+            api_key: OpenAI APIキー
+            base_url: APIのベースURL（省略時はOpenAIのデフォルト）
+            deadline: 待ち行列・リトライを含めた最大秒数（省略時は既定値）
+            lane: 'interactive'（既定）/ 'bulk'（一括処理、同時実行数を max_bulk_in_flight に制限）
+            timing: 渡すと 'call_seconds'（待ち行列・バックオフを除いたOpenAIの呼び出し時間の合計）を書き込む
+            **params: chat.completions.create の引数（model, messages, max_tokens, timeout など）
+
+        Returns:
+            ChatCompletion: OpenAIの応答（失敗時は最後のエラーを送出）
+        """
+        client = get_async_openai_client(api_key, base_url)
+        expires_at = time.monotonic() + (deadline or self.deadline)
+        with self._lock:
+            self._stats['calls'] += 1
+
+        attempt = 0
+        while True:
+            call_started = await self._acquire(expires_at, lane)
+            try:
+                response = await client.chat.completions.create(**params)
+            except Exception as error:
+                failure = error
+            else:
+                failure = None
+            finally:
+                call_seconds = self._release(call_started, lane)
+                if timing is not None:
+                    timing['call_seconds'] = timing.get('call_seconds', 0.0) + call_seconds
+
+            if failure is None:
+                with self._lock:
+                    self._stats['succeeded'] += 1
+                return response
+
+            # 同時実行枠を解放したまま待つ
+            await asyncio.sleep(self._retry_delay(failure, attempt, expires_at))
+            attempt += 1
+
+    async def astream(self, api_key: str, base_url: Optional[str] = None, deadline: Optional[float] = None,
+                      **params) -> AsyncIterator:
+        """
+        Chat Completions をストリーミングで呼び出す（ゲートウェイのイベントループ上で実行すること）
+        リトライは最初のチャンクを受け取るまで。ストリーム中は同時実行枠を保持する
+        （ストリーミング用のレーンで max_streams 本までに制限し、残りの枠を対話的な呼び出しに残す）
+
+        Args:
+            api_key: OpenAI APIキー
+            base_url: APIのベースURL（省略時はOpenAIのデフォルト）
+            deadline: 待ち行列・リトライ（最初のチャンクまで）を含めた最大秒数（省略時は既定値）
+            **params: chat.completions.create の引数（stream=True は自動で付与）
+
+        Yields:
+            ChatCompletionChunk: 受信したチャンク
+        """
+        client = get_async_openai_client(api_key, base_url)
+        expires_at = time.monotonic() + (deadline or self.deadline)
+        with self._lock:
+            self._stats['calls'] += 1
+            self._stats['streams'] += 1
+
+        attempt = 0
+        while True:
+            call_started = await self._acquire(expires_at, LANE_STREAM)
+            received = False
+            try:
+                stream = await client.chat.completions.create(stream=True, **params)
+                try:
+                    async for chunk in stream:
+                        received = True
+                        yield chunk
+                finally:
+                    # 途中で中断された場合も接続をプールに返す
+                    await stream.response.aclose()
+            except Exception as error:
+                if received:
+                    # 送信済みのトークンは取り消せないためリトライしない
+                    with self._lock:
+                        self._stats['failed'] += 1
+                    raise
+                failure = error
+            else:
+                failure = None
+            finally:
+                self._release(call_started, LANE_STREAM)
+
+            if failure is None:
+                with self._lock:
+                    self._stats['succeeded'] += 1
+                return
+
+            await asyncio.sleep(self._retry_delay(failure, attempt, expires_at))
+            attempt += 1
+
+    def submit(self, api_key: str, base_url: Optional[str] = None, deadline: Optional[float] = None,
+               lane: str = LANE_INTERACTIVE, timing: Optional[Dict] = None, **params) -> Future:
+        """
+        Chat Completions の呼び出しを予約（呼び出し元スレッドはブロックしない）
+        引数は achat と同じ
+
+        Returns:
+            concurrent.futures.Future: ChatCompletion またはエラーを返すFuture
+        """
+        loop = self._ensure_loop()
+        return asyncio.run_coroutine_threadsafe(
+            self.achat(api_key, base_url=base_url, deadline=deadline, lane=lane, timing=timing, **params), loop)
+
+    def stream(self, api_key: str, base_url: Optional[str] = None, deadline: Optional[float] = None,
+               **params) -> Iterator:
+        """
+        Chat Completions をストリーミングで呼び出す（同期ファサード）
+        途中でイテレーションをやめた場合（クライアント切断など）はOpenAIへのストリームも中断する
+
+        Args:
+            api_key: OpenAI APIキー
+            base_url: APIのベースURL（省略時はOpenAIのデフォルト）
+            deadline: 最初のチャンクまでの最大秒数（省略時は既定値）
+            **params: chat.completions.create の引数
+
+        Yields:
+            ChatCompletionChunk: 受信したチャンク
+        """
+        loop = self._ensure_loop()
+        chunks = queue.Queue()
+
+        async def pump():
+            try:
+                async for chunk in self.astream(api_key, base_url=base_url, deadline=deadline, **params):
+                    chunks.put(('chunk', chunk))
+            except Exception as error:
+                chunks.put(('error', error))
+            else:
+                chunks.put(('done', None))
+
+        future = asyncio.run_coroutine_threadsafe(pump(), loop)
+        wait = (deadline or self.deadline) + float(params.get('timeout') or 30)
+        try:
+            while True:
+                try:
+                    kind, value = chunks.get(timeout=wait)
+                except queue.Empty:
+                    # 待ち行列・リトライ中の呼び出しが同時実行枠を持ったまま続かないよう取り消す
+                    self._abandon(future)
+                    raise GatewayTimeoutError(request=None) from None
+                if kind == 'chunk':
+                    yield value
+                elif kind == 'error':
+                    raise value
+                else:
+                    return
+        finally:
+            future.cancel()
+
+    def chat(self, api_key: str, base_url: Optional[str] = None, deadline: Optional[float] = None,
+             lane: str = LANE_INTERACTIVE, timing: Optional[Dict] = None, **params):
+        """
+        Chat Completions を呼び出して結果を待つ（同期ファサード）
+
+        Args:
+            api_key: OpenAI APIキー
+            base_url: APIのベースURL（省略時はOpenAIのデフォルト）
+            deadline: 待ち行列・リトライを含めた最大秒数（省略時は既定値）
+            lane: 'interactive'（既定）/ 'bulk'
+            timing: 渡すと 'call_seconds'（OpenAIの呼び出し時間の合計）を書き込む
+            **params: chat.completions.create の引数
+
+        Returns:
+            ChatCompletion: OpenAIの応答（失敗時は最後のエラー、ゲートウェイ内の待ちで期限切れなら
+            GatewayTimeoutError / TimeoutError を送出）
+        """
+        future = self.submit(api_key, base_url=base_url, deadline=deadline, lane=lane, timing=timing, **params)
+        # 最後の試行がタイムアウトするまでの猶予を加えて待つ
+        try:
+            return future.result(timeout=(deadline or self.deadline) + float(params.get('timeout') or 30))
+        except FutureTimeoutError:
+            # 誰も待っていない呼び出しが同時実行枠を持ったままリトライし続けないよう取り消す
+            self._abandon(future)
+            raise
+
+    def _abandon(self, future: Future):
+        """呼び出し元が待つのをやめた呼び出しを取り消す"""
+        if future.cancel():
+            with self._lock:
+                self._stats['abandoned'] += 1
+
+    def stats(self) -> Dict:
+        """統計情報を取得"""
+        with self._lock:
+            calls = self._stats['calls']
+            return {
+                **{key: value for key, value in self._stats.items() if not key.endswith('_ms_total')},
+                'wait_ms_avg': round(self._stats['wait_ms_total'] / calls, 1) if calls else 0.0,
+                'call_ms_avg': round(self._stats['call_ms_total'] / calls, 1) if calls else 0.0,
+                'in_flight': self._in_flight,
+                'waiting': self._waiting,
+                'max_in_flight': self.max_in_flight,
+                'lanes': {lane: {'in_flight': self._lane_in_flight[lane], 'max_in_flight': limit}
+                          for lane, limit in self.lane_limits.items()},
+            }
+
+
+# プロセス全体で共有するゲートウェイ
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway() -> LLMGateway:
+    """共有ゲートウェイを取得"""
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                _gateway = LLMGateway.from_env()
+    return _gateway
@@ -0,0 +1,509 @@
+#!/usr/bin/env python3
+"""
+Webhook負荷試験ハーネス
+署名付きのLINE Webhookペイロード（LineBotHandler.verify_signature と同じHMAC-SHA256方式）を
+N人の同時ユーザー × M テナントで main:app に送信し、スループット・レイテンシ・エラー数を計測する
+
+LINE Messaging API（reply/push）と OpenAI Chat Completions / Embeddings API はローカルのスタブサーバーで代替する
+スタブの遅延・エラー率は設定可能
+
+使い方:
+    # プロセス内でアプリを起動して計測（一時DB・スタブを自動で用意）
+    python load_test.py run --users 50 --tenants 5 --messages 20
+
+    # gunicorn などで起動済みのサーバーを計測（ワーカーモデルの比較用）
+    python load_test.py stubs --line-port 9101 --openai-port 9102 &
+    DATABASE_PATH=/tmp/lt.db LINE_CHANNEL_SECRET=loadtest LINE_CHANNEL_ACCESS_TOKEN=loadtest \\
+        OPENAI_API_KEY=sk-loadtest LINE_API_ENDPOINT=http://127.0.0.1:9101 \\
+        OPENAI_BASE_URL=http://127.0.0.1:9102/v1 gunicorn --workers 2 main:app &
+    python load_test.py run --target http://127.0.0.1:8000 --db /tmp/lt.db --users 50 --tenants 5
+"""
+
+import argparse
+import atexit
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+CHANNEL_SECRET = 'loadtest'
+CHANNEL_ACCESS_TOKEN = 'loadtest'
+
+QUESTIONS = [
+    '営業時間を教えてください',
+    'パスワードを忘れた場合はどうすればいいですか',
+    '返品の手続きについて知りたいです',
+    '料金プランの違いは何ですか',
+    'How do I reset the device?',
+    '配送にはどのくらいかかりますか',
+]
+
+MANUAL_TEXT = (
+    '営業時間は平日9時から18時までです。\n'
+    'パスワードを忘れた場合はログイン画面の「パスワードを忘れた方」から再設定してください。\n'
+    '返品は商品到着後14日以内にサポート窓口へご連絡ください。\n'
+    '配送は通常2〜3営業日でお届けします。\n'
+) * 20
+
+
+def sign_body(body: str, channel_secret: str) -> str:
+    """LineBotHandler.verify_signature と同じ方式で X-Line-Signature を生成"""
+    digest = hmac.new(channel_secret.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode('utf-8')
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))] * 1000
+
+
+# ============================================================
+# スタブサーバー
+# ============================================================
+
+class StubBehavior:
+    """スタブの応答遅延・エラー率と受信記録"""
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, error_rate: float = 0.0,
+                 error_status: int = 500):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.counts = Counter()
+        self.received = {}  # replyToken -> 受信時刻
+        self.lock = threading.Lock()
+
+    def delay(self):
+        latency = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if latency > 0:
+            time.sleep(latency / 1000)
+
+    def should_fail(self) -> bool:
+        return random.random() < self.error_rate
+
+    def count(self, key: str):
+        with self.lock:
+            self.counts[key] += 1
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    behavior = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        try:
+            return json.loads(raw or b'{}')
+        except ValueError:
+            return {}
+
+    def _send_json(self, status: int, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class LineStubHandler(_StubHandler):
+    """LINE Messaging API（reply / push）のスタブ"""
+
+    def do_POST(self):
+        data = self._read_json()
+        behavior = self.behavior
+        behavior.delay()
+
+        if self.path.startswith('/v2/bot/message/reply'):
+            kind = 'reply'
+        elif self.path.startswith('/v2/bot/message/push'):
+            kind = 'push'
+        else:
+            behavior.count('not_found')
+            self._send_json(404, {'message': 'Not found'})
+            return
+
+        if behavior.should_fail():
+            behavior.count(f'{kind}_errors')
+            self._send_json(behavior.error_status, {'message': 'Injected error'})
+            return
+
+        behavior.count(kind)
+        if kind == 'reply':
+            with behavior.lock:
+                behavior.received[data.get('replyToken')] = time.time()
+        self._send_json(200, {})
+
+    def do_GET(self):
+        self.behavior.count('profile')
+        self._send_json(200, {'userId': self.path.rsplit('/', 1)[-1], 'displayName': 'load test'})
+
+
+def stub_embedding(text: str, dim: int = 256):
+    """文字バイグラムのハッシュによる決定的な埋め込み（同じ文は同じベクトル）"""
+    vector = [0.0] * dim
+    for i in range(max(1, len(text) - 1)):
+        digest = hashlib.md5(text[i:i + 2].encode('utf-8')).digest()
+        vector[int.from_bytes(digest[:4], 'little') % dim] += 1.0 if digest[4] & 1 else -1.0
+    return vector
+
+
+class OpenAIStubHandler(_StubHandler):
+    """OpenAI Chat Completions / Embeddings API のスタブ"""
+
+    def do_POST(self):
+        data = self._read_json()
+        behavior = self.behavior
+        behavior.delay()
+
+        if self.path.rstrip('/').endswith('/embeddings'):
+            inputs = data.get('input') or []
+            if isinstance(inputs, str):
+                inputs = [inputs]
+            behavior.count('embeddings')
+            self._send_json(200, {
+                'object': 'list',
+                'data': [{'object': 'embedding', 'index': i, 'embedding': stub_embedding(str(text))}
+                         for i, text in enumerate(inputs)],
+                'model': data.get('model', 'text-embedding-3-small'),
+                'usage': {'prompt_tokens': 0, 'total_tokens': 0},
+            })
+            return
+
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            behavior.count('not_found')
+            self._send_json(404, {'error': {'message': 'Not found', 'type': 'invalid_request_error'}})
+            return
+
+        if behavior.should_fail():
+            behavior.count('errors')
+            status = behavior.error_status
+            headers = {'Retry-After': '1'} if status == 429 else None
+            self._send_json(status, {'error': {'message': 'Injected error', 'type': 'server_error'}}, headers)
+            return
+
+        behavior.count('chat_completions')
+        prompt_chars = sum(len(message.get('content') or '') for message in data.get('messages', [])
+                           if isinstance(message.get('content'), str))
+        answer = 'マニュアルによると、お問い合わせの件は窓口までご連絡ください。'
+        usage = {
+            'prompt_tokens': prompt_chars // 2,
+            'completion_tokens': len(answer) // 2,
+            'total_tokens': prompt_chars // 2 + len(answer) // 2,
+        }
+        if data.get('stream'):
+            self._send_stream(data, answer, usage)
+            return
+        self._send_json(200, {
+            'id': f'chatcmpl-{uuid.uuid4().hex[:12]}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': data.get('model', 'gpt-3.5-turbo'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': answer},
+                'finish_reason': 'stop',
+            }],
+            'usage': usage,
+        })
+
+    def _send_stream(self, data, answer: str, usage):
+        """stream=True の応答（数文字ずつのチャンク、include_usage 指定時は最後に使用量チャンク）"""
+        completion_id = f'chatcmpl-{uuid.uuid4().hex[:12]}'
+
+        def chunk(choices, **extra):
+            return {'id': completion_id, 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                    'model': data.get('model', 'gpt-3.5-turbo'), 'choices': choices, **extra}
+
+        events = [chunk([{'index': 0, 'delta': {'role': 'assistant', 'content': ''}, 'finish_reason': None}])]
+        for i in range(0, len(answer), 4):
+            events.append(chunk([{'index': 0, 'delta': {'content': answer[i:i + 4]}, 'finish_reason': None}]))
+        events.append(chunk([{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]))
+        if (data.get('stream_options') or {}).get('include_usage'):
+            events.append(chunk([], usage=usage))
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        for event in events:
+            self.wfile.write(f'data: {json.dumps(event, ensure_ascii=False)}\n\n'.encode('utf-8'))
+            self.wfile.flush()
+        self.wfile.write(b'data: [DONE]\n\n')
+        self.close_connection = True
+
+
+def start_stub(handler_class, behavior: StubBehavior, port: int = 0):
+    """スタブサーバーをバックグラウンドスレッドで起動"""
+    handler = type(handler_class.__name__, (handler_class,), {'behavior': behavior})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name=handler_class.__name__, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+# ============================================================
+# テストデータ
+# ============================================================
+
+def seed_tenants(db_path: str, tenants: int, users: int):
+    """
+    M テナント（マニュアル1件ずつ）と、そこへ連携した N 人のLINEユーザーを作成
+
+    Returns:
+        list: LINEユーザーIDのリスト
+    """
+    run_id = uuid.uuid4().hex[:8]
+    conn = sqlite3.connect(db_path, timeout=30)
+    cursor = conn.cursor()
+    tenant_ids = []
+    for i in range(tenants):
+        cursor.execute(
+            "INSERT INTO users (email, password_hash, plan, subscription_status) VALUES (?, ?, 'enterprise', 'active')",
+            (f'loadtest-{run_id}-{i}@example.com', 'x')
+        )
+        tenant_id = cursor.lastrowid
+        tenant_ids.append(tenant_id)
+        cursor.execute(
+            'INSERT INTO files (user_id, filename, file_size, content) VALUES (?, ?, ?, ?)',
+            (tenant_id, f'manual-{i}.txt', len(MANUAL_TEXT), MANUAL_TEXT)
+        )
+
+    line_user_ids = []
+    for i in range(users):
+        line_user_id = f'U{run_id}{i:024d}'
+        cursor.execute('INSERT INTO line_accounts (user_id, line_user_id) VALUES (?, ?)',
+                       (tenant_ids[i % tenants], line_user_id))
+        line_user_ids.append(line_user_id)
+    conn.commit()
+    conn.close()
+    return line_user_ids
+
+
+def build_payload(line_user_id: str, text: str, reply_token: str) -> str:
+    """LINE Webhook のメッセージイベント1件分のリクエストボディ"""
+    return json.dumps({
+        'destination': 'Uloadtest',
+        'events': [{
+            'type': 'message',
+            'mode': 'active',
+            'timestamp': int(time.time() * 1000),
+            'webhookEventId': uuid.uuid4().hex.upper()[:26],
+            'deliveryContext': {'isRedelivery': False},
+            'replyToken': reply_token,
+            'source': {'type': 'user', 'userId': line_user_id},
+            'message': {'id': str(random.randint(10 ** 14, 10 ** 15)), 'type': 'text',
+                        'quoteToken': uuid.uuid4().hex, 'text': text},
+        }],
+    }, ensure_ascii=False)
+
+
+# ============================================================
+# 負荷生成
+# ============================================================
+
+class LoadResult:
+    """送信結果の集計"""
+
+    def __init__(self):
+        self.latencies = []
+        self.sent = {}  # replyToken -> 送信時刻
+        self.statuses = Counter()
+        self.exceptions = Counter()
+        self.lock = threading.Lock()
+
+
+def run_user(target: str, line_user_id: str, messages: int, think_ms: float, channel_secret: str,
+             result: LoadResult):
+    """LINEユーザー1人分：messages 件を順番に送信"""
+    session = requests.Session()
+    for _ in range(messages):
+        reply_token = uuid.uuid4().hex
+        body = build_payload(line_user_id, random.choice(QUESTIONS), reply_token)
+        headers = {'Content-Type': 'application/json', 'X-Line-Signature': sign_body(body, channel_secret)}
+        started = time.time()
+        try:
+            response = session.post(f'{target}/webhook', data=body.encode('utf-8'), headers=headers, timeout=120)
+            elapsed = time.time() - started
+            with result.lock:
+                result.latencies.append(elapsed)
+                result.statuses[response.status_code] += 1
+                result.sent[reply_token] = started
+        except Exception as e:
+            with result.lock:
+                result.exceptions[type(e).__name__] += 1
+        if think_ms:
+            time.sleep(think_ms / 1000)
+    session.close()
+
+
+def start_app(line_url: str, openai_url: str, db_path: str):
+    """main:app をスタブ向けの設定でプロセス内に起動"""
+    os.environ.update({
+        'DATABASE_PATH': db_path,
+        'LINE_CHANNEL_SECRET': CHANNEL_SECRET,
+        'LINE_CHANNEL_ACCESS_TOKEN': CHANNEL_ACCESS_TOKEN,
+        'OPENAI_API_KEY': 'sk-loadtest',
+        'LINE_API_ENDPOINT': line_url,
+        'OPENAI_BASE_URL': f'{openai_url}/v1',
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+    from werkzeug.serving import make_server
+
+    server = make_server('127.0.0.1', 0, main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='load-test-app', daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}', main
+
+
+def print_report(args, result: LoadResult, wall: float, line_behavior, openai_behavior, app_module):
+    total = sum(result.statuses.values()) + sum(result.exceptions.values())
+    ok = result.statuses.get(200, 0)
+
+    # リプライトークンでスタブ側の受信時刻と突き合わせ（非同期ACKモードでは応答後に処理される）
+    end_to_end = []
+    if line_behavior:
+        with line_behavior.lock:
+            received = dict(line_behavior.received)
+        end_to_end = [received[token] - sent for token, sent in result.sent.items() if token in received]
+
+    print(f"users: {args.users}, tenants: {args.tenants}, messages/user: {args.messages}")
+    print(f"requests: {total} in {wall:.2f}s -> {total / wall:.1f} req/s")
+    print(f"webhook latency ms: p50={percentile(result.latencies, 0.50):.1f} "
+          f"p95={percentile(result.latencies, 0.95):.1f} p99={percentile(result.latencies, 0.99):.1f} "
+          f"max={max(result.latencies, default=0) * 1000:.1f}")
+    if line_behavior:
+        print(f"reply latency ms  : p50={percentile(end_to_end, 0.50):.1f} "
+              f"p95={percentile(end_to_end, 0.95):.1f} p99={percentile(end_to_end, 0.99):.1f} "
+              f"(replies {len(end_to_end)}/{ok})")
+    print(f"statuses: {dict(result.statuses)}, exceptions: {dict(result.exceptions)}")
+    if line_behavior:
+        print(f"LINE stub: {dict(line_behavior.counts)}")
+    if openai_behavior:
+        print(f"OpenAI stub: {dict(openai_behavior.counts)}")
+    if app_module is not None:
+        print(f"pipeline: {json.dumps(app_module.message_pipeline.stats()['total'])}")
+
+
+def command_run(args):
+    line_behavior = openai_behavior = None
+    app_module = None
+
+    if args.target:
+        target = args.target.rstrip('/')
+        if not args.db:
+            sys.exit('--target を指定する場合は --db（サーバーの DATABASE_PATH）も指定してください')
+        # 外部のスタブを使う場合は返信の突き合わせができないため、HTTP応答のみ計測
+        db_path = args.db
+    else:
+        line_behavior = StubBehavior(args.line_latency_ms, args.line_jitter_ms, args.line_error_rate)
+        openai_behavior = StubBehavior(args.openai_latency_ms, args.openai_jitter_ms, args.openai_error_rate,
+                                       error_status=args.openai_error_status)
+        _, line_url = start_stub(LineStubHandler, line_behavior)
+        _, openai_url = start_stub(OpenAIStubHandler, openai_behavior)
+        tmp_dir = tempfile.mkdtemp(prefix='load_test_')
+        # main の atexit（使用量の書き込みなど）が終わってから削除されるよう、import より先に登録
+        atexit.register(shutil.rmtree, tmp_dir, ignore_errors=True)
+        db_path = os.path.join(tmp_dir, 'load_test.db')
+        _, target, app_module = start_app(line_url, openai_url, db_path)
+
+    line_user_ids = seed_tenants(db_path, args.tenants, args.users)
+    result = LoadResult()
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=args.users) as executor:
+        for line_user_id in line_user_ids:
+            executor.submit(run_user, target, line_user_id, args.messages, args.think_ms,
+                            args.channel_secret, result)
+    wall = time.time() - started
+
+    # 非同期ACKモードの残り処理を待つ
+    if line_behavior:
+        deadline = time.time() + args.drain_timeout
+        while time.time() < deadline:
+            with line_behavior.lock:
+                done = len(line_behavior.received) + line_behavior.counts['reply_errors']
+            if done >= result.statuses.get(200, 0):
+                break
+            time.sleep(0.1)
+
+    print_report(args, result, wall, line_behavior, openai_behavior, app_module)
+
+
+def command_stubs(args):
+    line_behavior = StubBehavior(args.line_latency_ms, args.line_jitter_ms, args.line_error_rate)
+    openai_behavior = StubBehavior(args.openai_latency_ms, args.openai_jitter_ms, args.openai_error_rate,
+                                   error_status=args.openai_error_status)
+    _, line_url = start_stub(LineStubHandler, line_behavior, args.line_port)
+    _, openai_url = start_stub(OpenAIStubHandler, openai_behavior, args.openai_port)
+    print(f"LINE stub   : {line_url}  (LINE_API_ENDPOINT={line_url})")
+    print(f"OpenAI stub : {openai_url}  (OPENAI_BASE_URL={openai_url}/v1)")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"LINE: {dict(line_behavior.counts)}  OpenAI: {dict(openai_behavior.counts)}")
+    except KeyboardInterrupt:
+        pass
+
+
+def add_stub_arguments(parser):
+    parser.add_argument('--line-latency-ms', type=float, default=30.0)
+    parser.add_argument('--line-jitter-ms', type=float, default=20.0)
+    parser.add_argument('--line-error-rate', type=float, default=0.0)
+    parser.add_argument('--openai-latency-ms', type=float, default=800.0)
+    parser.add_argument('--openai-jitter-ms', type=float, default=400.0)
+    parser.add_argument('--openai-error-rate', type=float, default=0.0)
+    parser.add_argument('--openai-error-status', type=int, default=429)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='LINE webhook load test')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run = subparsers.add_parser('run', help='負荷を生成して結果を表示')
+    run.add_argument('--users', type=int, default=20, help='同時に送信するLINEユーザー数 (N)')
+    run.add_argument('--tenants', type=int, default=5, help='テナント数 (M)')
+    run.add_argument('--messages', type=int, default=10, help='ユーザーあたりの送信数')
+    run.add_argument('--think-ms', type=float, default=0.0, help='ユーザーごとの送信間隔')
+    run.add_argument('--target', help='起動済みサーバーのURL（省略時はプロセス内で main:app を起動）')
+    run.add_argument('--db', help='--target のサーバーが使う DATABASE_PATH（テストデータ投入用）')
+    run.add_argument('--channel-secret', default=CHANNEL_SECRET)
+    run.add_argument('--drain-timeout', type=float, default=60.0, help='非同期処理の完了を待つ最大秒数')
+    add_stub_arguments(run)
+    run.set_defaults(func=command_run)
+
+    stubs = subparsers.add_parser('stubs', help='LINE / OpenAI スタブサーバーのみ起動')
+    stubs.add_argument('--line-port', type=int, default=9101)
+    stubs.add_argument('--openai-port', type=int, default=9102)
+    add_stub_arguments(stubs)
+    stubs.set_defaults(func=command_stubs)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
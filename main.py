@@ -5,7 +5,7 @@ Version: 6.0.0
 Last Updated: 2025-08-05
 """
 
-from flask import Flask, request, jsonify, render_template, render_template_string, redirect, url_for, session, send_file, flash, abort
+from flask import Flask, request, jsonify, render_template, render_template_string, redirect, url_for, session, send_file, flash, abort, Response, stream_with_context
 from functools import wraps
 import os
 import sqlite3
@@ -34,6 +34,7 @@ except ImportError:
 
 
 import hashlib
+import atexit
 from datetime import datetime, timedelta
 # Initialize logging early
 import logging
@@ -62,6 +63,21 @@ import secrets
 import bcrypt
 import tempfile
 
+# Shared keep-alive HTTP clients (requests session, OpenAI clients, LINE SDK transport)
+from http_clients import get_openai_client, get_registry as get_http_registry, SharedSessionLineHttpClient
+# Staged LINE message processing with per-stage latency histograms
+from message_pipeline import MessagePipeline, MessageContext
+# Byte-bounded LRU of assembled system prompts
+from prompt_cache import PromptCache
+# Token-budgeted packing of manual passages into the system prompt
+from prompt_assembler import PromptAssembler
+# Concurrency-limited OpenAI calls with async jittered backoff (sync facade for Flask routes)
+from llm_gateway import get_gateway as get_llm_gateway, is_local_timeout, is_transient_error
+# Per-plan model and max_tokens selection from a cheap query classification
+from model_router import ModelRouter, cached_prompt_tokens
+# Error-rate/latency circuit breaker around OpenAI calls
+from circuit_breaker import CircuitBreaker, CircuitOpenError, OPEN as CIRCUIT_OPEN
+
 # Optional custom modules with error handling
 try:
     from pdf_converter import PDFConverter
@@ -69,9 +85,14 @@ except ImportError:
     PDFConverter = None
 
 try:
-    from rag_system import RAGSystem
+    from rag_system import RAGSystem, embedding_cache_stats, open_store_count
 except ImportError:
     RAGSystem = None
+    embedding_cache_stats = None
+    open_store_count = None
+
+from rag_registry import RAGRegistry
+from write_behind import install_sigterm_handler, stats_all as write_behind_stats
 
 try:
     from email_notifier import EmailNotifier
@@ -83,6 +104,49 @@ try:
 except ImportError:
     MultiTenantManager = None
 
+try:
+    from usage_meter import UsageMeter
+except ImportError:
+    UsageMeter = None
+
+try:
+    from webhook_dedup import WebhookEventDeduper
+except ImportError:
+    WebhookEventDeduper = None
+
+try:
+    from passage_index import PassageIndex
+except ImportError:
+    PassageIndex = None
+
+try:
+    from document_versions import DocumentVersions
+except ImportError:
+    DocumentVersions = None
+
+try:
+    from answer_cache import AnswerCache
+except ImportError:
+    AnswerCache = None
+
+try:
+    from semantic_cache import SemanticAnswerCache, OpenAIQueryEmbedder, LocalHashEmbedder
+except ImportError:
+    SemanticAnswerCache = None
+
+try:
+    from line_account_cache import LineAccountResolver
+except ImportError:
+    LineAccountResolver = None
+
+try:
+    from keyed_executor import KeyedSerialExecutor
+    from webhook_dispatcher import WebhookDispatcher, event_key
+except ImportError:
+    KeyedSerialExecutor = None
+    WebhookDispatcher = None
+    event_key = None
+
 # Optional scheduler
 try:
     from apscheduler.schedulers.background import BackgroundScheduler
@@ -147,13 +211,11 @@ from typing import Dict, List, Optional, Tuple, Any
 
 # Import custom modules
 try:
-    from simple_search import SimpleSearch
     from safe_customer_response import SafeCustomerBot
     from admin_notification import AdminNotificationSystem
     from language_handler import LanguageHandler
 except ImportError as e:
     logging.warning(f"Custom module import failed: {e}")
-    SimpleSearch = None
     SafeCustomerBot = None
     AdminNotificationSystem = None
     LanguageHandler = None
@@ -222,6 +284,83 @@ STRIPE_WEBHOOK_SECRET = os.environ.get('STRIPE_WEBHOOK_SECRET')
 ADMIN_USER_ID = os.environ.get('ADMIN_LINE_USER_ID', '')
 ADMIN_GROUP_ID = os.environ.get('ADMIN_LINE_GROUP_ID', '')
 DATABASE_PATH = os.environ.get('DATABASE_PATH', 'manual_bot.db')
+# API endpoints (overridable to point at local stand-ins, e.g. load_test.py stubs)
+LINE_API_ENDPOINT = os.environ.get('LINE_API_ENDPOINT', 'https://api.line.me')
+OPENAI_BASE_URL = os.environ.get('OPENAI_BASE_URL', 'https://api.openai.com/v1')
+
+# Webhook event processing (WEBHOOK_WORKERS events run in parallel, ordered per LINE user)
+# Async ack mode acknowledges immediately and processes events on a worker pool
+WEBHOOK_ASYNC_ACK = os.environ.get('WEBHOOK_ASYNC_ACK', 'false').lower() in ('1', 'true', 'yes')
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', 4))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 100))
+WEBHOOK_REPLY_TOKEN_TTL = float(os.environ.get('WEBHOOK_REPLY_TOKEN_TTL', 50))
+
+# Redelivered webhook events are skipped for WEBHOOK_DEDUP_TTL seconds
+WEBHOOK_DEDUP_TTL = float(os.environ.get('WEBHOOK_DEDUP_TTL', 86400))
+
+# LINE account -> user resolution cache
+LINE_ACCOUNT_CACHE_SIZE = int(os.environ.get('LINE_ACCOUNT_CACHE_SIZE', 10000))
+LINE_ACCOUNT_CACHE_TTL = float(os.environ.get('LINE_ACCOUNT_CACHE_TTL', 300))
+LINE_ACCOUNT_NEGATIVE_TTL = float(os.environ.get('LINE_ACCOUNT_NEGATIVE_TTL', 30))
+
+# Write-behind usage metering (counters flushed to usage_tracking in batches)
+USAGE_METER_ENABLED = os.environ.get('USAGE_METER_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+USAGE_FLUSH_INTERVAL = float(os.environ.get('USAGE_FLUSH_INTERVAL', 5))
+USAGE_SYNC_INTERVAL = float(os.environ.get('USAGE_SYNC_INTERVAL', 10))
+USAGE_LIMIT_TOLERANCE = int(os.environ.get('USAGE_LIMIT_TOLERANCE', 20))
+
+# Manual context: top MANUAL_TOP_K passages for the question, packed in score order into at most
+# MANUAL_CONTEXT_TOKENS tokens (and never past the chat model's context window minus CHAT_MAX_TOKENS)
+MANUAL_CONTEXT_TOKENS = int(os.environ.get('MANUAL_CONTEXT_TOKENS', 3000))
+# 'estimate' counts tokens by character class instead of tiktoken (whose encoding is fetched
+# over the network on first use)
+PROMPT_TOKENIZER = os.environ.get('PROMPT_TOKENIZER', 'tiktoken').lower()
+MANUAL_TOP_K = int(os.environ.get('MANUAL_TOP_K', 6))
+PASSAGE_CHUNK_SIZE = int(os.environ.get('PASSAGE_CHUNK_SIZE', 600))
+
+# Chat model used for answers and the number of tokens reserved for its reply
+# (the default when model routing is disabled or the plan has no routes)
+CHAT_MODEL = os.environ.get('OPENAI_CHAT_MODEL', 'gpt-3.5-turbo')
+CHAT_MAX_TOKENS = int(os.environ.get('CHAT_MAX_TOKENS', 1000))
+# Route each question to the model/max_tokens configured for its class in PLANS[plan]['routes']
+MODEL_ROUTING_ENABLED = os.environ.get('MODEL_ROUTING_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+
+# OpenAI circuit breaker: opens when at least LLM_BREAKER_FAILURE_RATE of the calls in the last
+# LLM_BREAKER_WINDOW seconds failed or took longer than LLM_BREAKER_SLOW_MS; while open, messages are
+# answered from keyword search, and one probe call is let through every LLM_BREAKER_OPEN_SECONDS
+LLM_BREAKER_WINDOW = float(os.environ.get('LLM_BREAKER_WINDOW', 60))
+LLM_BREAKER_MIN_CALLS = int(os.environ.get('LLM_BREAKER_MIN_CALLS', 10))
+LLM_BREAKER_FAILURE_RATE = float(os.environ.get('LLM_BREAKER_FAILURE_RATE', 0.5))
+LLM_BREAKER_SLOW_MS = float(os.environ.get('LLM_BREAKER_SLOW_MS', 15000))
+LLM_BREAKER_OPEN_SECONDS = float(os.environ.get('LLM_BREAKER_OPEN_SECONDS', 30))
+
+# Assembled system prompts are cached per tenant document version (PROMPT_CACHE_MB in total);
+# document version changes made by other workers are picked up within DOCUMENT_VERSION_TTL seconds
+PROMPT_CACHE_MB = float(os.environ.get('PROMPT_CACHE_MB', 32))
+DOCUMENT_VERSION_TTL = float(os.environ.get('DOCUMENT_VERSION_TTL', 5))
+
+# Answers to repeated questions are served from the answer cache for ANSWER_CACHE_TTL seconds
+ANSWER_CACHE_ENABLED = os.environ.get('ANSWER_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+ANSWER_CACHE_TTL = float(os.environ.get('ANSWER_CACHE_TTL', 86400))
+ANSWER_CACHE_SIZE = int(os.environ.get('ANSWER_CACHE_SIZE', 5000))
+
+# Paraphrased questions are answered from the semantic cache when the cosine similarity of their
+# embedding ('openai' = text-embedding-3-small, 'local' = hashed character n-grams) reaches the threshold
+SEMANTIC_CACHE_ENABLED = os.environ.get('SEMANTIC_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+SEMANTIC_CACHE_EMBEDDER = os.environ.get('SEMANTIC_CACHE_EMBEDDER', 'openai')
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get('SEMANTIC_CACHE_THRESHOLD', 0.92))
+SEMANTIC_CACHE_SIZE = int(os.environ.get('SEMANTIC_CACHE_SIZE', 500))
+SEMANTIC_CACHE_EMBED_TIMEOUT = float(os.environ.get('SEMANTIC_CACHE_EMBED_TIMEOUT', 3))
+
+# Warm RAGSystem instances (embeddings client + open Chroma store) kept per process for the
+# RAG_MAX_INSTANCES most recently used tenants (an evicted tenant's Chroma client is stopped once
+# no request is using it); the RAG_WARMUP_TENANTS most recently active
+# tenants are loaded in the background when the worker starts
+RAG_MAX_INSTANCES = int(os.environ.get('RAG_MAX_INSTANCES', 32))
+RAG_WARMUP_TENANTS = int(os.environ.get('RAG_WARMUP_TENANTS', 8))
+
+# Messages slower than SLOW_MESSAGE_MS are logged with their per-stage breakdown
+SLOW_MESSAGE_MS = float(os.environ.get('SLOW_MESSAGE_MS', 5000))
 
 # Stripe configuration
 stripe.api_key = STRIPE_SECRET_KEY
@@ -230,18 +369,15 @@ stripe.api_key = STRIPE_SECRET_KEY
 if not OPENAI_API_KEY:
     logger.warning("OPENAI_API_KEY not set in environment variables")
 
-# Initialize OpenAI client with error handling
+# Initialize OpenAI client with error handling (shared keep-alive client from http_clients)
 import openai
 openai_client = None
 try:
     if OPENAI_API_KEY:
-        # Explicitly set base_url to default OpenAI API endpoint
-        openai_client = openai.OpenAI(
-            api_key=OPENAI_API_KEY,
-            base_url="https://api.openai.com/v1"
-        )
+        # Explicitly set base_url (defaults to the OpenAI API endpoint)
+        openai_client = get_openai_client(OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
         logger.info("✅ OpenAI client initialized successfully")
-        logger.info(f"   Base URL: https://api.openai.com/v1")
+        logger.info(f"   Base URL: {OPENAI_BASE_URL}")
     else:
         logger.warning("⚠️ OpenAI API key not set - AI features disabled")
 except Exception as e:
@@ -260,7 +396,11 @@ line_bot_api = None
 handler = None
 try:
     if LINE_CHANNEL_ACCESS_TOKEN and LINE_CHANNEL_SECRET:
-        line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
+        if SharedSessionLineHttpClient:
+            line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN, endpoint=LINE_API_ENDPOINT,
+                                      http_client=SharedSessionLineHttpClient)
+        else:
+            line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN, endpoint=LINE_API_ENDPOINT)
         handler = WebhookHandler(LINE_CHANNEL_SECRET)
         logger.info("✅ LINE Bot initialized successfully")
     else:
@@ -279,7 +419,6 @@ limiter = Limiter(
 )
 
 # Initialize custom modules if available
-search_engine = SimpleSearch() if SimpleSearch else None
 safe_response = SafeCustomerBot() if SafeCustomerBot else None
 admin_notifier = AdminNotificationSystem(line_bot_api) if AdminNotificationSystem else None
 language_handler = LanguageHandler() if LanguageHandler else None
@@ -297,7 +436,14 @@ PLANS = {
         'api_calls': 1000,
         'messages': 5000,
         'file_size': 10 * 1024 * 1024,
-        'features': ['基本的なQ&A', 'ファイルアップロード', 'LINE連携']
+        'features': ['基本的なQ&A', 'ファイルアップロード', 'LINE連携'],
+        # Model per question class (lookup / standard / complex / off_topic), see model_router.py
+        'routes': {
+            'lookup': {'model': 'gpt-4o-mini', 'max_tokens': 300},
+            'standard': {'model': 'gpt-4o-mini', 'max_tokens': 700},
+            'complex': {'model': 'gpt-4o-mini', 'max_tokens': 1000},
+            'off_topic': {'model': 'gpt-4o-mini', 'max_tokens': 150},
+        }
     },
     'pro': {
         'name': 'プロフェッショナル',
@@ -306,7 +452,13 @@ PLANS = {
         'api_calls': 5000,
         'messages': 20000,
         'file_size': 25 * 1024 * 1024,
-        'features': ['高度な分析', 'APIアクセス', '優先サポート', 'カスタマイズ']
+        'features': ['高度な分析', 'APIアクセス', '優先サポート', 'カスタマイズ'],
+        'routes': {
+            'lookup': {'model': 'gpt-4o-mini', 'max_tokens': 300},
+            'standard': {'model': 'gpt-4o-mini', 'max_tokens': 800},
+            'complex': {'model': 'gpt-4o', 'max_tokens': 1000},
+            'off_topic': {'model': 'gpt-4o-mini', 'max_tokens': 150},
+        }
     },
     'enterprise': {
         'name': 'エンタープライズ',
@@ -315,7 +467,13 @@ PLANS = {
         'api_calls': -1,
         'messages': -1,
         'file_size': 50 * 1024 * 1024,
-        'features': ['無制限利用', 'チーム管理', '専用サポート', 'SLA保証', 'カスタム開発']
+        'features': ['無制限利用', 'チーム管理', '専用サポート', 'SLA保証', 'カスタム開発'],
+        'routes': {
+            'lookup': {'model': 'gpt-4o-mini', 'max_tokens': 400},
+            'standard': {'model': 'gpt-4o', 'max_tokens': 1000},
+            'complex': {'model': 'gpt-4o', 'max_tokens': 1500},
+            'off_topic': {'model': 'gpt-4o-mini', 'max_tokens': 150},
+        }
     }
 }
 
@@ -523,6 +681,32 @@ def get_db_connection():
     conn.row_factory = sqlite3.Row
     return conn
 
+def lookup_line_account(line_user_id):
+    """Look up the user linked to a LINE account (None if not linked)."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT user_id FROM line_accounts
+        WHERE line_user_id = ? AND is_active = 1
+    ''', (line_user_id,))
+    line_account = cursor.fetchone()
+    conn.close()
+    return line_account['user_id'] if line_account else None
+
+def resolve_line_account(line_user_id):
+    """Resolve the user linked to a LINE account through the in-process cache."""
+    if line_account_resolver:
+        return line_account_resolver.resolve(line_user_id)
+    return lookup_line_account(line_user_id)
+
+# LINE account resolution cache
+line_account_resolver = LineAccountResolver(
+    lookup_line_account,
+    max_size=LINE_ACCOUNT_CACHE_SIZE,
+    ttl=LINE_ACCOUNT_CACHE_TTL,
+    negative_ttl=LINE_ACCOUNT_NEGATIVE_TTL
+) if LineAccountResolver else None
+
 def generate_link_code():
     """Generate 4-digit link code."""
     return ''.join(random.choices(string.digits, k=4))
@@ -567,6 +751,9 @@ def extract_text_from_file(file_path, file_type):
 
 def check_usage_limit(user_id, limit_type='files'):
     """Check if user has exceeded their plan limits."""
+    if usage_meter:
+        return usage_meter.check(user_id, limit_type)
+    
     conn = get_db_connection()
     cursor = conn.cursor()
     
@@ -610,6 +797,10 @@ def check_usage_limit(user_id, limit_type='files'):
 
 def update_usage(user_id, usage_type='files', amount=1):
     """Update user usage statistics."""
+    if usage_meter:
+        usage_meter.record(user_id, usage_type, amount)
+        return
+    
     conn = get_db_connection()
     cursor = conn.cursor()
     current_month = datetime.now().strftime('%Y-%m')
@@ -642,6 +833,18 @@ def update_usage(user_id, usage_type='files', amount=1):
     conn.commit()
     conn.close()
 
+# Usage meter (in-memory counters, flushed every USAGE_FLUSH_INTERVAL seconds and at exit)
+usage_meter = None
+if UsageMeter and USAGE_METER_ENABLED:
+    usage_meter = UsageMeter(
+        DATABASE_PATH,
+        PLANS,
+        flush_interval=USAGE_FLUSH_INTERVAL,
+        sync_interval=USAGE_SYNC_INTERVAL,
+        tolerance=USAGE_LIMIT_TOLERANCE
+    )
+    atexit.register(usage_meter.shutdown)
+
 def log_audit(user_id, action, details=None, ip_address=None):
     """Log user actions for audit trail."""
     conn = get_db_connection()
@@ -673,7 +876,8 @@ def health():
         services_status = {
             'database': 'healthy',
             'line_api': 'healthy' if LINE_CHANNEL_ACCESS_TOKEN else 'unhealthy',
-            'openai_api': 'healthy' if (OPENAI_API_KEY and 'openai_client' in globals()) else 'unhealthy',
+            'openai_api': ('unhealthy' if not (OPENAI_API_KEY and 'openai_client' in globals())
+                           else 'degraded' if llm_breaker.state == CIRCUIT_OPEN else 'healthy'),
             'stripe_api': 'healthy' if STRIPE_SECRET_KEY else 'unhealthy'
         }
         
@@ -683,6 +887,8 @@ def health():
             'status': overall_status,
             'timestamp': datetime.utcnow().isoformat(),
             'services': services_status,
+            'webhook_queue': webhook_dispatcher.stats() if webhook_dispatcher else None,
+            'circuit_breakers': {'openai': llm_breaker.stats()},
             'version': '6.0.0'
         }), 200 if overall_status == 'healthy' else 503
     
@@ -903,6 +1109,16 @@ def webhook():
         logger.info("Empty webhook body received (verification request)")
         return 'OK', 200
 
+    # Redelivery of events this worker has already processed: acknowledge without any work
+    if webhook_deduper:
+        try:
+            event_ids = [event.get('webhookEventId') for event in json.loads(body).get('events', [])]
+        except Exception:
+            event_ids = []
+        if webhook_deduper.all_seen(event_ids):
+            logger.info(f"Duplicate webhook delivery skipped: {len(event_ids)} events")
+            return 'OK', 200
+
     # Debug logging
     logger.info(f"Webhook received - Body length: {len(body)}, Signature: {signature[:20] if signature else 'None'}...")
     logger.info(f"LINE_CHANNEL_SECRET available: {bool(LINE_CHANNEL_SECRET)}, Handler available: {bool(handler)}")
@@ -923,21 +1139,54 @@ def webhook():
             # For actual messages without signature, return 400 for security
             abort(400)
         
-        # Process webhook with handler
+        # Async ack mode: verify signature, queue events and return immediately
+        if webhook_dispatcher:
+            try:
+                events = handler.parser.parse(body, signature)
+            except InvalidSignatureError:
+                logger.warning("Invalid signature in webhook request")
+                return 'Invalid signature', 400
+            
+            events = filter_new_line_events(events)
+            shed = 0
+            for event in events:
+                if not webhook_dispatcher.submit(event):
+                    # Queue full or shutting down: handling it inline would block the ack on OpenAI
+                    # and let it overtake this user's queued messages, so shed it instead
+                    shed += 1
+                    reply_busy(event)
+            
+            if shed:
+                logger.warning(f"Webhook queue full: shed {shed} of {len(events)} events")
+            logger.info(f"Webhook acknowledged: {len(events) - shed} events queued")
+            return 'OK', 200
+        
+        # Process webhook events (in parallel across LINE users, in order per user)
         try:
-            handler.handle(body, signature)
-            logger.info("Webhook processed successfully by handler")
+            events = filter_new_line_events(handler.parser.parse(body, signature))
+            run_events_concurrently([
+                (event_key(event),
+                 release_claim_on_failure(getattr(event, 'webhook_event_id', None), dispatch_line_event),
+                 (event,))
+                for event in events
+            ])
+            logger.info(f"Webhook processed successfully: {len(events)} events")
         except Exception as handler_error:
             logger.error(f"Handler processing error: {str(handler_error)}")
             import traceback
             traceback.print_exc()
             # Try manual processing as fallback
             try:
-                import json
                 json_body = json.loads(body)
                 events = json_body.get('events', [])
+                events = filter_new_events(
+                    events,
+                    [event.get('webhookEventId') for event in events],
+                    sum(1 for event in events if event.get('deliveryContext', {}).get('isRedelivery'))
+                )
                 logger.info(f"Attempting manual processing for {len(events)} events")
                 
+                jobs = []
                 for event in events:
                     if event.get('type') == 'message' and event.get('message', {}).get('type') == 'text':
                         line_user_id = event.get('source', {}).get('userId')
@@ -946,9 +1195,15 @@ def webhook():
 
                         if message_text and reply_token:
                             logger.info(f"Manual processing message from {line_user_id}: {message_text}")
-                            handle_text_message_manual(line_user_id, message_text, reply_token)
+                            jobs.append((line_user_id,
+                                         release_claim_on_failure(event.get('webhookEventId'),
+                                                                  handle_text_message_manual),
+                                         (line_user_id, message_text, reply_token)))
+                run_events_concurrently(jobs)
             except Exception as manual_error:
                 logger.error(f"Manual processing also failed: {str(manual_error)}")
+                # Failed events were released from the deduper; a 500 makes LINE redeliver them
+                raise
 
     except Exception as e:
         logger.error(f"Webhook processing error: {str(e)}")
@@ -962,223 +1217,250 @@ def webhook():
     return 'OK', 200
 
 # Event handlers - only register if handler is available
-def handle_message(event):
-    """Handle LINE text messages."""
-    try:
-        line_user_id = event.source.user_id
-        message_text = event.message.text
-        reply_token = event.reply_token
-        
-        # Check if it's a group message
-        is_group = event.source.type == 'group'
-        group_id = event.source.group_id if is_group else None
-        
-        # Admin commands
-        if line_user_id == ADMIN_USER_ID:
-            if message_text.startswith('#回答'):
-                handle_admin_answer(event)
-                return
-            elif message_text == '#一覧':
-                handle_admin_list(event)
-                return
-        
-        # Link code handling
-        if re.match(r'^\d{4}$', message_text):
-            handle_link_code(event)
-            return
-        
-        # Find linked user
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT user_id FROM line_accounts
-            WHERE line_user_id = ? AND is_active = 1
-        ''', (line_user_id,))
-        
-        line_account = cursor.fetchone()
-        
-        if not line_account:
-            # Not linked
-            line_bot_api.reply_message(
-                reply_token,
-                TextSendMessage(text="このアカウントはまだ連携されていません。\nWebサイトから連携コードを生成してください。")
-            )
-            conn.close()
-            return
-        
-        user_id = line_account['user_id']
-        logger.info(f"DEBUG handle_message: user_id = {user_id}, line_user_id = {line_user_id}")
-        
-        # Check usage limits
-        if not check_usage_limit(user_id, 'messages'):
-            line_bot_api.reply_message(
-                reply_token,
-                TextSendMessage(text="メッセージ送信数の上限に達しました。プランをアップグレードしてください。")
-            )
-            conn.close()
-            return
-        
-        # Detect language
-        detected_language = 'ja'
-        if language_handler:
-            detected_language = language_handler.detect_language(message_text)
-        
-        # Search for relevant content
-        cursor.execute('''
-            SELECT content FROM files
-            WHERE user_id = ?
-            ORDER BY uploaded_at DESC
-            LIMIT 5
-        ''', (user_id,))
-        
-        files = cursor.fetchall()
-        context = "\n".join([f['content'][:500] for f in files if f['content']])
-        
-        # Search using search engine
-        if search_engine:
-            search_results = search_engine.search(message_text, user_id)
-            if search_results:
-                context = "\n".join([result['content'][:500] for result in search_results[:3]])
-        
-        # Generate AI response with user_id
-        logger.info(f"DEBUG: Calling generate_ai_response with user_id={user_id}, query='{message_text[:50]}...'")
-        ai_response = generate_ai_response(message_text, context, detected_language, user_id=user_id)
-        logger.info(f"AI response generated for user {user_id}: {ai_response[:100]}...")
-        
-        # Apply safety filters
-        if safe_response:
-            ai_response = safe_response.filter_response(ai_response)
-        
-        # Save conversation
-        cursor.execute('''
-            INSERT INTO conversations (user_id, line_user_id, message, response, is_answered, language)
-            VALUES (?, ?, ?, ?, 1, ?)
-        ''', (user_id, line_user_id, message_text, ai_response, detected_language))
-        
-        conversation_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        
-        # Update usage
-        update_usage(user_id, 'messages', 1)
-        update_usage(user_id, 'api_calls', 1)
-        
-        # Send response
-        line_bot_api.reply_message(
-            reply_token,
-            TextSendMessage(text=ai_response)
-        )
-        
-        # Check for urgent keywords
-        urgent_keywords = ['緊急', '至急', '大至急', 'urgent', 'emergency', '紧急']
-        if any(keyword in message_text.lower() for keyword in urgent_keywords):
-            if admin_notifier:
-                admin_notifier.notify_urgent_message(line_user_id, message_text, conversation_id)
+def dispatch_line_event(event):
+    """Dispatch a single parsed LINE event to its handler."""
+    if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+        handle_message(event)
+
+def filter_new_events(events, event_ids, redelivered=0):
+    """Drop events whose webhookEventId has already been processed (LINE redeliveries)."""
+    if not webhook_deduper:
+        return events
+    
+    claimed = webhook_deduper.claim_many(event_ids, redelivered)
+    new_events = [event for event, event_id in zip(events, event_ids) if not event_id or event_id in claimed]
+    if len(new_events) < len(events):
+        logger.info(f"Skipped {len(events) - len(new_events)} duplicate webhook events")
+    return new_events
+
+def release_claim_on_failure(event_id, func):
+    """Wrap func so that if it raises, the event's dedup claim is dropped and LINE's redelivery is processed."""
+    def run(*args):
+        try:
+            return func(*args)
+        except Exception:
+            if webhook_deduper and event_id:
+                try:
+                    webhook_deduper.release([event_id])
+                except Exception as e:
+                    logger.warning(f"Failed to release webhook event {event_id}: {e}")
+            raise
+    return run
+
+def filter_new_line_events(events):
+    """filter_new_events for parsed LINE SDK events."""
+    return filter_new_events(
+        events,
+        [getattr(event, 'webhook_event_id', None) for event in events],
+        sum(1 for event in events if getattr(getattr(event, 'delivery_context', None), 'is_redelivery', False))
+    )
+
+def run_events_concurrently(jobs):
+    """Run (key, func, args) jobs in parallel across keys and in order within a key.
+    
+    Waits for every job, then re-raises the first failure so the caller's fallback still runs.
+    """
+    if not event_executor:
+        for key, func, args in jobs:
+            func(*args)
+        return
     
-    except Exception as e:
-        logger.error(f"Message handling error: {e}")
+    futures = [event_executor.submit(key, func, *args) for key, func, args in jobs]
+    first_error = None
+    for future in futures:
         try:
-            line_bot_api.reply_message(
-                reply_token,
-                TextSendMessage(text="申し訳ございません。エラーが発生しました。しばらく経ってから再度お試しください。")
-            )
-        except:
-            pass
+            future.result()
+        except Exception as e:
+            logger.error(f"Webhook event processing error: {e}")
+            first_error = first_error or e
+    if first_error:
+        raise first_error
+
+NOT_LINKED_MESSAGE = "このアカウントはまだ連携されていません。\nWebサイトから連携コードを生成してください。"
+LIMIT_REACHED_MESSAGE = "メッセージ送信数の上限に達しました。プランをアップグレードしてください。"
+ERROR_MESSAGE = "申し訳ございません。エラーが発生しました。しばらく経ってから再度お試しください。"
+BUSY_MESSAGE = "ただいま混み合っているため、メッセージを処理できませんでした。しばらく経ってから再度お送りください。"
+URGENT_KEYWORDS = ['緊急', '至急', '大至急', 'urgent', 'emergency', '紧急']
+
+def reply_text(reply_token, text):
+    """Reply with a single text message."""
+    line_bot_api.reply_message(reply_token, TextSendMessage(text=text))
+
+def reply_busy(event):
+    """Tell the sender their message was not handled because the webhook queue is full."""
+    reply_token = getattr(event, 'reply_token', None)
+    if not reply_token or not isinstance(event, MessageEvent):
+        return
+    try:
+        reply_text(reply_token, BUSY_MESSAGE)
+    except Exception as e:
+        logger.warning(f"Failed to send busy reply: {e}")
+
+def stage_commands(ctx):
+    """Admin commands and link codes bypass the AI pipeline."""
+    if ctx.line_user_id == ADMIN_USER_ID and (ctx.message_text.startswith('#回答') or ctx.message_text == '#一覧'):
+        if ctx.event is None:
+            reply_text(ctx.reply_token, "管理者コマンドはWebhook経由ではサポートされていません。")
+        elif ctx.message_text.startswith('#回答'):
+            handle_admin_answer(ctx.event)
+        else:
+            handle_admin_list(ctx.event)
+        ctx.finish()
+    elif re.match(r'^\d{4}$', ctx.message_text):
+        if ctx.event is None:
+            handle_link_code_manual(ctx.line_user_id, ctx.message_text, ctx.reply_token)
+        else:
+            handle_link_code(ctx.event)
+        ctx.finish()
+
+def stage_resolve_account(ctx):
+    """Find the linked user for the LINE account."""
+    ctx.user_id = resolve_line_account(ctx.line_user_id)
+    if not ctx.user_id:
+        reply_text(ctx.reply_token, NOT_LINKED_MESSAGE)
+        ctx.finish()
+
+def stage_quota(ctx):
+    """Stop when the plan's monthly message limit is reached."""
+    if not check_usage_limit(ctx.user_id, 'messages'):
+        reply_text(ctx.reply_token, LIMIT_REACHED_MESSAGE)
+        ctx.finish()
+
+def stage_detect_language(ctx):
+    """Detect the question language."""
+    if language_handler:
+        ctx.language = language_handler.detect_language(ctx.message_text)
+
+def stage_answer_cache(ctx):
+    """Answer repeated questions from the answer cache."""
+    # Read once: the answer generated below is cached under the version its prompt was built from,
+    # even when a file upload bumps the version during generation
+    ctx.document_version = current_document_version(ctx.user_id)
+    if answer_cache:
+        ctx.response = answer_cache.get(ctx.user_id, ctx.language, ctx.message_text, ctx.document_version)
+        if ctx.response is not None:
+            ctx.cache_hit = 'exact'
+
+def stage_semantic_cache(ctx):
+    """Answer paraphrases of already answered questions from the semantic cache."""
+    if ctx.response is not None or not semantic_cache:
+        return
+    # The OpenAI question embedder would hang on the same outage the circuit is shielding us from
+    if isinstance(semantic_cache.embedder, OpenAIQueryEmbedder) and llm_breaker.is_open():
+        return
+    hit = semantic_cache.lookup(ctx.user_id, ctx.language, ctx.message_text, ctx.document_version)
+    if hit:
+        logger.info(f"Semantic cache hit for user {ctx.user_id} (similarity {hit['similarity']})")
+        ctx.response = hit['answer']
+        ctx.cache_hit = 'semantic'
+
+def stage_route(ctx):
+    """Pick the model and max_tokens for the question."""
+    if ctx.response is not None:
+        return
+    ctx.route = route_query(ctx.user_id, ctx.message_text)
 
-def handle_text_message_manual(line_user_id, message_text, reply_token):
-    """Handle LINE text messages manually (for webhook testing)."""
+def stage_retrieve(ctx):
+    """Build the system prompt from the manual passages relevant to the question."""
+    if ctx.response is not None:
+        return
+    ctx.context = build_system_prompt(ctx.user_id, ctx.message_text, ctx.language, route=ctx.route,
+                                      version=ctx.document_version)
+
+def stage_generate(ctx):
+    """Generate the AI response (keyword-search answer while the OpenAI circuit is open)."""
+    if ctx.response is not None:
+        return
     try:
-        # Check if it's a group message (simplified)
-        is_group = False  # Manual processing doesn't have group info
-
-        # Admin commands
-        if line_user_id == ADMIN_USER_ID:
-            if message_text.startswith('#回答'):
-                # Handle admin answer (simplified)
-                line_bot_api.reply_message(
-                    reply_token,
-                    TextSendMessage(text="管理者コマンドはWebhook経由ではサポートされていません。")
-                )
-                return
-            elif message_text == '#一覧':
-                # Handle admin list (simplified)
-                line_bot_api.reply_message(
-                    reply_token,
-                    TextSendMessage(text="管理者コマンドはWebhook経由ではサポートされていません。")
-                )
-                return
+        if llm_breaker.is_open():
+            raise CircuitOpenError(llm_breaker.name)
+        ctx.response = generate_ai_response(ctx.message_text, ctx.context, ctx.language, user_id=ctx.user_id,
+                                            route=ctx.route, document_version=ctx.document_version)
+    except CircuitOpenError:
+        logger.info(f"OpenAI circuit {llm_breaker.state}, answering user {ctx.user_id} from keyword search")
+        ctx.response = keyword_fallback_answer(ctx.user_id, ctx.message_text)
+        ctx.fallback = True
+        return
+    logger.info(f"AI response generated for user {ctx.user_id}: {ctx.response[:100]}...")
 
-        # Link code handling
-        if re.match(r'^\d{4}$', message_text):
-            handle_link_code_manual(line_user_id, message_text, reply_token)
-            return
+def stage_safety_filter(ctx):
+    """Apply safety filters to the response."""
+    if safe_response:
+        ctx.response = safe_response.filter_response(ctx.response)
 
-        # Find linked user
-        conn = get_db_connection()
+def stage_persist(ctx):
+    """Save the conversation and count usage."""
+    conn = get_db_connection()
+    try:
         cursor = conn.cursor()
         cursor.execute('''
-            SELECT user_id FROM line_accounts
-            WHERE line_user_id = ? AND is_active = 1
-        ''', (line_user_id,))
-
-        line_account = cursor.fetchone()
-
-        if not line_account:
-            # Not linked
-            line_bot_api.reply_message(
-                reply_token,
-                TextSendMessage(text="このアカウントはまだ連携されていません。\nWebサイトから連携コードを生成してください。")
-            )
-            conn.close()
-            return
-
-        user_id = line_account['user_id']
-
-        # Check usage limits
-        if not check_usage_limit(user_id, 'messages'):
-            line_bot_api.reply_message(
-                reply_token,
-                TextSendMessage(text="メッセージ送信数の上限に達しました。プランをアップグレードしてください。")
-            )
-            conn.close()
-            return
-
-        # Generate AI response
-        ai_response = generate_ai_response(message_text, user_id=user_id)
-        logger.info(f"AI response generated successfully for user {user_id}: {ai_response[:100]}...")
-
-        # Send response
-        try:
-            line_bot_api.reply_message(
-                reply_token,
-                TextSendMessage(text=ai_response)
-            )
-            logger.info(f"✅ Successfully sent AI response to LINE user: {line_user_id}")
-        except Exception as reply_error:
-            logger.warning(f"Failed to send reply to LINE (AI response was generated): {reply_error}")
-            # AI response was generated successfully, just couldn't send to LINE
-            # This is normal for test webhooks with invalid reply_token
-
-        # Update usage
-        update_usage(user_id, 'messages', 1)
-
-        # Log message
-        log_audit(user_id, 'message_sent', f'LINE User: {line_user_id}, Response: {ai_response[:50]}', None)
-
+            INSERT INTO conversations (user_id, line_user_id, message, response, is_answered, language)
+            VALUES (?, ?, ?, ?, 1, ?)
+        ''', (ctx.user_id, ctx.line_user_id, ctx.message_text, ctx.response, ctx.language))
+        ctx.conversation_id = cursor.lastrowid
+        conn.commit()
+    finally:
         conn.close()
+    
+    update_usage(ctx.user_id, 'messages', 1)
+    if not ctx.cache_hit and not ctx.fallback:
+        update_usage(ctx.user_id, 'api_calls', 1)
+    
+    if ctx.source == 'manual':
+        log_audit(ctx.user_id, 'message_sent', f'LINE User: {ctx.line_user_id}, Response: {ctx.response[:50]}', None)
 
+def stage_reply(ctx):
+    """Send the response to LINE."""
+    try:
+        reply_text(ctx.reply_token, ctx.response)
+    except Exception as reply_error:
+        # The answer is already saved; test webhooks carry invalid reply tokens
+        logger.warning(f"Failed to send reply to LINE (AI response was generated): {reply_error}")
+
+def stage_notify(ctx):
+    """Notify admins about urgent messages."""
+    if admin_notifier and any(keyword in ctx.message_text.lower() for keyword in URGENT_KEYWORDS):
+        admin_notifier.notify_urgent_message(ctx.line_user_id, ctx.message_text, ctx.conversation_id)
+
+MESSAGE_STAGES = [
+    ('commands', stage_commands),
+    ('resolve_account', stage_resolve_account),
+    ('quota', stage_quota),
+    ('detect_language', stage_detect_language),
+    ('answer_cache', stage_answer_cache),
+    ('semantic_cache', stage_semantic_cache),
+    ('route', stage_route),
+    ('retrieve', stage_retrieve),
+    ('generate', stage_generate),
+    ('safety_filter', stage_safety_filter),
+    ('persist', stage_persist),
+    ('reply', stage_reply),
+    ('notify', stage_notify),
+]
+
+message_pipeline = MessagePipeline(MESSAGE_STAGES, slow_threshold_ms=SLOW_MESSAGE_MS)
+
+def process_text_message(ctx):
+    """Run one text message through the message pipeline."""
+    try:
+        message_pipeline.run(ctx)
     except Exception as e:
-        logger.error(f"Manual message handling error: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.error(f"Message handling error ({ctx.source}): {e}", exc_info=True)
         try:
-            line_bot_api.reply_message(
-                reply_token,
-                TextSendMessage(text="申し訳ございません。エラーが発生しました。しばらく経ってから再度お試しください。")
-            )
-        except:
+            reply_text(ctx.reply_token, ERROR_MESSAGE)
+        except Exception:
             logger.warning("Failed to send error message to LINE (invalid reply_token)")
 
+def handle_message(event):
+    """Handle LINE text messages."""
+    process_text_message(MessageContext(
+        event.source.user_id, event.message.text, event.reply_token, event=event, source='webhook'
+    ))
+
+def handle_text_message_manual(line_user_id, message_text, reply_token):
+    """Handle LINE text messages manually (for webhook testing)."""
+    process_text_message(MessageContext(line_user_id, message_text, reply_token, source='manual'))
+
 def handle_link_code_manual(line_user_id, code, reply_token):
     """Handle LINE account linking with 4-digit code (manual processing)."""
     try:
@@ -1233,6 +1515,10 @@ def handle_link_code_manual(line_user_id, code, reply_token):
         conn.commit()
         conn.close()
 
+        # Drop any cached "not linked" result for this LINE user
+        if line_account_resolver:
+            line_account_resolver.invalidate(line_user_id)
+
         line_bot_api.reply_message(
             reply_token,
             TextSendMessage(text=f"連携が完了しました！\n\nこれからマニュアルに関する質問をお送りください。")
@@ -1312,6 +1598,10 @@ def handle_link_code(event):
         conn.commit()
         conn.close()
         
+        # Drop any cached "not linked" result for this LINE user
+        if line_account_resolver:
+            line_account_resolver.invalidate(line_user_id)
+        
         line_bot_api.reply_message(
             event.reply_token,
             TextSendMessage(text=f"連携が完了しました！\n\nこれからマニュアルに関する質問をお送りください。")
@@ -1439,66 +1729,14 @@ def handle_admin_list(event):
             TextSendMessage(text="一覧取得中にエラーが発生しました。")
         )
 
-def generate_ai_response(query, context="", language="ja", user_id=None):
-    """Generate AI response using OpenAI API - STRICTLY RAG SYSTEM."""
-    try:
-        logger.info(f"DEBUG generate_ai_response: user_id={user_id}, query='{query[:50]}...'")
-        
-        # Get user's uploaded documents first
-        manual_content = ""
-        has_manual = False
-        
-        if user_id:
-            try:
-                # Get user's uploaded files
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT content, filename FROM files
-                    WHERE user_id = ? AND content IS NOT NULL AND content != ''
-                    ORDER BY uploaded_at DESC
-                    LIMIT 5
-                ''', (user_id,))
-
-                user_files = cursor.fetchall()
-                conn.close()
-                
-                logger.info(f"DEBUG: Found {len(user_files)} files for user {user_id}")
-
-                if user_files:
-                    has_manual = True
-                    manual_content = "\n\n【アップロードされたマニュアル情報】\n"
-                    for content, filename in user_files:
-                        if content and len(content.strip()) > 0:
-                            # Limit content length to avoid token limits
-                            truncated_content = content[:3000] + "..." if len(content) > 3000 else content
-                            manual_content += f"\n=== {filename} ===\n{truncated_content}\n"
-                            logger.info(f"DEBUG: Added file '{filename}' with {len(content)} characters")
-                        else:
-                            logger.warning(f"DEBUG: File '{filename}' has empty content")
-                    
-                    logger.info(f"DEBUG: Total manual content length: {len(manual_content)} characters")
-
-            except Exception as e:
-                logger.warning(f"Failed to load user documents: {e}")
-        
-        # If no manual is uploaded, return error message
-        if not has_manual:
-            fallback_messages = {
-                'ja': "申し訳ございません。現在、参照できるマニュアルがアップロードされていません。先にマニュアルファイルをアップロードしてください。",
-                'en': "I apologize, but there are no manuals uploaded for reference. Please upload a manual file first.",
-                'zh': "很抱歉，目前没有上传可参考的手册。请先上传手册文件。"
-            }
-            return fallback_messages.get(language, fallback_messages['ja'])
-        
-        # STRICT RAG SYSTEM PROMPT - Only answer from manual
-        system_prompts = {
-            'ja': f"""あなたは親切なマニュアルアシスタントです。以下のマニュアル情報を使って、ユーザーの質問に回答してください。
-
-{manual_content}
+# STRICT RAG SYSTEM PROMPT - Only answer from manual ({manual_content} is filled per request).
+# The static instructions come first and the manual last, so that prompts for the same tenant
+# share a byte-identical prefix (provider-side prompt caching); the question is the user message.
+SYSTEM_PROMPT_TEMPLATES = {
+    'ja': """あなたは親切なマニュアルアシスタントです。末尾のマニュアル情報を使って、ユーザーの質問に回答してください。
 
 【基本ルール】
-✅ マニュアルに関する質問には、上記の内容を使って自然に回答してください
+✅ マニュアルに関する質問には、マニュアル情報の内容を使って自然に回答してください
 ✅ マニュアルに書かれていることだけを答え、推測や創作は絶対にしないでください
 ❌ マニュアルと全く関係ない話題（子育て相談、料理レシピ、天気など）には、「申し訳ございません。その質問はマニュアルの内容とは関係がありません」と答えてください
 
@@ -1507,14 +1745,12 @@ def generate_ai_response(query, context="", language="ja", user_id=None):
 ・番号で参照された場合（「1番」「2番」など）も、該当するマニュアルの内容を説明してください
 ・会話の流れの中での追加質問（「なぜ」「詳しく」など）も、マニュアルの情報を使って答えてください
 
-自然で親切な対応を心がけ、マニュアルの情報だけを正確に提供してください。""",
-            
-            'en': f"""You are a helpful manual assistant. Use the following manual information to answer user questions naturally.
-
-{manual_content}
+自然で親切な対応を心がけ、マニュアルの情報だけを正確に提供してください。{manual_content}""",
+    
+    'en': """You are a helpful manual assistant. Use the manual information at the end to answer user questions naturally.
 
 【Basic Rules】
-✅ Answer questions about the manual using the information above
+✅ Answer questions about the manual using the manual information
 ✅ Only provide information that is explicitly in the manual - never guess or make things up
 ❌ For completely unrelated topics (personal advice, recipes, weather), respond: "I apologize, but that question is not related to the manual content"
 
@@ -1522,14 +1758,12 @@ def generate_ai_response(query, context="", language="ja", user_id=None):
 ・If asked about information not in the manual, honestly say: "That information is not in the manual"
 ・Answer naturally and be helpful, but only use the manual information provided
 
-Be friendly and accurate, providing only what's in the manual.""",
-            
-            'zh': f"""您是一位友善的手册助手。请使用以下手册信息自然地回答用户问题。
-
-{manual_content}
+Be friendly and accurate, providing only what's in the manual.{manual_content}""",
+    
+    'zh': """您是一位友善的手册助手。请使用末尾的手册信息自然地回答用户问题。
 
 【基本规则】
-✅ 使用上述内容回答关于手册的问题
+✅ 使用手册信息的内容回答关于手册的问题
 ✅ 只提供手册中明确记载的信息 - 绝不猜测或编造
 ❌ 对于完全无关的话题（个人建议、食谱、天气等），回答："抱歉，该问题与手册内容无关"
 
@@ -1537,10 +1771,177 @@ Be friendly and accurate, providing only what's in the manual.""",
 ・如果被问及手册中没有的信息，请诚实回答："该信息未在手册中记载"
 ・自然友好地回答，但只使用提供的手册信息
 
-请友好且准确地回答，仅提供手册中的内容。"""
-        }
+请友好且准确地回答，仅提供手册中的内容。{manual_content}"""
+}
+
+MANUAL_HEADER = "\n\n【アップロードされたマニュアル情報】\n"
+
+def manual_section(passage):
+    """One passage as it appears in the system prompt."""
+    return f"\n=== {passage['filename']} ===\n{passage['content']}\n"
+
+def build_system_prompt(user_id, query, language="ja", route=None, version=None):
+    """System prompt with the tenant's manual, or its passages most relevant to the query ("" when there is no manual).
+    
+    The prompt is the static instructions followed by the manual, and nothing per-question, so
+    calls for the same tenant share a byte-identical prefix that the provider can cache:
+    - when the whole manual fits in the token budget, every question gets the same prompt;
+    - otherwise the top passages are packed whole, best score first, into the budget left after
+      the template, the question and the reply reservation of the routed model (passages that
+      do not fit are dropped rather than cut), then laid out in document order, so questions that
+      retrieve overlapping passages still share a long prefix.
+    Prompts are cached per (user_id, document version, language, passages, budget), so a repeated
+    question skips the DB read and the tokenizing until the tenant's files change.
+    version is the document version the caller read (the current one when None).
+    """
+    if not user_id or not passage_index:
+        return ""
+    
+    if language not in SYSTEM_PROMPT_TEMPLATES:
+        language = 'ja'
+    template = SYSTEM_PROMPT_TEMPLATES[language]
+    if route:
+        budget = prompt_assembler.section_budget(template, query, model=route['model'], max_tokens=route['max_tokens'])
+    else:
+        budget = prompt_assembler.section_budget(template, query)
+    
+    # Whole manual ("" cached when it does not fit the budget)
+    if version is None:
+        version = current_document_version(user_id)
+    manual_key = (user_id, version, language, 'manual', budget)
+    system_prompt = prompt_cache.get(manual_key)
+    if system_prompt is None:
+        passages = passage_index.passages(user_id, version=version)
+        sections = [manual_section(passage) for passage in passages]
+        system_prompt = ""
+        if sections and prompt_assembler.fits(sections, budget, header=MANUAL_HEADER):
+            assembled = prompt_assembler.assemble(template, sections, question=query, header=MANUAL_HEADER,
+                                                  budget=budget)
+            system_prompt = assembled['prompt']
+            logger.info(f"Built whole-manual system prompt for user {user_id}: {len(passages)} passages, "
+                        f"{assembled['tokens']} tokens")
+        prompt_cache.put(manual_key, system_prompt)
+    if system_prompt:
+        return system_prompt
+    
+    passages = passage_index.retrieve(user_id, query, max_chars=None, top_k=MANUAL_TOP_K, version=version)
+    if not passages:
+        return ""
+    
+    cache_key = (user_id, version, language, tuple((p['file_id'], p['chunk_index']) for p in passages), budget)
+    system_prompt = prompt_cache.get(cache_key)
+    if system_prompt is not None:
+        return system_prompt
+    
+    sections = [manual_section(passage) for passage in passages]
+    assembled = prompt_assembler.assemble(template, sections, question=query, header=MANUAL_HEADER, budget=budget,
+                                          order=[(p['file_id'], p['chunk_index']) for p in passages])
+    system_prompt = assembled['prompt']
+    if assembled['dropped']:
+        logger.info(f"Dropped {len(assembled['dropped'])} of {len(passages)} passages "
+                    f"({assembled['dropped_tokens']} tokens) over the {budget}-token budget for user {user_id}")
+    
+    prompt_cache.put(cache_key, system_prompt)
+    logger.info(f"Built system prompt for user {user_id}: {len(assembled['included'])} passages, "
+                f"{assembled['tokens']} tokens")
+    return system_prompt
+
+def get_user_plan(user_id):
+    """Plan of the user (cached by the usage meter when it is enabled)."""
+    if usage_meter:
+        return usage_meter.get_plan(user_id)
+    conn = get_db_connection()
+    try:
+        row = conn.execute('SELECT plan FROM users WHERE id = ?', (user_id,)).fetchone()
+    finally:
+        conn.close()
+    return row['plan'] if row else None
+
+def route_query(user_id, query):
+    """Model and max_tokens for the question under the user's plan."""
+    plan = None
+    if user_id:
+        try:
+            plan = get_user_plan(user_id)
+        except Exception as e:
+            logger.warning(f"Failed to load plan for user {user_id}: {e}")
+    return model_router.route(query, plan)
+
+def current_document_version(user_id):
+    """Version of the tenant's document set (None when versions are unavailable)."""
+    return document_versions.get(user_id) if document_versions else None
+
+def remember_answer(user_id, language, query, answer, version):
+    """Store a generated answer in the exact-match and semantic answer caches.
+    
+    version is the document version read before the prompt was built, so an answer generated
+    while a file change bumps the version is filed under the old version and never served.
+    """
+    try:
+        if answer_cache:
+            answer_cache.put(user_id, language, query, version, answer)
+        if semantic_cache:
+            semantic_cache.store(user_id, language, query, version, answer)
+    except Exception as e:
+        logger.warning(f"Failed to cache answer: {e}")
+
+def invalidate_document_caches(user_id):
+    """Start a new document version for the tenant after files are added or removed."""
+    if document_versions:
+        document_versions.bump(user_id)
+    prompt_cache.invalidate(user_id)
+    if answer_cache:
+        answer_cache.invalidate(user_id)
+    if semantic_cache:
+        semantic_cache.invalidate(user_id)
+
+def keyword_fallback_answer(user_id, query):
+    """Answer from the tenant's best keyword-matching passages without calling OpenAI."""
+    results = []
+    if passage_index and user_id:
+        try:
+            passages = passage_index.search(user_id, query, top_k=3, version=current_document_version(user_id))
+            results = [(p['filename'], p['content'], p['score']) for p in passages]
+        except Exception as e:
+            logger.warning(f"Keyword fallback search failed for user {user_id}: {e}")
+    if safe_response:
+        return safe_response.safe_response(query, results=results)
+    if results:
+        return "\n\n".join(content for _, content, _ in results[:2])
+    return ERROR_MESSAGE
+
+def generate_ai_response(query, context="", language="ja", user_id=None, route=None, document_version=None):
+    """Generate AI response using OpenAI API - STRICTLY RAG SYSTEM.
+    
+    context is the system prompt from build_system_prompt; it is built here when empty.
+    route is the model choice from route_query; the question is routed here when it is None.
+    document_version is the version context was built from; it is read here when None.
+    Raises CircuitOpenError when the OpenAI circuit rejects the call (the caller answers without the API).
+    """
+    try:
+        logger.info(f"DEBUG generate_ai_response: user_id={user_id}, query='{query[:50]}...'")
         
-        system_prompt = system_prompts.get(language, system_prompts['ja'])
+        if route is None:
+            route = route_query(user_id, query)
+        if document_version is None and user_id:
+            document_version = current_document_version(user_id)
+        
+        system_prompt = context
+        if not system_prompt and user_id:
+            try:
+                system_prompt = build_system_prompt(user_id, query, language, route=route,
+                                                    version=document_version)
+            except Exception as e:
+                logger.warning(f"Failed to load user documents: {e}")
+        
+        # If no manual is uploaded, return error message
+        if not system_prompt:
+            fallback_messages = {
+                'ja': "申し訳ございません。現在、参照できるマニュアルがアップロードされていません。先にマニュアルファイルをアップロードしてください。",
+                'en': "I apologize, but there are no manuals uploaded for reference. Please upload a manual file first.",
+                'zh': "很抱歉，目前没有上传可参考的手册。请先上传手册文件。"
+            }
+            return fallback_messages.get(language, fallback_messages['ja'])
         
         # Debug: Check openai_client
         logger.info(f"DEBUG: openai_client = {openai_client}")
@@ -1553,45 +1954,65 @@ Be friendly and accurate, providing only what's in the manual.""",
             logger.warning("Empty query received")
             return "申し訳ございません。質問内容が空です。もう一度お試しください。"
 
-        if len(system_prompt) > 50000:  # Prevent token limit issues
-            logger.warning(f"System prompt too long: {len(system_prompt)} characters")
-            system_prompt = system_prompt[:49000] + "\n\n... (truncated for token limit)"
-
-        # OpenAI API call with retry logic
-        max_retries = 3
-        for attempt in range(max_retries):
-            try:
-                response = openai_client.chat.completions.create(
-                    model="gpt-3.5-turbo",
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": query}
-                    ],
-                    max_tokens=1000,
-                    temperature=0.7,
-                    timeout=30  # 30 second timeout
-                )
-
-                if not response or not response.choices or len(response.choices) == 0:
-                    raise Exception("Empty response from OpenAI API")
+        if not OPENAI_API_KEY:
+            raise Exception("OpenAI API key not configured")
 
-                ai_response = response.choices[0].message.content.strip()
-                if not ai_response:
-                    raise Exception("Empty content in OpenAI response")
+        # While the circuit is open (or its single recovery probe is taken), let the caller fall back
+        if not llm_breaker.allow():
+            raise CircuitOpenError(llm_breaker.name)
 
-                logger.info(f"✅ OpenAI API call successful, response length: {len(ai_response)}")
-                return ai_response
-
-            except Exception as api_error:
-                logger.warning(f"OpenAI API attempt {attempt + 1} failed: {str(api_error)}")
-                if attempt == max_retries - 1:
-                    raise api_error
-                import time
-                time.sleep(1 * (attempt + 1))  # Exponential backoff
+        # The gateway bounds concurrent OpenAI calls and retries 429/5xx with jittered backoff
+        # (honoring Retry-After) on its event loop instead of sleeping in this worker thread
+        started = time.perf_counter()
+        timing = {}
+        try:
+            response = get_llm_gateway().chat(
+                OPENAI_API_KEY,
+                base_url=OPENAI_BASE_URL,
+                timing=timing,
+                model=route['model'],
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": query}
+                ],
+                max_tokens=route['max_tokens'],
+                temperature=0.7,
+                timeout=30  # 30 second timeout per attempt
+            )
+        except Exception as api_error:
+            if is_local_timeout(api_error):
+                # Expired while queued in this process (e.g. behind bulk work): says nothing about OpenAI
+                llm_breaker.release()
+            else:
+                # Only outages count against the circuit (not e.g. a 400 for this particular request)
+                llm_breaker.record(not is_transient_error(api_error), timing.get('call_seconds', 0.0))
+            model_router.record(route, time.perf_counter() - started, error=True)
+            raise
+        # Judge slowness by the time spent calling OpenAI, not the time queued in the gateway
+        llm_breaker.record(True, timing.get('call_seconds', time.perf_counter() - started))
+        usage = getattr(response, 'usage', None)
+        model_router.record(route, time.perf_counter() - started,
+                            prompt_tokens=getattr(usage, 'prompt_tokens', 0) or 0,
+                            completion_tokens=getattr(usage, 'completion_tokens', 0) or 0,
+                            cached_tokens=cached_prompt_tokens(usage), tenant=user_id)
+
+        if not response or not response.choices or len(response.choices) == 0:
+            raise Exception("Empty response from OpenAI API")
+
+        ai_response = response.choices[0].message.content.strip()
+        if not ai_response:
+            raise Exception("Empty content in OpenAI response")
+
+        logger.info(f"✅ OpenAI API call successful, response length: {len(ai_response)}")
+        if user_id:
+            remember_answer(user_id, language, query, ai_response, document_version)
+        return ai_response
 
+    except CircuitOpenError:
+        raise
     except Exception as e:
         error_msg = str(e)
-        logger.error(f"❌ OpenAI API error after {max_retries} attempts: {error_msg}")
+        logger.error(f"❌ OpenAI API error: {error_msg}")
         import traceback
         logger.error(f"Full traceback: {traceback.format_exc()}")
 
@@ -1611,6 +2032,33 @@ Be friendly and accurate, providing only what's in the manual.""",
             }
             return fallback_messages.get(language, fallback_messages['ja'])
 
+@app.route('/api/admin/metrics')
+@admin_required
+def admin_metrics():
+    """Runtime performance metrics for admins."""
+    return jsonify({
+        'webhook_queue': webhook_dispatcher.stats() if webhook_dispatcher else None,
+        'line_account_cache': line_account_resolver.stats() if line_account_resolver else None,
+        'usage_meter': usage_meter.stats() if usage_meter else None,
+        'webhook_dedup': webhook_deduper.stats() if webhook_deduper else None,
+        'http_clients': get_http_registry().stats(),
+        'message_pipeline': message_pipeline.stats(),
+        'passage_index': passage_index.stats() if passage_index else None,
+        'document_versions': document_versions.stats() if document_versions else None,
+        'prompt_cache': prompt_cache.stats(),
+        'prompt_assembler': prompt_assembler.stats(),
+        'llm_gateway': get_llm_gateway().stats(),
+        'model_router': model_router.stats(),
+        'prompt_cache_by_tenant': model_router.tenant_stats(),
+        'rag_registry': {**rag_registry.stats(),
+                         'open_chroma_stores': open_store_count() if open_store_count else None},
+        'embedding_cache': embedding_cache_stats() if embedding_cache_stats else None,
+        'rag_persistence': write_behind_stats(),
+        'llm_breaker': llm_breaker.stats(),
+        'answer_cache': answer_cache.stats() if answer_cache else None,
+        'semantic_cache': semantic_cache.stats() if semantic_cache else None
+    })
+
 @app.route('/api/generate_link_code', methods=['POST'])
 @login_required
 def generate_link_code_api():
@@ -1753,9 +2201,10 @@ def upload_file():
         # Update usage
         update_usage(user_id, 'files', 1)
         
-        # Update search index
-        if search_engine:
-            search_engine.add_document(str(file_id), content)
+        # Split into passages for per-question retrieval
+        if passage_index:
+            passage_index.index_file(user_id, file_id, content)
+        invalidate_document_caches(user_id)
         
         # Log upload
         log_audit(user_id, 'file_uploaded', f'File: {original_filename}, Size: {file_size}', request.remote_addr)
@@ -1799,6 +2248,10 @@ def delete_file(file_id):
         conn.commit()
         conn.close()
         
+        if passage_index:
+            passage_index.remove_file(session['user_id'], file_id)
+        invalidate_document_caches(session['user_id'])
+        
         # Log deletion
         log_audit(session['user_id'], 'file_deleted', f'File ID: {file_id}', request.remote_addr)
         
@@ -2033,6 +2486,9 @@ def handle_checkout_completed(session):
         conn.commit()
         conn.close()
         
+        if usage_meter:
+            usage_meter.invalidate_plan(user_id)
+        
         logger.info(f"Subscription activated for user {user_id}, plan: {plan}")
     
     except Exception as e:
@@ -2079,6 +2535,9 @@ def handle_subscription_deleted(subscription):
             conn.commit()
             conn.close()
         
+        if usage_meter:
+            usage_meter.invalidate_plan(user_id)
+        
         logger.info(f"Subscription cancelled for user {user_id}")
     
     except Exception as e:
@@ -2451,6 +2910,10 @@ def convert_pdf():
         )
         get_db().commit()
         
+        if passage_index:
+            passage_index.index_file(user_id, cursor.lastrowid, result['markdown'])
+        invalidate_document_caches(user_id)
+        
         # 一時ファイル削除
         os.unlink(tmp_path)
         
@@ -2502,15 +2965,19 @@ def rag_add_document():
         filename, content = row
         
         # RAGに追加
-        rag = RAGSystem(user_id=user_id)
-        chunks = rag.add_document(
-            markdown_text=content,
-            metadata={"filename": filename, "file_id": file_id}
-        )
+        with rag_registry.acquire(user_id) as rag:
+            result = rag.ingest(
+                markdown_text=content,
+                metadata={"filename": filename, "file_id": file_id}
+            )
+        chunks = result['chunks']
         
         return jsonify({
             'success': True,
             'chunks': chunks,
+            'skipped': result['skipped'],
+            'chunks_per_sec': result['chunks_per_sec'],
+            'embedding_cache': result['embedding'],
             'message': f'{chunks}チャンクをRAGに追加しました'
         })
     
@@ -2531,12 +2998,19 @@ def rag_search():
         
         user_id = session.get('user_id')
         
-        # RAG検索
-        rag = RAGSystem(user_id=user_id)
-        result = rag.qa(query)
+        # RAG検索（モデルは質問の分類とプランで選択）
+        route = route_query(user_id, query)
+        started = time.perf_counter()
+        try:
+            with rag_registry.acquire(user_id) as rag:
+                result = rag.qa(query, model=route['model'], max_tokens=route['max_tokens'])
+        except Exception:
+            model_router.record(route, time.perf_counter() - started, error=True)
+            raise
+        model_router.record(route, time.perf_counter() - started, tenant=user_id, **(result.get('usage') or {}))
         
         # 使用量追跡
-        track_usage(user_id, 'api_calls_made')
+        update_usage(user_id, 'api_calls', 1)
         
         return jsonify({
             'success': True,
@@ -2549,14 +3023,61 @@ def rag_search():
         logger.error(f"RAG検索エラー: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+def sse_event(event, data):
+    """Format one server-sent event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/api/rag/search/stream', methods=['POST'])
+@login_required
+def rag_search_stream():
+    """RAG検索（Server-Sent Events）
+    
+    Sends a "sources" event as soon as retrieval finishes, then one "token" event per answer
+    fragment and a final "done" event with the cost computed from the usage chunk.
+    """
+    data = request.json or {}
+    query = data.get('query')
+    
+    if not query:
+        return jsonify({'error': 'queryが必要です'}), 400
+    
+    user_id = session.get('user_id')
+    
+    def generate():
+        route = route_query(user_id, query)
+        started = time.perf_counter()
+        try:
+            with rag_registry.acquire(user_id) as rag:
+                for event in rag.qa_stream(query, model=route['model'], max_tokens=route['max_tokens']):
+                    if event['type'] == 'token':
+                        yield sse_event('token', {'text': event['text']})
+                    elif event['type'] == 'sources':
+                        yield sse_event('sources', {'sources': event['sources']})
+                    else:
+                        usage = event['usage'] or {}
+                        model_router.record(route, time.perf_counter() - started,
+                                            prompt_tokens=usage.get('prompt_tokens', 0),
+                                            completion_tokens=usage.get('completion_tokens', 0),
+                                            cached_tokens=cached_prompt_tokens(usage), tenant=user_id)
+                        # 使用量追跡
+                        update_usage(user_id, 'api_calls', 1)
+                        yield sse_event('done', {'success': True, 'cost': event['cost'], 'usage': event['usage']})
+        except Exception as e:
+            model_router.record(route, time.perf_counter() - started, error=True)
+            logger.error(f"RAGストリーミング検索エラー: {str(e)}")
+            yield sse_event('error', {'error': str(e)})
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api/rag/documents', methods=['GET'])
 @login_required
 def rag_list_documents():
     """RAGに登録されているドキュメント一覧"""
     try:
         user_id = session.get('user_id')
-        rag = RAGSystem(user_id=user_id)
-        documents = rag.get_all_documents()
+        with rag_registry.acquire(user_id) as rag:
+            documents = rag.get_all_documents()
         
         return jsonify({
             'success': True,
@@ -2753,6 +3274,105 @@ if handler:
 else:
     logger.warning("⚠️ LINE Bot handler not available - event handlers not registered")
 
+# Processed webhookEventIds (shared across workers through SQLite)
+webhook_deduper = None
+if WebhookEventDeduper:
+    try:
+        webhook_deduper = WebhookEventDeduper(DATABASE_PATH, ttl=WEBHOOK_DEDUP_TTL)
+    except Exception as e:
+        logger.error(f"❌ Webhook deduplication store initialization failed: {e}")
+
+# Document set version per tenant (bumped on upload/delete) and the prompt cache keyed by it
+document_versions = None
+if DocumentVersions:
+    try:
+        document_versions = DocumentVersions(DATABASE_PATH, ttl=DOCUMENT_VERSION_TTL)
+    except Exception as e:
+        logger.error(f"❌ Document version store initialization failed: {e}")
+prompt_cache = PromptCache(max_bytes=int(PROMPT_CACHE_MB * 1024 * 1024))
+prompt_assembler = PromptAssembler(model=CHAT_MODEL, max_tokens=CHAT_MAX_TOKENS,
+                                   context_budget=MANUAL_CONTEXT_TOKENS,
+                                   use_tiktoken=PROMPT_TOKENIZER != 'estimate')
+model_router = ModelRouter(PLANS, default_model=CHAT_MODEL, default_max_tokens=CHAT_MAX_TOKENS,
+                           enabled=MODEL_ROUTING_ENABLED)
+llm_breaker = CircuitBreaker('openai', window=LLM_BREAKER_WINDOW, min_calls=LLM_BREAKER_MIN_CALLS,
+                             failure_rate=LLM_BREAKER_FAILURE_RATE, slow_call_ms=LLM_BREAKER_SLOW_MS,
+                             open_seconds=LLM_BREAKER_OPEN_SECONDS)
+
+# Exact-match answer cache (SQLite shared across workers, in-memory LRU in front)
+answer_cache = None
+if AnswerCache and ANSWER_CACHE_ENABLED:
+    try:
+        answer_cache = AnswerCache(DATABASE_PATH, ttl=ANSWER_CACHE_TTL, memory_size=ANSWER_CACHE_SIZE)
+    except Exception as e:
+        logger.error(f"❌ Answer cache initialization failed: {e}")
+
+# Semantic answer cache (per-process, per-tenant question embeddings)
+semantic_cache = None
+if SemanticAnswerCache and SEMANTIC_CACHE_ENABLED:
+    if SEMANTIC_CACHE_EMBEDDER == 'local':
+        semantic_cache = SemanticAnswerCache(LocalHashEmbedder(), threshold=SEMANTIC_CACHE_THRESHOLD,
+                                             max_per_tenant=SEMANTIC_CACHE_SIZE, ttl=ANSWER_CACHE_TTL)
+    elif openai_client:
+        # A cache lookup must stay cheap: short timeout, no SDK retries
+        semantic_cache = SemanticAnswerCache(OpenAIQueryEmbedder(openai_client, timeout=SEMANTIC_CACHE_EMBED_TIMEOUT,
+                                                                 max_retries=0),
+                                             threshold=SEMANTIC_CACHE_THRESHOLD,
+                                             max_per_tenant=SEMANTIC_CACHE_SIZE, ttl=ANSWER_CACHE_TTL)
+
+# Per-tenant passage index for manual context retrieval
+passage_index = None
+if PassageIndex:
+    try:
+        passage_index = PassageIndex(DATABASE_PATH, chunk_size=PASSAGE_CHUNK_SIZE)
+    except Exception as e:
+        logger.error(f"❌ Passage index initialization failed: {e}")
+
+# Warm RAGSystem instances per tenant (RAG endpoints)
+rag_registry = RAGRegistry(lambda user_id: RAGSystem(user_id=user_id), max_instances=RAG_MAX_INSTANCES)
+atexit.register(rag_registry.close)
+# RAGSystem instances are built in request/warmup threads, so hook SIGTERM here on the main thread
+# to make deferred Chroma persists run at exit (no-op under gunicorn, which installs its own handler)
+install_sigterm_handler()
+
+def recent_rag_tenants(limit):
+    """Tenants with a Chroma store, most recently active (by usage updates) first."""
+    conn = get_db_connection()
+    try:
+        rows = conn.execute('''
+            SELECT user_id FROM usage_tracking GROUP BY user_id ORDER BY MAX(updated_at) DESC LIMIT ?
+        ''', (limit * 4,)).fetchall()
+    finally:
+        conn.close()
+    return [row[0] for row in rows if os.path.isdir(RAGSystem.store_directory(row[0]))][:limit]
+
+def warm_rag_registry():
+    """Load RAGSystem instances for recently active tenants so their first request skips setup."""
+    try:
+        rag_registry.warmup(recent_rag_tenants(RAG_WARMUP_TENANTS))
+    except Exception as e:
+        logger.warning(f"RAG registry warmup failed: {e}")
+
+if RAGSystem and RAG_WARMUP_TENANTS > 0:
+    threading.Thread(target=warm_rag_registry, name='rag-warmup', daemon=True).start()
+
+# Per-user serial executor for multi-event deliveries (sync mode)
+event_executor = None
+if KeyedSerialExecutor:
+    event_executor = KeyedSerialExecutor(max_workers=WEBHOOK_WORKERS, thread_name_prefix='webhook-event')
+
+# Webhook worker pool (async ack mode)
+webhook_dispatcher = None
+if handler and WEBHOOK_ASYNC_ACK and WebhookDispatcher:
+    webhook_dispatcher = WebhookDispatcher(
+        dispatch_line_event,
+        workers=WEBHOOK_WORKERS,
+        max_queue=WEBHOOK_QUEUE_SIZE,
+        reply_token_ttl=WEBHOOK_REPLY_TOKEN_TTL
+    )
+    atexit.register(webhook_dispatcher.shutdown)
+    logger.info("✅ Webhook async ack mode enabled")
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8080))
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,179 @@
+"""
+メッセージ処理パイプライン
+LINEメッセージ1件の処理（アカウント解決 → 使用量判定 → 言語判定 → 検索 → AI応答 → 安全フィルタ → 保存 → 返信）を
+名前付きステージの列として実行し、ステージごとの所要時間をヒストグラム（p50/p95/p99）に記録する
+閾値を超えた遅いリクエストはステージ内訳つきでログに残す
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class MessageContext:
+    """パイプラインの各ステージが読み書きするメッセージ1件分の状態"""
+
+    def __init__(self, line_user_id: str, message_text: str, reply_token: str,
+                 event=None, source: str = 'webhook'):
+        """
+        Args:
+            line_user_id: LINEユーザーID
+            message_text: 受信したテキスト
+            reply_token: リプライトークン
+            event: LINE SDKのイベント（手動パース時はNone）
+            source: 'webhook'（SDKでパース）/ 'manual'（手動パース）
+        """
+        self.line_user_id = line_user_id
+        self.message_text = message_text
+        self.reply_token = reply_token
+        self.event = event
+        self.source = source
+
+        self.user_id = None
+        self.language = 'ja'
+        self.context = ''
+        # 回答の生成とキャッシュへの保存に使うドキュメントバージョン（最初のキャッシュ参照時に1回だけ読む）
+        self.document_version = None
+        # 回答に使うモデルと max_tokens（model_router.ModelRouter.route の戻り値）
+        self.route = None
+        self.response = None
+        self.conversation_id = None
+        # キャッシュから回答した場合はキャッシュの種類（'exact' など）
+        self.cache_hit = None
+        # OpenAIを使わずにキーワード検索で回答した場合True（ブレーカーが開いているとき）
+        self.fallback = False
+        # 返信済みなどで以降のステージが不要になったらTrue
+        self.done = False
+        self.timings = {}  # stage -> 秒
+
+    def finish(self):
+        """以降のステージをスキップ"""
+        self.done = True
+
+
+class LatencyHistogram:
+    """直近 window 件の所要時間からパーセンタイルを求める"""
+
+    def __init__(self, window: int = 1000):
+        self._samples = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        self._samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def snapshot(self) -> Dict:
+        samples = sorted(self._samples)
+
+        def percentile(p):
+            if not samples:
+                return 0.0
+            return round(samples[min(len(samples) - 1, int(len(samples) * p))] * 1000, 1)
+
+        return {
+            'count': self.count,
+            'avg_ms': round(self.total / self.count * 1000, 1) if self.count else 0.0,
+            'p50_ms': percentile(0.50),
+            'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99),
+            'max_ms': round(self.max * 1000, 1),
+        }
+
+
+class MessagePipeline:
+    """名前付きステージを順に実行し、ステージごとの所要時間を集計するパイプライン"""
+
+    def __init__(self, stages: List[Tuple[str, Callable[[MessageContext], None]]],
+                 slow_threshold_ms: float = 5000.0, window: int = 1000, exemplars: int = 20):
+        """
+        パイプライン初期化
+
+        Args:
+            stages: (ステージ名, ステージ関数) のリスト。関数は MessageContext を受け取る
+            slow_threshold_ms: これを超えたリクエストをステージ内訳つきでログ出力（ミリ秒）
+            window: パーセンタイル計算に使う直近のサンプル数
+            exemplars: 保持する遅いリクエストの最大件数
+        """
+        self.stages = stages
+        self.slow_threshold_ms = slow_threshold_ms
+        self.window = window
+
+        self._histograms = {name: LatencyHistogram(window) for name, _ in stages}
+        self._total = LatencyHistogram(window)
+        self._slow = deque(maxlen=exemplars)
+        self._errors = {}
+        self._lock = threading.Lock()
+
+    def run(self, ctx: MessageContext) -> MessageContext:
+        """
+        ステージを順に実行（ctx.finish() されたらそこで終了）
+
+        Args:
+            ctx: メッセージコンテキスト
+
+        Returns:
+            MessageContext: 実行後のコンテキスト
+        """
+        started = time.perf_counter()
+        failed_stage = None
+        try:
+            for name, stage in self.stages:
+                if ctx.done:
+                    break
+                stage_started = time.perf_counter()
+                try:
+                    stage(ctx)
+                except Exception:
+                    failed_stage = name
+                    raise
+                finally:
+                    ctx.timings[name] = time.perf_counter() - stage_started
+            return ctx
+        finally:
+            self._record(ctx, time.perf_counter() - started, failed_stage)
+
+    def _record(self, ctx: MessageContext, total: float, failed_stage: Optional[str]):
+        with self._lock:
+            for name, seconds in ctx.timings.items():
+                self._histograms[name].add(seconds)
+            self._total.add(total)
+            if failed_stage:
+                self._errors[failed_stage] = self._errors.get(failed_stage, 0) + 1
+
+        total_ms = total * 1000
+        if total_ms < self.slow_threshold_ms:
+            return
+
+        breakdown = {name: round(seconds * 1000, 1) for name, seconds in ctx.timings.items()}
+        exemplar = {
+            'at': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'source': ctx.source,
+            'user_id': ctx.user_id,
+            'cache_hit': ctx.cache_hit,
+            'total_ms': round(total_ms, 1),
+            'stages': breakdown,
+            'failed_stage': failed_stage,
+        }
+        with self._lock:
+            self._slow.append(exemplar)
+        logger.warning(f"Slow message ({total_ms:.0f} ms, user {ctx.user_id}, {ctx.source}): "
+                       + ", ".join(f"{name}={ms}ms" for name, ms in breakdown.items()))
+
+    def stats(self) -> Dict:
+        """ステージごとのパーセンタイルと直近の遅いリクエスト"""
+        with self._lock:
+            return {
+                'total': self._total.snapshot(),
+                'stages': {name: histogram.snapshot() for name, histogram in self._histograms.items()},
+                'errors': dict(self._errors),
+                'slow_threshold_ms': self.slow_threshold_ms,
+                'slow_exemplars': list(self._slow),
+            }
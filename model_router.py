@@ -0,0 +1,321 @@
+"""
+モデルルーティング
+質問を軽量なヒューリスティックで分類し（単純な確認 / 通常 / 複数の論点 / 無関係な話題）、
+プランごとの設定に従って回答に使うモデルと max_tokens を選ぶ
+ルートごとのレイテンシ（p50/p95）・トークン数・推定コストを集計する
+テナントごとに、プロバイダー側のプロンプトキャッシュに載った入力トークン数と、それによる節約額・
+キャッシュあり/なしの平均レイテンシを集計する
+"""
+
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from message_pipeline import LatencyHistogram
+
+ROUTE_LOOKUP = 'lookup'
+ROUTE_STANDARD = 'standard'
+ROUTE_COMPLEX = 'complex'
+ROUTE_OFF_TOPIC = 'off_topic'
+ROUTES = (ROUTE_LOOKUP, ROUTE_STANDARD, ROUTE_COMPLEX, ROUTE_OFF_TOPIC)
+
+# モデルごとの料金（USD / 100万トークン: 入力, 出力）
+MODEL_PRICES = {
+    'gpt-3.5-turbo': (0.5, 1.5),
+    'gpt-4': (30.0, 60.0),
+    'gpt-4-turbo': (10.0, 30.0),
+    'gpt-4o': (2.5, 10.0),
+    'gpt-4o-mini': (0.15, 0.6),
+}
+
+# キャッシュされた入力トークンの料金（通常の入力料金に対する割合）
+CACHED_INPUT_PRICE_RATIO = 0.5
+
+# 営業時間・場所・料金など、短い答えで済む質問
+_LOOKUP_PATTERNS = re.compile(
+    r'何時|いつ|どこ|いくら|何円|何階|何番|何分|電話番号|住所|場所|営業時間|料金|値段|有無|ありますか|できますか'
+    r'|几点|哪里|多少钱|什么时候|电话'
+    r'|\bwhat time\b|\bwhen\b|\bwhere\b|\bhow much\b|\bis there\b|\bdo you have\b|\bcan i\b|\bphone\b|\baddress\b',
+    re.IGNORECASE)
+
+# 説明・比較・手順など、長い答えが必要な質問
+_COMPLEX_PATTERNS = re.compile(
+    r'なぜ|どうして|理由|違い|比較|手順|方法を|詳しく|説明して|まとめて|それぞれ|および|ならびに'
+    r'|为什么|区别|比较|步骤|详细'
+    r'|\bwhy\b|\bexplain\b|\bcompare\b|\bdifference\b|\bsteps?\b|\bin detail\b|\bsummari[sz]e\b|\band also\b',
+    re.IGNORECASE)
+
+# マニュアルと関係がないことが明らかな話題
+_OFF_TOPIC_PATTERNS = re.compile(
+    r'天気|占い|レシピ|献立|株価|競馬|宝くじ|恋愛|ジョーク|冗談|しりとり'
+    r'|天气|菜谱|股票|笑话'
+    r'|\bweather\b|\brecipe\b|\bhoroscope\b|\bstock price\b|\blottery\b|\bjoke\b',
+    re.IGNORECASE)
+
+_QUESTION_MARKS = re.compile(r'[?？]')
+_ENUMERATION = re.compile(r'(?:^|\s)(?:[1-9][.)、]|[①-⑨]|・)', re.MULTILINE)
+
+
+def cached_prompt_tokens(usage) -> int:
+    """
+    usage のうちプロンプトキャッシュから読まれた入力トークン数
+
+    Args:
+        usage: レスポンスの usage（オブジェクトまたは dict、古いSDKでは追加フィールドの dict）
+
+    Returns:
+        int: prompt_tokens_details.cached_tokens（返されない場合は0）
+    """
+    if not usage:
+        return 0
+    details = usage.get('prompt_tokens_details') if isinstance(usage, dict) \
+        else getattr(usage, 'prompt_tokens_details', None)
+    if not details:
+        return 0
+    cached = details.get('cached_tokens') if isinstance(details, dict) else getattr(details, 'cached_tokens', 0)
+    return int(cached or 0)
+
+
+def _prices(model: str):
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        for name in sorted(MODEL_PRICES, key=len, reverse=True):
+            if model.startswith(name):
+                return MODEL_PRICES[name]
+    return prices
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0) -> float:
+    """
+    推定コスト（USD）
+
+    Args:
+        model: モデル名（日付つきのスナップショット名は前方一致で解決）
+        prompt_tokens: 入力トークン数（キャッシュされた分を含む）
+        completion_tokens: 出力トークン数
+        cached_tokens: 入力のうちプロンプトキャッシュから読まれたトークン数
+    """
+    prices = _prices(model)
+    if prices is None:
+        return 0.0
+    cached_tokens = min(cached_tokens, prompt_tokens)
+    return ((prompt_tokens - cached_tokens) / 1_000_000 * prices[0]
+            + cached_tokens / 1_000_000 * prices[0] * CACHED_INPUT_PRICE_RATIO
+            + completion_tokens / 1_000_000 * prices[1])
+
+
+def cache_savings(model: str, cached_tokens: int) -> float:
+    """プロンプトキャッシュによって節約された入力コスト（USD）"""
+    prices = _prices(model)
+    if prices is None:
+        return 0.0
+    return cached_tokens / 1_000_000 * prices[0] * (1 - CACHED_INPUT_PRICE_RATIO)
+
+
+def classify_query(query: str, lookup_chars: int = 40, complex_chars: int = 150) -> str:
+    """
+    質問をルートに分類
+
+    Args:
+        query: 質問文
+        lookup_chars: これ以下の長さで単純な確認の表現を含めば lookup
+        complex_chars: これを超える長さは complex
+
+    Returns:
+        str: 'lookup' / 'standard' / 'complex' / 'off_topic'
+    """
+    text = unicodedata.normalize('NFKC', query or '').strip()
+    if _OFF_TOPIC_PATTERNS.search(text):
+        return ROUTE_OFF_TOPIC
+    questions = len(_QUESTION_MARKS.findall(text))
+    if (len(text) > complex_chars or questions >= 2 or len(_ENUMERATION.findall(text)) >= 2
+            or _COMPLEX_PATTERNS.search(text)):
+        return ROUTE_COMPLEX
+    if len(text) <= lookup_chars and _LOOKUP_PATTERNS.search(text):
+        return ROUTE_LOOKUP
+    return ROUTE_STANDARD
+
+
+class _RouteStats:
+    """1ルート・1モデル分の集計"""
+
+    def __init__(self, window: int):
+        self.latency = LatencyHistogram(window)
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.cost = 0.0
+        self.errors = 0
+
+
+class _TenantStats:
+    """1テナント分のプロンプトキャッシュの集計"""
+
+    def __init__(self):
+        self.calls = 0
+        self.cached_calls = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.cost = 0.0
+        self.saved = 0.0
+        self.cached_seconds = 0.0
+        self.uncached_seconds = 0.0
+
+
+class ModelRouter:
+    """質問の分類に応じてモデルと max_tokens を選ぶルーター"""
+
+    def __init__(self, plans: Dict, default_model: str = 'gpt-3.5-turbo', default_max_tokens: int = 1000,
+                 enabled: bool = True, window: int = 1000, max_tenants: int = 1000):
+        """
+        ルーター初期化
+
+        Args:
+            plans: プラン設定（PLANS）。各プランの 'routes' に {ルート: {'model', 'max_tokens'}} を指定
+            default_model: ルート設定がない場合（または無効時）のモデル
+            default_max_tokens: ルート設定がない場合（または無効時）の max_tokens
+            enabled: Falseなら常に既定のモデルを使う（集計は行う）
+            window: レイテンシのパーセンタイル計算に使う直近のサンプル数
+            max_tenants: テナントごとの集計を保持する最大テナント数（古いものから破棄）
+        """
+        self.plans = plans
+        self.default_model = default_model
+        self.default_max_tokens = default_max_tokens
+        self.enabled = enabled
+        self.window = window
+        self.max_tenants = max_tenants
+
+        self._stats = {}  # (route, model) -> _RouteStats
+        self._tenants = OrderedDict()  # tenant -> _TenantStats（最近使った順）
+        self._counts = {route: 0 for route in ROUTES}
+        self._lock = threading.Lock()
+
+    def route(self, query: str, plan: Optional[str] = None) -> Dict:
+        """
+        質問に使うモデルを選択
+
+        Args:
+            query: 質問文
+            plan: ユーザーのプラン（PLANS のキー）
+
+        Returns:
+            dict: route, model, max_tokens
+        """
+        route = classify_query(query)
+        with self._lock:
+            self._counts[route] += 1
+
+        choice = {'route': route, 'model': self.default_model, 'max_tokens': self.default_max_tokens}
+        if self.enabled:
+            routes = (self.plans.get(plan) or {}).get('routes') or {}
+            configured = routes.get(route) or routes.get(ROUTE_STANDARD)
+            if configured:
+                choice['model'] = configured.get('model', self.default_model)
+                choice['max_tokens'] = configured.get('max_tokens', self.default_max_tokens)
+        return choice
+
+    def record(self, choice: Dict, seconds: float, prompt_tokens: int = 0, completion_tokens: int = 0,
+               error: bool = False, cached_tokens: int = 0, tenant=None) -> float:
+        """
+        呼び出し結果を記録
+
+        Args:
+            choice: route() の戻り値
+            seconds: OpenAI呼び出しの所要時間（秒）
+            prompt_tokens: 入力トークン数
+            completion_tokens: 出力トークン数
+            error: 呼び出しが失敗したか
+            cached_tokens: 入力のうちプロンプトキャッシュから読まれたトークン数
+            tenant: テナント（ユーザーID）。指定するとテナントごとのキャッシュ効果を集計する
+
+        Returns:
+            float: 推定コスト（USD）
+        """
+        cost = estimate_cost(choice['model'], prompt_tokens, completion_tokens, cached_tokens)
+        key = (choice['route'], choice['model'])
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = _RouteStats(self.window)
+            stats.latency.add(seconds)
+            stats.prompt_tokens += prompt_tokens
+            stats.completion_tokens += completion_tokens
+            stats.cached_tokens += cached_tokens
+            stats.cost += cost
+            stats.errors += int(error)
+            if tenant is not None and not error:
+                self._record_tenant(tenant, choice['model'], seconds, prompt_tokens, cached_tokens, cost)
+        return cost
+
+    def _record_tenant(self, tenant, model: str, seconds: float, prompt_tokens: int, cached_tokens: int,
+                       cost: float):
+        """テナントごとの集計に加える（ロックを保持して呼ぶこと）"""
+        stats = self._tenants.get(tenant)
+        if stats is None:
+            stats = self._tenants[tenant] = _TenantStats()
+            while len(self._tenants) > self.max_tenants:
+                self._tenants.popitem(last=False)
+        else:
+            self._tenants.move_to_end(tenant)
+        stats.calls += 1
+        stats.prompt_tokens += prompt_tokens
+        stats.cached_tokens += cached_tokens
+        stats.cost += cost
+        stats.saved += cache_savings(model, cached_tokens)
+        if cached_tokens:
+            stats.cached_calls += 1
+            stats.cached_seconds += seconds
+        else:
+            stats.uncached_seconds += seconds
+
+    def tenant_stats(self, limit: int = 20) -> Dict:
+        """
+        テナントごとのプロンプトキャッシュの効果（最近使ったテナントから limit 件）
+
+        Returns:
+            dict: テナント -> calls, cached_calls, prompt_tokens, cached_tokens, cached_ratio,
+                  cost_usd, saved_usd, latency_ms_cached, latency_ms_uncached
+        """
+        with self._lock:
+            tenants = {}
+            for tenant in list(reversed(self._tenants))[:limit]:
+                stats = self._tenants[tenant]
+                uncached_calls = stats.calls - stats.cached_calls
+                tenants[str(tenant)] = {
+                    'calls': stats.calls,
+                    'cached_calls': stats.cached_calls,
+                    'prompt_tokens': stats.prompt_tokens,
+                    'cached_tokens': stats.cached_tokens,
+                    'cached_ratio': round(stats.cached_tokens / stats.prompt_tokens, 3) if stats.prompt_tokens else 0.0,
+                    'cost_usd': round(stats.cost, 6),
+                    'saved_usd': round(stats.saved, 6),
+                    'latency_ms_cached': round(stats.cached_seconds / stats.cached_calls * 1000, 1)
+                    if stats.cached_calls else None,
+                    'latency_ms_uncached': round(stats.uncached_seconds / uncached_calls * 1000, 1)
+                    if uncached_calls else None,
+                }
+            return tenants
+
+    def stats(self) -> Dict:
+        """ルート・モデルごとのレイテンシとコスト"""
+        with self._lock:
+            routes = {}
+            for (route, model), stats in sorted(self._stats.items()):
+                calls = stats.latency.count
+                routes[f'{route}:{model}'] = {
+                    **stats.latency.snapshot(),
+                    'errors': stats.errors,
+                    'prompt_tokens': stats.prompt_tokens,
+                    'completion_tokens': stats.completion_tokens,
+                    'cached_tokens': stats.cached_tokens,
+                    'cost_usd': round(stats.cost, 6),
+                    'cost_usd_avg': round(stats.cost / calls, 6) if calls else 0.0,
+                }
+            return {
+                'enabled': self.enabled,
+                'classified': dict(self._counts),
+                'routes': routes,
+                'tenants_tracked': len(self._tenants),
+            }
@@ -0,0 +1,372 @@
+"""
+テナント別パッセージインデックス
+アップロード時にファイル本文をパッセージ（チャンク）に分割して file_chunks テーブルへ保存し、
+質問ごとに BM25 でテナントの全ファイルから上位のパッセージを取り出す
+- トークン: 英数字は単語単位、日本語・中国語は文字バイグラム
+- テナントごとの転置インデックスをメモリにキャッシュ（LRU）
+  ドキュメントバージョン（document_versions）を渡すとバージョンが同じ間はDBを参照しない
+  渡さない場合はチャンクの件数・最大IDが変わったら再構築
+"""
+
+import logging
+import math
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_CJK = r'\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af'
+_WORD_PATTERN = re.compile(rf'[a-z0-9]+|[{_CJK}]+')
+_CJK_PATTERN = re.compile(rf'[{_CJK}]')
+
+
+def tokenize(text: str) -> List[str]:
+    """英数字は単語、CJK文字列は文字バイグラムに分割"""
+    tokens = []
+    for run in _WORD_PATTERN.findall(text.lower()):
+        if _CJK_PATTERN.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        elif len(run) > 1 or run.isdigit():
+            tokens.append(run)
+    return tokens
+
+
+def split_passages(text: str, chunk_size: int = 600, overlap: int = 100) -> List[str]:
+    """
+    本文をパッセージに分割（段落・改行単位でまとめ、長い段落は文字数で分割）
+
+    Args:
+        text: ファイル本文
+        chunk_size: 1パッセージの最大文字数
+        overlap: 長い段落を分割するときの重なり文字数
+
+    Returns:
+        list: パッセージのリスト
+    """
+    passages = []
+    current = ''
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if len(current) + len(line) + 1 <= chunk_size:
+            current = f"{current}\n{line}" if current else line
+            continue
+        if current:
+            passages.append(current)
+            current = ''
+        if len(line) <= chunk_size:
+            current = line
+            continue
+        step = max(1, chunk_size - overlap)
+        for start in range(0, len(line), step):
+            piece = line[start:start + chunk_size]
+            passages.append(piece)
+            if start + chunk_size >= len(line):
+                break
+    if current:
+        passages.append(current)
+    return passages
+
+
+class _TenantIndex:
+    """1テナント分の BM25 転置インデックス"""
+
+    def __init__(self, signature, rows):
+        self.signature = signature
+        self.passages = []  # dict(file_id, filename, chunk_index, content)
+        self.postings = defaultdict(list)  # token -> [(passage_no, tf)]
+        self.lengths = []
+        for row in rows:
+            counts = Counter(tokenize(row['content']))
+            passage_no = len(self.passages)
+            self.passages.append({
+                'file_id': row['file_id'],
+                'filename': row['filename'],
+                'chunk_index': row['chunk_index'],
+                'content': row['content'],
+            })
+            self.lengths.append(sum(counts.values()))
+            for token, tf in counts.items():
+                self.postings[token].append((passage_no, tf))
+        self.avg_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0.0
+
+    def search(self, query: str, top_k: int, k1: float = 1.2, b: float = 0.75) -> List[Dict]:
+        total = len(self.passages)
+        if not total:
+            return []
+        scores = defaultdict(float)
+        for token in set(tokenize(query)):
+            postings = self.postings.get(token)
+            if not postings:
+                continue
+            idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+            for passage_no, tf in postings:
+                norm = k1 * (1 - b + b * self.lengths[passage_no] / (self.avg_length or 1))
+                scores[passage_no] += idf * tf * (k1 + 1) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:top_k]
+        return [{**self.passages[passage_no], 'score': round(score, 4)} for passage_no, score in ranked]
+
+
+class PassageIndex:
+    """テナント別のパッセージ分割・保存・検索"""
+
+    def __init__(self, db_path: str, chunk_size: int = 600, overlap: int = 100, max_tenants: int = 64):
+        """
+        インデックス初期化
+
+        Args:
+            db_path: SQLiteデータベースのパス
+            chunk_size: 1パッセージの最大文字数
+            overlap: 長い段落を分割するときの重なり文字数
+            max_tenants: メモリに保持するテナント別インデックスの最大数
+        """
+        self.db_path = db_path
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        self.max_tenants = max_tenants
+
+        self._tenants = OrderedDict()  # user_id -> _TenantIndex
+        self._lock = threading.Lock()
+        self._stats = {
+            'searches': 0,
+            'index_builds': 0,
+            'files_indexed': 0,
+            'backfilled_files': 0,
+            'search_ms_total': 0.0,
+        }
+
+        self._init_table()
+
+    def _get_connection(self):
+        """データベース接続取得"""
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _init_table(self):
+        """パッセージテーブル初期化"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS file_chunks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                file_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                chunk_index INTEGER NOT NULL,
+                content TEXT NOT NULL,
+                UNIQUE(file_id, chunk_index)
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_file_chunks_user ON file_chunks(user_id)')
+        conn.commit()
+        conn.close()
+
+    def _write_chunks(self, conn, user_id, file_id, content: str) -> int:
+        passages = split_passages(content or '', self.chunk_size, self.overlap)
+        conn.execute('DELETE FROM file_chunks WHERE file_id = ?', (file_id,))
+        conn.executemany(
+            'INSERT INTO file_chunks (file_id, user_id, chunk_index, content) VALUES (?, ?, ?, ?)',
+            [(file_id, user_id, i, passage) for i, passage in enumerate(passages)]
+        )
+        return len(passages)
+
+    def index_file(self, user_id, file_id, content: str) -> int:
+        """
+        ファイル本文を分割して保存（アップロード時に呼ぶ。同じファイルは置き換え）
+
+        Args:
+            user_id: テナント（ユーザー）ID
+            file_id: files.id
+            content: 抽出済みの本文
+
+        Returns:
+            int: 保存したパッセージ数
+        """
+        conn = self._get_connection()
+        try:
+            count = self._write_chunks(conn, user_id, file_id, content)
+            conn.commit()
+        finally:
+            conn.close()
+        self.invalidate(user_id)
+        with self._lock:
+            self._stats['files_indexed'] += 1
+        logger.info(f"Indexed file {file_id} for user {user_id}: {count} passages")
+        return count
+
+    def remove_file(self, user_id, file_id):
+        """ファイルのパッセージを削除（ファイル削除時に呼ぶ）"""
+        conn = self._get_connection()
+        try:
+            conn.execute('DELETE FROM file_chunks WHERE file_id = ?', (file_id,))
+            conn.commit()
+        finally:
+            conn.close()
+        self.invalidate(user_id)
+
+    def invalidate(self, user_id=None):
+        """メモリ上のインデックスを破棄"""
+        with self._lock:
+            if user_id is None:
+                self._tenants.clear()
+            else:
+                self._tenants.pop(user_id, None)
+
+    def _backfill(self, conn, user_id) -> int:
+        """パッセージ未作成のファイル（この機能以前のアップロード）を分割して保存"""
+        rows = conn.execute('''
+            SELECT id, content FROM files
+            WHERE user_id = ? AND content IS NOT NULL AND TRIM(content) != ''
+            AND id NOT IN (SELECT DISTINCT file_id FROM file_chunks WHERE user_id = ?)
+        ''', (user_id, user_id)).fetchall()
+        for row in rows:
+            self._write_chunks(conn, user_id, row['id'], row['content'])
+        if rows:
+            conn.commit()
+            with self._lock:
+                self._stats['backfilled_files'] += len(rows)
+        return len(rows)
+
+    def _cached_index(self, user_id, signature):
+        with self._lock:
+            index = self._tenants.get(user_id)
+            if index is not None and index.signature == signature:
+                self._tenants.move_to_end(user_id)
+                return index
+        return None
+
+    def _tenant_index(self, user_id, version: Optional[int] = None) -> _TenantIndex:
+        """
+        テナントのインデックスを取得（他ワーカーでの更新はシグネチャで検出）
+
+        Args:
+            user_id: テナント（ユーザー）ID
+            version: ドキュメントバージョン（指定時はキャッシュと一致すればDBを参照しない）
+        """
+        if version is not None:
+            signature = ('version', version)
+            index = self._cached_index(user_id, signature)
+            if index is not None:
+                return index
+
+        conn = self._get_connection()
+        try:
+            self._backfill(conn, user_id)
+            if version is None:
+                row = conn.execute(
+                    'SELECT COUNT(*) AS n, COALESCE(MAX(id), 0) AS max_id FROM file_chunks WHERE user_id = ?',
+                    (user_id,)
+                ).fetchone()
+                signature = (row['n'], row['max_id'])
+                index = self._cached_index(user_id, signature)
+                if index is not None:
+                    return index
+
+            rows = conn.execute('''
+                SELECT c.file_id, c.chunk_index, c.content, f.filename
+                FROM file_chunks c
+                JOIN files f ON f.id = c.file_id
+                WHERE c.user_id = ?
+                ORDER BY f.uploaded_at DESC, c.file_id DESC, c.chunk_index
+            ''', (user_id,)).fetchall()
+        finally:
+            conn.close()
+
+        index = _TenantIndex(signature, rows)
+        with self._lock:
+            self._tenants[user_id] = index
+            self._tenants.move_to_end(user_id)
+            while len(self._tenants) > self.max_tenants:
+                self._tenants.popitem(last=False)
+            self._stats['index_builds'] += 1
+        return index
+
+    def passages(self, user_id, version: Optional[int] = None) -> List[Dict]:
+        """
+        テナントの全パッセージ（新しいファイル順・ファイル内は先頭から）
+
+        Args:
+            user_id: テナント（ユーザー）ID
+            version: ドキュメントバージョン
+
+        Returns:
+            list: パッセージ（search と同じ形式、score なし）
+        """
+        return list(self._tenant_index(user_id, version).passages)
+
+    def has_passages(self, user_id, version: Optional[int] = None) -> bool:
+        """テナントに検索対象のパッセージがあるか"""
+        return bool(self._tenant_index(user_id, version).passages)
+
+    def search(self, user_id, query: str, top_k: int = 6, version: Optional[int] = None) -> List[Dict]:
+        """
+        質問に関連するパッセージを検索
+
+        Args:
+            user_id: テナント（ユーザー）ID
+            query: 質問文
+            top_k: 取得する最大件数
+            version: ドキュメントバージョン
+
+        Returns:
+            list: file_id, filename, chunk_index, content, score を持つ辞書のリスト（スコア順）
+        """
+        return self._search(self._tenant_index(user_id, version), query, top_k)
+
+    def _search(self, index: _TenantIndex, query: str, top_k: int) -> List[Dict]:
+        started = time.perf_counter()
+        results = index.search(query, top_k)
+        with self._lock:
+            self._stats['searches'] += 1
+            self._stats['search_ms_total'] += (time.perf_counter() - started) * 1000
+        return results
+
+    def retrieve(self, user_id, query: str, max_chars: Optional[int] = 6000, top_k: int = 6,
+                 version: Optional[int] = None) -> List[Dict]:
+        """
+        文字数予算内に収まる上位パッセージを取得
+        一致するパッセージがない場合は最新ファイルの先頭から予算分を返す
+
+        Args:
+            user_id: テナント（ユーザー）ID
+            query: 質問文
+            max_chars: パッセージ本文の合計文字数の上限（Noneなら上限なし）
+            top_k: 取得する最大件数
+            version: ドキュメントバージョン
+
+        Returns:
+            list: パッセージ（search と同じ形式）
+        """
+        index = self._tenant_index(user_id, version)
+        candidates = self._search(index, query, top_k) or index.passages[:top_k]
+
+        selected = []
+        used = 0
+        for passage in candidates:
+            if selected and max_chars is not None and used + len(passage['content']) > max_chars:
+                break
+            selected.append(passage)
+            used += len(passage['content'])
+        return selected
+
+    def stats(self) -> Dict:
+        """統計情報を取得"""
+        with self._lock:
+            searches = self._stats['searches']
+            return {
+                'searches': searches,
+                'index_builds': self._stats['index_builds'],
+                'files_indexed': self._stats['files_indexed'],
+                'backfilled_files': self._stats['backfilled_files'],
+                'search_ms_avg': round(self._stats['search_ms_total'] / searches, 2) if searches else 0.0,
+                'cached_tenants': len(self._tenants),
+                'passages_cached': sum(len(index.passages) for index in self._tenants.values()),
+            }
@@ -3,7 +3,6 @@ PDF変換エンジン（Doclingから移植）
 OpenAI GPT-4o Visionを使用した高精度PDF変換
 """
 
-import openai
 import base64
 from pdf2image import convert_from_path
 import io
@@ -11,6 +10,9 @@ import os
 from dotenv import load_dotenv
 from pathlib import Path
 import time
+from collections import deque
+from http_clients import get_openai_client
+from llm_gateway import LANE_BULK, get_gateway
 
 load_dotenv()
 
@@ -20,7 +22,9 @@ class PDFConverter:
         if not self.api_key:
             raise ValueError("OpenAI APIキーが設定されていません")
         
-        self.client = openai.OpenAI(api_key=self.api_key)
+        self.client = get_openai_client(self.api_key)
+        # 同時に変換するページ数
+        self.pages_in_flight = max(1, int(os.getenv("PDF_PAGES_IN_FLIGHT", 2)))
     
     def convert_to_markdown(self, pdf_path, dpi=200):
         """
@@ -37,21 +41,46 @@ class PDFConverter:
                 'cost': 推定コスト
             }
         """
+        pending = deque()
         try:
             # PDFを画像に変換
             images = convert_from_path(pdf_path, dpi=dpi)
             
+            # ページを PDF_PAGES_IN_FLIGHT ページずつLLMゲートウェイに投入する
+            # （一括処理のレーンで送るので、LINEの応答の同時実行枠は埋めない）
             markdown_result = ""
             total_cost = 0
             
-            for page_num, image in enumerate(images, 1):
-                # 画像をBase64エンコード
-                buffer = io.BytesIO()
-                image.save(buffer, format="PNG")
-                image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-                
-                # OpenAI API呼び出し
-                prompt = """このページをMarkdown形式に変換してください。
+            for page_num in range(1, len(images) + 1):
+                if len(pending) >= self.pages_in_flight:
+                    markdown_result, total_cost = self._collect(pending.popleft(), markdown_result, total_cost)
+                # 画像のBase64エンコードは投入する直前に行う
+                pending.append((page_num, self._submit_page(images[page_num - 1])))
+            
+            while pending:
+                markdown_result, total_cost = self._collect(pending.popleft(), markdown_result, total_cost)
+            
+            return {
+                'markdown': markdown_result,
+                'pages': len(images),
+                'cost': round(total_cost, 4)
+            }
+        
+        except Exception as e:
+            # 失敗したら投入済みのページの変換も止める
+            for _, future in pending:
+                future.cancel()
+            raise Exception(f"PDF変換エラー: {str(e)}")
+    
+    def _submit_page(self, image):
+        """ページ画像の変換をLLMゲートウェイに投入"""
+        # 画像をBase64エンコード
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+        
+        # OpenAI API呼び出し
+        prompt = """このページをMarkdown形式に変換してください。
 
 【重要な要件】
 1. テーブルは必ず正確に再現（列の区切りを明確に）
@@ -61,35 +90,35 @@ class PDFConverter:
 5. 数式がある場合は $$数式$$ 形式
 
 出力はMarkdownのみ。説明不要。"""
-                
-                response = self.client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=[{
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt},
-                            {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_base64}"}}
-                        ]
-                    }],
-                    max_tokens=4096
-                )
-                
-                page_markdown = response.choices[0].message.content
-                markdown_result += f"## ページ {page_num}\n\n{page_markdown}\n\n---\n\n"
-                
-                # コスト計算
-                cost = (response.usage.prompt_tokens / 1_000_000 * 2.5) + \
-                       (response.usage.completion_tokens / 1_000_000 * 10)
-                total_cost += cost
-            
-            return {
-                'markdown': markdown_result,
-                'pages': len(images),
-                'cost': round(total_cost, 4)
-            }
         
-        except Exception as e:
-            raise Exception(f"PDF変換エラー: {str(e)}")
+        # 他のPDFの変換と一括処理のレーンを共有するため、待ち時間の上限を長めに取る
+        return get_gateway().submit(
+            self.api_key,
+            deadline=600,
+            lane=LANE_BULK,
+            model="gpt-4o",
+            messages=[{
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt},
+                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_base64}"}}
+                ]
+            }],
+            max_tokens=4096
+        )
+    
+    @staticmethod
+    def _collect(page, markdown_result, total_cost):
+        """変換済みのページをMarkdownとコストに加える"""
+        page_num, future = page
+        response = future.result()
+        page_markdown = response.choices[0].message.content
+        markdown_result += f"## ページ {page_num}\n\n{page_markdown}\n\n---\n\n"
+        
+        # コスト計算
+        cost = (response.usage.prompt_tokens / 1_000_000 * 2.5) + \
+               (response.usage.completion_tokens / 1_000_000 * 10)
+        return markdown_result, total_cost + cost
     
     def convert_and_save(self, pdf_path, output_path=None):
         """
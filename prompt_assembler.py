@@ -0,0 +1,309 @@
+"""
+トークン予算つきプロンプト組み立て
+モデルのコンテキスト長から応答用の max_tokens・テンプレート・質問の分を差し引いた予算内に、
+優先度の高いセクション（検索スコア順のパッセージ）から順に詰めてシステムプロンプトを作る
+- トークン数: tiktoken（インストール済みでエンコーディングを読み込める場合、初回の計算時に読み込む）または文字種ごとの概算
+- 入りきらないセクションは途中で切らずに丸ごと除外し、除外したトークン数を記録する
+- 採用したセクションは order で指定した固定の順序で並べられる（プロバイダー側のプロンプトキャッシュが効くよう、
+  同じセクションの組み合わせなら質問によらず同じ文字列になる）
+"""
+
+import logging
+import math
+import threading
+from typing import Dict, List, Optional
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# モデルごとのコンテキスト長（トークン）
+MODEL_CONTEXT_TOKENS = {
+    'gpt-3.5-turbo': 16385,
+    'gpt-4': 8192,
+    'gpt-4-turbo': 128000,
+    'gpt-4o': 128000,
+    'gpt-4o-mini': 128000,
+}
+DEFAULT_CONTEXT_TOKENS = 8192
+
+# チャット形式のメッセージ1件あたりの付加トークンと、応答の開始に使われるトークン
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_PRIMER_TOKENS = 3
+
+
+def context_tokens_for(model: str) -> int:
+    """モデルのコンテキスト長（日付つきのスナップショット名は前方一致で解決）"""
+    if model in MODEL_CONTEXT_TOKENS:
+        return MODEL_CONTEXT_TOKENS[model]
+    for name in sorted(MODEL_CONTEXT_TOKENS, key=len, reverse=True):
+        if model.startswith(name):
+            return MODEL_CONTEXT_TOKENS[name]
+    return DEFAULT_CONTEXT_TOKENS
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    tokenizerを使わないトークン数の概算（多めに見積もる）
+
+    ASCIIは約4文字で1トークン、かな・漢字などそれ以外の文字は1文字1トークンとして数える
+    """
+    if not text:
+        return 0
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return math.ceil(ascii_chars / 4) + (len(text) - ascii_chars)
+
+
+class TokenCounter:
+    """モデルに対応したトークン数の計算"""
+
+    def __init__(self, model: str = 'gpt-3.5-turbo', use_tiktoken: bool = True):
+        """
+        Args:
+            model: OpenAIのモデル名（tiktokenのエンコーディング選択に使用）
+            use_tiktoken: Falseなら常に概算で数える（エンコーディングのダウンロードを避けたい環境向け）
+        """
+        self.model = model
+        # エンコーディングの読み込みは初回ダウンロードを伴うことがあるため、最初に数えるときまで遅らせる
+        self._encoding = None
+        self._loaded = tiktoken is None or not use_tiktoken
+        self._load_lock = threading.Lock()
+
+    def _get_encoding(self):
+        """tiktokenのエンコーディング（初回呼び出し時に読み込み、使えなければNone）"""
+        if self._loaded:
+            return self._encoding
+        with self._load_lock:
+            if not self._loaded:
+                try:
+                    try:
+                        self._encoding = tiktoken.encoding_for_model(self.model)
+                    except KeyError:
+                        self._encoding = tiktoken.get_encoding('cl100k_base')
+                except Exception as e:
+                    # エンコーディングのダウンロードに失敗した場合など
+                    logger.warning(f"tiktoken encoding unavailable, estimating tokens instead: {e}")
+                    self._encoding = None
+                self._loaded = True
+        return self._encoding
+
+    @property
+    def backend(self) -> str:
+        """トークン数の計算方法（まだ数えていなければ 'pending'）"""
+        if not self._loaded:
+            return 'pending'
+        return 'tiktoken' if self._encoding is not None else 'estimate'
+
+    def count(self, text: str) -> int:
+        """テキストのトークン数"""
+        if not text:
+            return 0
+        encoding = self._get_encoding()
+        if encoding is not None:
+            return len(encoding.encode(text, disallowed_special=()))
+        return estimate_tokens(text)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """
+        max_tokens 以内に収まるよう末尾を切る（文や行の区切りがあればそこで切る）
+
+        Args:
+            text: テキスト
+            max_tokens: トークン数の上限
+
+        Returns:
+            str: 切り詰めたテキスト（収まる場合はそのまま）
+        """
+        if max_tokens <= 0:
+            return ''
+        if self.count(text) <= max_tokens:
+            return text
+        encoding = self._get_encoding()
+        if encoding is not None:
+            cut = encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+            # 末尾の文字がトークンの途中で切れると置換文字になる
+            cut = cut.rstrip('�')
+        else:
+            low, high = 0, len(text)
+            while low < high:
+                middle = (low + high + 1) // 2
+                if estimate_tokens(text[:middle]) <= max_tokens:
+                    low = middle
+                else:
+                    high = middle - 1
+            cut = text[:low]
+
+        boundary = max(cut.rfind(mark) for mark in ('。', '\n', '. ', '！', '？'))
+        if boundary >= len(cut) // 2:
+            cut = cut[:boundary + 1]
+        return cut.rstrip()
+
+
+class PromptAssembler:
+    """トークン予算内にセクションを優先度順に詰めてシステムプロンプトを組み立てる"""
+
+    def __init__(self, model: str = 'gpt-3.5-turbo', max_tokens: int = 1000,
+                 context_budget: Optional[int] = None, context_tokens: Optional[int] = None,
+                 use_tiktoken: bool = True):
+        """
+        組み立て初期化
+
+        Args:
+            model: 回答に使うモデル
+            max_tokens: 応答用に確保するトークン数（APIに渡す max_tokens）
+            context_budget: セクション（マニュアル本文）に使うトークン数の上限（Noneならコンテキスト長いっぱい）
+            context_tokens: モデルのコンテキスト長（省略時はモデル名から決定）
+            use_tiktoken: Falseならtiktokenを使わず概算でトークン数を数える
+        """
+        self.model = model
+        self.max_tokens = max_tokens
+        self.context_budget = context_budget
+        self.context_tokens = context_tokens or context_tokens_for(model)
+        self.counter = TokenCounter(model, use_tiktoken=use_tiktoken)
+
+        self._template_tokens = {}  # テンプレート -> トークン数
+        self._lock = threading.Lock()
+        self._stats = {
+            'assembled': 0,
+            'sections_included': 0,
+            'sections_dropped': 0,
+            'tokens_used': 0,
+            'tokens_dropped': 0,
+            'truncated': 0,
+            'over_budget': 0,
+        }
+
+    def _fixed_tokens(self, template: str, question: str) -> int:
+        """テンプレート（本文以外）・質問・メッセージ形式の付加分のトークン数"""
+        with self._lock:
+            template_tokens = self._template_tokens.get(template)
+        if template_tokens is None:
+            template_tokens = self.counter.count(template.format(manual_content=''))
+            with self._lock:
+                self._template_tokens[template] = template_tokens
+        return (template_tokens + self.counter.count(question)
+                + 2 * MESSAGE_OVERHEAD_TOKENS + REPLY_PRIMER_TOKENS)
+
+    def section_budget(self, template: str, question: str = '', model: Optional[str] = None,
+                       max_tokens: Optional[int] = None) -> int:
+        """
+        セクションに使えるトークン数
+
+        Args:
+            template: {manual_content} を含むシステムプロンプトのテンプレート
+            question: ユーザーの質問（userメッセージとして送る分）
+            model: 回答に使うモデル（省略時は初期化時のモデル）
+            max_tokens: 応答用に確保するトークン数（省略時は初期化時の値）
+
+        Returns:
+            int: コンテキスト長から max_tokens と固定部分を引いた残り（context_budget が上限）
+        """
+        context_tokens = context_tokens_for(model) if model else self.context_tokens
+        reserved = self.max_tokens if max_tokens is None else max_tokens
+        available = context_tokens - reserved - self._fixed_tokens(template, question)
+        if self.context_budget is not None:
+            available = min(available, self.context_budget)
+        return max(0, available)
+
+    def fits(self, sections: List[str], budget: int, header: str = '') -> bool:
+        """
+        すべてのセクションが予算内に収まるか（統計には記録しない）
+
+        Args:
+            sections: セクション本文
+            budget: セクションに使うトークン数
+            header: セクションの前に付ける見出し
+        """
+        remaining = budget - self.counter.count(header)
+        for section in sections:
+            remaining -= self.counter.count(section)
+            if remaining < 0:
+                return False
+        return True
+
+    def assemble(self, template: str, sections: List[str], question: str = '', header: str = '',
+                 budget: Optional[int] = None, order: Optional[List] = None) -> Dict:
+        """
+        優先度順のセクションを予算内に詰めてテンプレートに埋め込む
+
+        Args:
+            template: {manual_content} を含むシステムプロンプトのテンプレート
+            sections: 優先度の高い順のセクション本文
+            question: ユーザーの質問
+            header: セクションの前に付ける見出し（セクションが1つ以上入るときのみ）
+            budget: セクションに使うトークン数（省略時は section_budget）
+            order: セクションごとの並び順のキー（省略時は優先度順に並べる）
+
+        Returns:
+            dict: prompt, tokens（プロンプト全体）, budget, included（採用したセクションの番号）,
+                  dropped（除外したセクションの番号）, dropped_tokens, truncated
+        """
+        if budget is None:
+            budget = self.section_budget(template, question)
+
+        remaining = budget - self.counter.count(header)
+        included, dropped = [], []
+        texts = {}
+        dropped_tokens = 0
+        for number, section in enumerate(sections):
+            cost = self.counter.count(section)
+            if cost <= remaining:
+                included.append(number)
+                texts[number] = section
+                remaining -= cost
+            else:
+                # 途中で切らずに丸ごと除外し、後ろの小さいセクションが入るか試す
+                dropped.append(number)
+                dropped_tokens += cost
+
+        truncated = False
+        if not included and sections and remaining > 0:
+            # 最上位のセクションすら入らない場合だけ、文の区切りで切って入れる
+            cut = self.counter.truncate(sections[0], remaining)
+            if cut:
+                included.append(0)
+                dropped.remove(0)
+                texts[0] = cut
+                dropped_tokens -= self.counter.count(cut)
+                truncated = True
+
+        rendered = sorted(included, key=lambda number: order[number]) if order else included
+        manual_content = header + ''.join(texts[number] for number in rendered) if included else ''
+        prompt = template.format(manual_content=manual_content)
+        tokens = self.counter.count(prompt)
+
+        with self._lock:
+            self._stats['assembled'] += 1
+            self._stats['sections_included'] += len(included)
+            self._stats['sections_dropped'] += len(dropped)
+            self._stats['tokens_used'] += tokens
+            self._stats['tokens_dropped'] += dropped_tokens
+            self._stats['truncated'] += int(truncated)
+            self._stats['over_budget'] += int(dropped_tokens > 0)
+
+        return {
+            'prompt': prompt,
+            'tokens': tokens,
+            'budget': budget,
+            'included': included,
+            'dropped': dropped,
+            'dropped_tokens': dropped_tokens,
+            'truncated': truncated,
+        }
+
+    def stats(self) -> Dict:
+        """統計情報を取得"""
+        with self._lock:
+            assembled = self._stats['assembled']
+            return {
+                **self._stats,
+                'tokens_avg': round(self._stats['tokens_used'] / assembled, 1) if assembled else 0.0,
+                'model': self.model,
+                'tokenizer': self.counter.backend,
+                'context_tokens': self.context_tokens,
+                'max_tokens': self.max_tokens,
+                'context_budget': self.context_budget,
+            }
@@ -0,0 +1,95 @@
+"""
+プロンプトキャッシュ
+組み立て済みのシステムプロンプトを (テナント, ドキュメントバージョン, 言語, パッセージ) をキーに保持する
+メモリ使用量はエントリのバイト数の合計で制限し、超過したら最も古く使われたものから削除（LRU）
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional
+
+
+class PromptCache:
+    """バイト数上限付きLRUの文字列キャッシュ"""
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024):
+        """
+        キャッシュ初期化
+
+        Args:
+            max_bytes: 保持する文字列（UTF-8）の合計バイト数の上限
+        """
+        self.max_bytes = max_bytes
+
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, key: Hashable) -> Optional[str]:
+        """
+        キャッシュから取得
+
+        Args:
+            key: タプルなどハッシュ可能なキー（先頭要素はテナントID）
+
+        Returns:
+            str: キャッシュされた値（なければNone）
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: str):
+        """
+        キャッシュに追加（上限を超えたら古いものから削除）
+
+        Args:
+            key: タプルなどハッシュ可能なキー（先頭要素はテナントID）
+            value: 保持する文字列
+        """
+        size = len(value.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self._stats['evictions'] += 1
+
+    def invalidate(self, user_id=None):
+        """
+        テナントのエントリを削除
+
+        Args:
+            user_id: テナント（ユーザー）ID（省略時は全件）
+        """
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+                self._bytes = 0
+                return
+            for key in [key for key in self._entries if key[0] == user_id]:
+                self._bytes -= self._entries.pop(key)[1]
+
+    def stats(self) -> Dict:
+        """統計情報を取得"""
+        with self._lock:
+            total = self._stats['hits'] + self._stats['misses']
+            return {
+                **self._stats,
+                'hit_rate': round(self._stats['hits'] / total * 100, 1) if total else 0.0,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+            }
@@ -0,0 +1,261 @@
+"""
+RAGチャンクマニフェスト
+ファイルごとに、ベクトルDBに書き込んだチャンクの (本文ハッシュ, ベクトルID, チャンク番号) をSQLiteに記録する
+同じファイルを再登録したときは新しいチャンク列との差分をとり、
+追加されたチャンクだけを埋め込み、削除されたチャンクだけをベクトルDBから消す
+あわせてファイルごとの (ファイル名, チャンク数) を記録し、ドキュメント一覧をベクトルDBを走査せずに返す
+"""
+
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, Tuple
+
+
+def diff_chunks(old: List[Tuple[str, str, int]], new_hashes: List[str]) -> Dict:
+    """
+    マニフェストの既存チャンクと新しいチャンク列の差分
+
+    同じ本文ハッシュのチャンクは既存のベクトルIDをそのまま使う（同じ本文が複数あれば出現順に対応づける）
+
+    Args:
+        old: マニフェストの (本文ハッシュ, ベクトルID, チャンク番号)
+        new_hashes: 新しいチャンク列の本文ハッシュ
+
+    Returns:
+        dict: keep（新しいチャンク番号 -> 使い続けるベクトルID）, add（埋め込みが必要なチャンク番号）,
+              remove（削除するベクトルID）, moved（番号が変わったベクトルID -> 新しいチャンク番号）
+    """
+    available = defaultdict(list)
+    for chunk_hash, vector_id, chunk_index in sorted(old, key=lambda row: row[2]):
+        available[chunk_hash].append((vector_id, chunk_index))
+
+    keep, add, moved = {}, [], {}
+    for index, chunk_hash in enumerate(new_hashes):
+        if available[chunk_hash]:
+            vector_id, old_index = available[chunk_hash].pop(0)
+            keep[index] = vector_id
+            if old_index != index:
+                moved[vector_id] = index
+        else:
+            add.append(index)
+
+    remove = [vector_id for rows in available.values() for vector_id, _ in rows]
+    return {'keep': keep, 'add': add, 'remove': remove, 'moved': moved}
+
+
+class ChunkManifest:
+    """ファイルごとのチャンク（本文ハッシュ -> ベクトルID）とファイル一覧の記録"""
+
+    def __init__(self, db_path: str):
+        """
+        マニフェスト初期化
+
+        Args:
+            db_path: SQLiteデータベースのパス
+        """
+        self.db_path = db_path
+
+        self._lock = threading.Lock()
+        self._stats = {
+            'ingests': 0,
+            'chunks_added': 0,
+            'chunks_kept': 0,
+            'chunks_removed': 0,
+        }
+
+        self._init_table()
+
+    def _get_connection(self):
+        """データベース接続取得"""
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def _init_table(self):
+        """マニフェストテーブル初期化"""
+        conn = self._get_connection()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS rag_chunks (
+                user_id TEXT NOT NULL,
+                file_key TEXT NOT NULL,
+                vector_id TEXT NOT NULL,
+                chunk_hash TEXT NOT NULL,
+                chunk_index INTEGER NOT NULL,
+                PRIMARY KEY (user_id, file_key, vector_id)
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_rag_chunks_vector_id ON rag_chunks(user_id, vector_id)')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS rag_files (
+                user_id TEXT NOT NULL,
+                file_key TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                chunk_count INTEGER NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (user_id, file_key)
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_rag_files_filename ON rag_files(user_id, filename)')
+        conn.commit()
+        conn.close()
+
+    def chunks(self, user_id, file_key) -> List[Tuple[str, str, int]]:
+        """
+        ファイルの記録済みチャンク
+
+        Args:
+            user_id: テナント（ユーザー）ID
+            file_key: ファイルのキー（file_id、なければファイル名）
+
+        Returns:
+            list: (本文ハッシュ, ベクトルID, チャンク番号)
+        """
+        conn = self._get_connection()
+        try:
+            return conn.execute('''
+                SELECT chunk_hash, vector_id, chunk_index FROM rag_chunks
+                WHERE user_id = ? AND file_key = ? ORDER BY chunk_index
+            ''', (str(user_id), str(file_key))).fetchall()
+        finally:
+            conn.close()
+
+    def add(self, user_id, file_key, rows: Iterable[Tuple[str, str, int]]):
+        """
+        書き込んだチャンクを記録
+
+        Args:
+            user_id: テナント（ユーザー）ID
+            file_key: ファイルのキー
+            rows: (本文ハッシュ, ベクトルID, チャンク番号)
+        """
+        conn = self._get_connection()
+        try:
+            conn.executemany('''
+                INSERT OR REPLACE INTO rag_chunks (user_id, file_key, vector_id, chunk_hash, chunk_index)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(str(user_id), str(file_key), vector_id, chunk_hash, chunk_index)
+                  for chunk_hash, vector_id, chunk_index in rows])
+            conn.commit()
+        finally:
+            conn.close()
+
+    def move(self, user_id, file_key, moved: Dict[str, int]):
+        """
+        チャンク番号を更新
+
+        Args:
+            user_id: テナント（ユーザー）ID
+            file_key: ファイルのキー
+            moved: ベクトルID -> 新しいチャンク番号
+        """
+        if not moved:
+            return
+        conn = self._get_connection()
+        try:
+            conn.executemany('''
+                UPDATE rag_chunks SET chunk_index = ? WHERE user_id = ? AND file_key = ? AND vector_id = ?
+            ''', [(chunk_index, str(user_id), str(file_key), vector_id) for vector_id, chunk_index in moved.items()])
+            conn.commit()
+        finally:
+            conn.close()
+
+    def remove(self, user_id, vector_ids: List[str]):
+        """
+        削除したチャンクの記録を消す
+
+        Args:
+            user_id: テナント（ユーザー）ID
+            vector_ids: ベクトルID
+        """
+        if not vector_ids:
+            return
+        conn = self._get_connection()
+        try:
+            conn.executemany('DELETE FROM rag_chunks WHERE user_id = ? AND vector_id = ?',
+                             [(str(user_id), vector_id) for vector_id in vector_ids])
+            conn.commit()
+        finally:
+            conn.close()
+
+    def set_file(self, user_id, file_key, filename: str, chunk_count: int):
+        """
+        ファイルの登録内容を記録
+
+        Args:
+            user_id: テナント（ユーザー）ID
+            file_key: ファイルのキー
+            filename: ファイル名
+            chunk_count: ベクトルDB上のチャンク数
+        """
+        conn = self._get_connection()
+        try:
+            conn.execute('''
+                INSERT OR REPLACE INTO rag_files (user_id, file_key, filename, chunk_count, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (str(user_id), str(file_key), filename, chunk_count, time.time()))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def files(self, user_id) -> List[Dict]:
+        """
+        テナントの登録済みファイル
+
+        Args:
+            user_id: テナント（ユーザー）ID
+
+        Returns:
+            list: {'file_key', 'filename', 'chunk_count'}（ファイル名順）
+        """
+        conn = self._get_connection()
+        try:
+            rows = conn.execute('''
+                SELECT file_key, filename, chunk_count FROM rag_files WHERE user_id = ? ORDER BY filename, file_key
+            ''', (str(user_id),)).fetchall()
+        finally:
+            conn.close()
+        return [{'file_key': file_key, 'filename': filename, 'chunk_count': chunk_count}
+                for file_key, filename, chunk_count in rows]
+
+    def file_keys(self, user_id, filename: str) -> List[str]:
+        """ファイル名に対応するファイルのキー"""
+        conn = self._get_connection()
+        try:
+            rows = conn.execute('SELECT file_key FROM rag_files WHERE user_id = ? AND filename = ?',
+                                (str(user_id), filename)).fetchall()
+        finally:
+            conn.close()
+        return [row[0] for row in rows]
+
+    def remove_file(self, user_id, file_key):
+        """
+        ファイルのチャンクと登録内容の記録を消す
+
+        Args:
+            user_id: テナント（ユーザー）ID
+            file_key: ファイルのキー
+        """
+        conn = self._get_connection()
+        try:
+            conn.execute('DELETE FROM rag_chunks WHERE user_id = ? AND file_key = ?', (str(user_id), str(file_key)))
+            conn.execute('DELETE FROM rag_files WHERE user_id = ? AND file_key = ?', (str(user_id), str(file_key)))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def record(self, added: int, kept: int, removed: int):
+        """取り込み1回分の差分を集計に加える"""
+        with self._lock:
+            self._stats['ingests'] += 1
+            self._stats['chunks_added'] += added
+            self._stats['chunks_kept'] += kept
+            self._stats['chunks_removed'] += removed
+
+    def stats(self) -> Dict:
+        """統計情報を取得"""
+        with self._lock:
+            touched = self._stats['chunks_added'] + self._stats['chunks_kept']
+            return {
+                **self._stats,
+                'reuse_rate': round(self._stats['chunks_kept'] / touched * 100, 1) if touched else 0.0,
+            }
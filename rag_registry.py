@@ -0,0 +1,235 @@
+"""
+RAGSystemレジストリ
+テナントごとの RAGSystem（Embeddingsクライアント・Chroma永続クライアント・テキスト分割器）を
+プロセス内で使い回し、リクエストごとの初期化コストをなくす
+- 最近使ったテナントから max_instances 件を保持し、超えたら最も古く使われたものを閉じる（LRU）
+- 同じテナントの初期化は1回だけ行い、他のテナントの取得はその間も待たない
+- 使用中のインスタンスは閉じずに、返却された時点で閉じる（上限を一時的に超えることがある）
+- warmup() で起動時などに指定テナントのインスタンスを先に作っておける
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry:
+    """1テナント分のインスタンスと利用状況"""
+
+    __slots__ = ('instance', 'ready', 'error', 'in_use', 'evicted')
+
+    def __init__(self):
+        self.instance = None
+        self.ready = threading.Event()
+        self.error = None
+        self.in_use = 0
+        self.evicted = False
+
+
+class RAGRegistry:
+    """テナントごとの RAGSystem を保持するスレッドセーフなLRUレジストリ"""
+
+    def __init__(self, factory: Callable, max_instances: int = 32):
+        """
+        レジストリ初期化
+
+        Args:
+            factory: テナントIDを受け取ってインスタンスを作る関数（例: lambda user_id: RAGSystem(user_id=user_id)）
+            max_instances: 同時に保持するインスタンス（開いたChromaハンドル）の上限
+        """
+        self.factory = factory
+        self.max_instances = max_instances
+
+        self._entries = OrderedDict()  # user_id -> _Entry（最近使った順）
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'init_errors': 0,
+            'init_seconds': 0.0,
+            'warmed': 0,
+        }
+
+    @contextmanager
+    def acquire(self, user_id):
+        """
+        テナントのインスタンスを借りる（ブロックを抜けるまで閉じられない）
+
+        Args:
+            user_id: テナント（ユーザー）ID
+
+        Yields:
+            RAGSystem: テナントのインスタンス
+        """
+        entry = self._checkout(user_id)
+        try:
+            yield entry.instance
+        finally:
+            self._checkin(entry)
+
+    def _checkout(self, user_id) -> _Entry:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry.ready.is_set() and entry.error is None:
+                self._entries.move_to_end(user_id)
+                entry.in_use += 1
+                self._stats['hits'] += 1
+                return entry
+            if entry is None:
+                entry = self._entries[user_id] = _Entry()
+                build = True
+                self._stats['misses'] += 1
+            else:
+                # 別のスレッドが初期化中（完了を待って同じインスタンスを使う）
+                build = False
+                self._stats['hits'] += 1
+            entry.in_use += 1
+
+        if build:
+            self._build(user_id, entry)
+        else:
+            entry.ready.wait()
+
+        if entry.error is not None:
+            self._checkin(entry)
+            raise entry.error
+        return entry
+
+    def _build(self, user_id, entry: _Entry):
+        """インスタンスを作る（レジストリのロックは持たずに呼ぶ）"""
+        started = time.perf_counter()
+        try:
+            entry.instance = self.factory(user_id)
+        except Exception as e:
+            entry.error = e
+            with self._lock:
+                if self._entries.get(user_id) is entry:
+                    del self._entries[user_id]
+                self._stats['init_errors'] += 1
+            logger.error(f"RAGSystem initialization failed for tenant {user_id}: {e}")
+        else:
+            evicted = []
+            with self._lock:
+                self._stats['init_seconds'] += time.perf_counter() - started
+                evicted = self._evict_locked()
+            for instance in evicted:
+                self._close(instance)
+        finally:
+            entry.ready.set()
+
+    def _checkin(self, entry: _Entry):
+        close = None
+        with self._lock:
+            entry.in_use -= 1
+            if entry.evicted and entry.in_use == 0 and entry.instance is not None:
+                close, entry.instance = entry.instance, None
+            evicted = self._evict_locked()
+        for instance in ([close] if close is not None else []) + evicted:
+            self._close(instance)
+
+    def _evict_locked(self):
+        """上限を超えた分を古いものから外す（ロックを保持して呼ぶ。閉じるべきインスタンスを返す）"""
+        to_close = []
+        excess = len(self._entries) - self.max_instances
+        if excess <= 0:
+            return to_close
+        for user_id in list(self._entries):
+            if excess <= 0:
+                break
+            entry = self._entries[user_id]
+            if not entry.ready.is_set():
+                continue
+            del self._entries[user_id]
+            entry.evicted = True
+            self._stats['evictions'] += 1
+            excess -= 1
+            if entry.in_use == 0 and entry.instance is not None:
+                to_close.append(entry.instance)
+                entry.instance = None
+        return to_close
+
+    @staticmethod
+    def _close(instance):
+        close = getattr(instance, 'close', None)
+        if close is None:
+            return
+        try:
+            close()
+        except Exception as e:
+            logger.warning(f"Failed to close RAGSystem: {e}")
+
+    def invalidate(self, user_id=None):
+        """
+        テナントのインスタンスを破棄（次の取得で作り直す）
+
+        Args:
+            user_id: テナント（ユーザー）ID（省略時は全件）
+        """
+        to_close = []
+        with self._lock:
+            user_ids = list(self._entries) if user_id is None else [user_id]
+            for key in user_ids:
+                entry = self._entries.get(key)
+                if entry is None or not entry.ready.is_set():
+                    continue
+                del self._entries[key]
+                entry.evicted = True
+                if entry.in_use == 0 and entry.instance is not None:
+                    to_close.append(entry.instance)
+                    entry.instance = None
+        for instance in to_close:
+            self._close(instance)
+
+    def warmup(self, user_ids: Iterable) -> int:
+        """
+        指定テナントのインスタンスを先に作る（上限を超える分は作らない）
+
+        Args:
+            user_ids: テナントIDの列（優先度の高い順）
+
+        Returns:
+            int: 新たに作ったインスタンスの数
+        """
+        warmed = 0
+        for user_id in user_ids:
+            with self._lock:
+                if len(self._entries) >= self.max_instances:
+                    break
+                if user_id in self._entries:
+                    continue
+            try:
+                with self.acquire(user_id):
+                    pass
+            except Exception:
+                continue
+            warmed += 1
+        with self._lock:
+            self._stats['warmed'] += warmed
+        if warmed:
+            logger.info(f"Warmed {warmed} RAGSystem instances")
+        return warmed
+
+    def close(self):
+        """全インスタンスを閉じる（プロセス終了時）"""
+        self.invalidate()
+
+    def stats(self) -> Dict:
+        """統計情報を取得"""
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            built = self._stats['misses'] - self._stats['init_errors']
+            return {
+                **self._stats,
+                'init_seconds': round(self._stats['init_seconds'], 3),
+                'init_ms_avg': round(self._stats['init_seconds'] / built * 1000, 1) if built > 0 else 0.0,
+                'hit_rate': round(self._stats['hits'] / lookups * 100, 1) if lookups else 0.0,
+                'instances': len(self._entries),
+                'in_use': sum(entry.in_use for entry in self._entries.values()),
+                'max_instances': self.max_instances,
+            }
@@ -1,55 +1,228 @@
 """
 RAGシステム（Retrieval-Augmented Generation）
-Chromaを使用したベクトルDB + OpenAI Embeddings
+Chromaを使用したベクトルDB + 埋め込みバックエンド（OpenAI Embeddings またはローカルのCPU埋め込み）
 """
 
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_openai import OpenAIEmbeddings
 from langchain_community.vectorstores import Chroma
 from langchain.schema import Document
-import openai
+import logging
+from collections import Counter
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from dotenv import load_dotenv
-from typing import List, Dict
+from typing import Callable, Iterator, List, Dict, Optional
 import sqlite3
+from http_clients import get_openai_client
+from embedding_backends import BACKEND_OPENAI, backend_name_for, get_backend
+from embedding_cache import CachedEmbeddings, EmbeddingCache, content_hash, estimate_embedding_tokens
+from rag_manifest import ChunkManifest, diff_chunks
+from write_behind import WriteBehind
+from llm_gateway import get_gateway
+from model_router import cached_prompt_tokens, estimate_cost
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# 取り込み: チャンクを最大 RAG_EMBED_BATCH_CHUNKS 件・RAG_EMBED_BATCH_TOKENS トークンのバッチに分け、
+# RAG_EMBED_CONCURRENCY 並列で埋め込んでバッチごとにベクトルDBへ書き込む
+EMBED_BATCH_CHUNKS = int(os.getenv("RAG_EMBED_BATCH_CHUNKS", 100))
+EMBED_BATCH_TOKENS = int(os.getenv("RAG_EMBED_BATCH_TOKENS", 50000))
+EMBED_CONCURRENCY = int(os.getenv("RAG_EMBED_CONCURRENCY", 4))
+
+# ベクトルDBの persist() は操作ごとに行わず、RAG_PERSIST_EVERY_OPS 回の追加・削除ごと、
+# または最初の未反映の操作から RAG_PERSIST_INTERVAL 秒後にまとめて行う（プロセス終了時にも行う）
+PERSIST_EVERY_OPS = int(os.getenv("RAG_PERSIST_EVERY_OPS", 20))
+PERSIST_INTERVAL = float(os.getenv("RAG_PERSIST_INTERVAL", 5))
+
+# 埋め込みバックエンド・埋め込みキャッシュ・テキスト分割器はテナント間で共有する
+_shared_embeddings = {}
+_embedding_caches = {}
+_manifests = {}
+_shared_lock = threading.Lock()
+
+# 保存先ディレクトリごとの開いている RAGSystem の数（0になったらChromaのクライアントを停止する）
+_open_stores = Counter()
+
+# 取り込み中のファイルごとのロック -> 使用数（同じファイルの取り込みを直列にする。使われなくなったら外す）
+_ingest_locks = {}
+
+try:
+    from chromadb.api.client import SharedSystemClient
+except ImportError:
+    SharedSystemClient = None
+
+def _release_chroma(vectorstore):
+    """
+    Chromaのクライアントが保持するシステム（SQLite接続・インデックス）を停止し、chromadb のキャッシュから外す
+    （chromadb はディレクトリごとにシステムを使い回すため、停止しないとハンドルが開いたまま残る）
+    """
+    client = getattr(vectorstore, "_client", None)
+    system = getattr(client, "_system", None)
+    if system is None:
+        return
+    system.stop()
+    cache = getattr(SharedSystemClient, "_identifer_to_system", None)
+    identifier = getattr(client, "_identifier", None)
+    if isinstance(cache, dict) and identifier in cache:
+        del cache[identifier]
+
+def _get_embedding_cache(persist_directory: str) -> EmbeddingCache:
+    """保存先ディレクトリごとに共有する埋め込みキャッシュ（EMBEDDING_CACHE_PATH で場所を変更可）"""
+    db_path = os.getenv("EMBEDDING_CACHE_PATH") or os.path.join(persist_directory, "embedding_cache.db")
+    with _shared_lock:
+        cache = _embedding_caches.get(db_path)
+        if cache is None:
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+            cache = _embedding_caches[db_path] = EmbeddingCache(db_path)
+        return cache
+
+def _get_embeddings(backend_name: str, api_key: str, persist_directory: str) -> CachedEmbeddings:
+    """バックエンド（とAPIキー）ごとに共有する埋め込み（埋め込みキャッシュつき）"""
+    backend = get_backend(backend_name, api_key)
+    cache = _get_embedding_cache(persist_directory)
+    with _shared_lock:
+        key = (backend_name, api_key, cache.db_path)
+        embeddings = _shared_embeddings.get(key)
+        if embeddings is None:
+            embeddings = _shared_embeddings[key] = CachedEmbeddings(backend, cache, model=backend.model)
+        return embeddings
+
+def _get_manifest(persist_directory: str) -> ChunkManifest:
+    """保存先ディレクトリごとに共有するチャンクマニフェスト"""
+    db_path = os.path.join(persist_directory, "rag_manifest.db")
+    with _shared_lock:
+        manifest = _manifests.get(db_path)
+        if manifest is None:
+            os.makedirs(persist_directory, exist_ok=True)
+            manifest = _manifests[db_path] = ChunkManifest(db_path)
+        return manifest
+
+@contextmanager
+def _ingest_lock(persist_directory: str, user_id, file_key: str):
+    """
+    同じ保存先・テナント・ファイルの取り込みを直列にするロック
+    （並行して取り込むと、どちらもマニフェストに未登録と判断して同じチャンクを二重に書き込む）
+    """
+    key = (os.path.abspath(persist_directory), user_id, file_key)
+    with _shared_lock:
+        entry = _ingest_locks.get(key)
+        if entry is None:
+            entry = _ingest_locks[key] = [threading.Lock(), 0]
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _shared_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del _ingest_locks[key]
+
+def open_store_count() -> int:
+    """開いているChromaの保存先の数"""
+    with _shared_lock:
+        return len(_open_stores)
+
+def embedding_cache_stats() -> dict:
+    """埋め込みキャッシュの統計（保存先ごと）"""
+    with _shared_lock:
+        caches = dict(_embedding_caches)
+    return {db_path: cache.stats() for db_path, cache in caches.items()}
+
+_text_splitter = RecursiveCharacterTextSplitter(
+    chunk_size=500,
+    chunk_overlap=50,
+    separators=["\n\n", "\n", "。", "、", " "]
+)
+
 class RAGSystem:
-    def __init__(self, user_id, persist_directory="./chroma_db"):
+    @staticmethod
+    def store_root(persist_directory: str, embedding_backend: str) -> str:
+        """バックエンドの保存先（ベクトルの次元がバックエンドごとに違うため、openai 以外は別のディレクトリ）"""
+        if embedding_backend == BACKEND_OPENAI:
+            return persist_directory
+        return os.path.join(persist_directory, embedding_backend)
+    
+    @classmethod
+    def store_directory(cls, user_id, persist_directory="./chroma_db", embedding_backend: Optional[str] = None) -> str:
+        """テナントのChroma DBのディレクトリ"""
+        root = cls.store_root(persist_directory, embedding_backend or backend_name_for(user_id))
+        return f"{root}/user_{user_id}"
+    
+    def __init__(self, user_id, persist_directory="./chroma_db", embedding_backend: Optional[str] = None):
         """
         RAGシステム初期化
+        （リクエストごとに作らず、rag_registry.RAGRegistry で使い回すこと）
         
         Args:
             user_id: ユーザーID（マルチテナント対応）
             persist_directory: Chroma DBの保存先
+            embedding_backend: 'openai' / 'local'（省略時はテナントの設定、embedding_backends.backend_name_for）
         """
         self.user_id = user_id
+        self.embedding_backend = embedding_backend or backend_name_for(user_id)
+        persist_directory = self.store_root(persist_directory, self.embedding_backend)
         self.persist_directory = f"{persist_directory}/user_{user_id}"
         
-        # OpenAI Embeddings
-        self.embeddings = OpenAIEmbeddings(
-            model="text-embedding-3-small",
-            openai_api_key=os.getenv("OPENAI_API_KEY_DOCLING") or os.getenv("OPENAI_API_KEY")
-        )
+        # OpenAI クライアント（プロセス全体で共有、回答生成に使用）
+        self.api_key = os.getenv("OPENAI_API_KEY_DOCLING") or os.getenv("OPENAI_API_KEY")
+        self.client = get_openai_client(self.api_key) if self.api_key else None
+        
+        # 埋め込み（プロセス全体で共有、内容が同じチャンクはキャッシュから返す）
+        self.embeddings = _get_embeddings(self.embedding_backend, self.api_key, persist_directory)
+        
+        # ファイルごとのチャンクの記録（再登録時の差分計算に使用）
+        self.manifest = _get_manifest(persist_directory)
         
         # Chroma ベクトルDB
         self.vectorstore = Chroma(
             persist_directory=self.persist_directory,
             embedding_function=self.embeddings
         )
+        with _shared_lock:
+            _open_stores[self.persist_directory] += 1
         
-        # テキスト分割
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=500,
-            chunk_overlap=50,
-            separators=["\n\n", "\n", "。", "、", " "]
-        )
+        # テキスト分割（プロセス全体で共有）
+        self.text_splitter = _text_splitter
         
-        # OpenAI クライアント
-        self.client = openai.OpenAI(
-            api_key=os.getenv("OPENAI_API_KEY_DOCLING") or os.getenv("OPENAI_API_KEY")
-        )
+        # persist() をまとめて行う
+        self._writes = WriteBehind(self.vectorstore.persist, max_ops=PERSIST_EVERY_OPS,
+                                   max_seconds=PERSIST_INTERVAL, name=f"chroma user_{user_id}")
+    
+    def flush(self) -> bool:
+        """
+        未反映の追加・削除をすぐにベクトルDBへ書き出す（テスト・終了処理用）
+        
+        Returns:
+            bool: 書き出したか（未反映の操作がなければFalse）
+        """
+        return self._writes.flush()
+    
+    def close(self):
+        """
+        未反映の操作を書き出してChromaのハンドルを閉じる（レジストリから外されたときに呼ばれる）
+        同じディレクトリを開いた別のインスタンス（作り直した後も使用中だった古いインスタンスなど）が
+        残っている間はクライアントを共有しているので、最後のインスタンスを閉じたときに停止する
+        """
+        if self.vectorstore is None:
+            return
+        self.flush()
+        vectorstore, self.vectorstore = self.vectorstore, None
+        with _shared_lock:
+            _open_stores[self.persist_directory] -= 1
+            last = _open_stores[self.persist_directory] <= 0
+            if last:
+                del _open_stores[self.persist_directory]
+        if last:
+            try:
+                _release_chroma(vectorstore)
+            except Exception as e:
+                logger.warning(f"Failed to stop Chroma client for {self.persist_directory}: {e}")
     
     def add_document(self, markdown_text: str, metadata: Dict):
         """
@@ -62,27 +235,184 @@ class RAGSystem:
         Returns:
             int: 追加されたチャンク数
         """
+        return self.ingest(markdown_text, metadata)["chunks"]
+    
+    @staticmethod
+    def _file_key(metadata: Dict) -> str:
+        """マニフェストでファイルを識別するキー（file_id、なければファイル名）"""
+        return str(metadata.get("file_id", metadata.get("filename", "")))
+    
+    def _chunk_id(self, file_key: str, chunk_hash: str, used: set) -> str:
+        """
+        チャンクの決定的なID（同じファイル・同じ内容なら常に同じ）
+        同じ内容のチャンクが複数ある場合は使われていない連番をつける
+        """
+        number = 0
+        while True:
+            vector_id = f"{self.user_id}:{file_key}:{chunk_hash[:16]}:{number}"
+            if vector_id not in used:
+                used.add(vector_id)
+                return vector_id
+            number += 1
+    
+    @staticmethod
+    def _batches(indexes: List[int], chunks: List[str], max_chunks: int, max_tokens: int) -> List[List[int]]:
+        """チャンクを件数とトークン数の上限でバッチに分ける"""
+        batches, batch, tokens = [], [], 0
+        for index in indexes:
+            cost = estimate_embedding_tokens(chunks[index])
+            if batch and (len(batch) >= max_chunks or tokens + cost > max_tokens):
+                batches.append(batch)
+                batch, tokens = [], 0
+            batch.append(index)
+            tokens += cost
+        if batch:
+            batches.append(batch)
+        return batches
+    
+    def ingest(self, markdown_text: str, metadata: Dict, progress: Optional[Callable[[int, int], None]] = None,
+               batch_chunks: int = None, batch_tokens: int = None, concurrency: int = None) -> Dict:
+        """
+        ドキュメントをRAGシステムに追加（登録済みのファイルなら差分だけ更新）し、処理内容を返す
+        
+        新しいチャンク列をファイルのマニフェストと比べ、内容が同じチャンクはそのまま残し、
+        追加されたチャンクだけを埋め込み、なくなったチャンクだけをベクトルDBから消す。
+        追加分はバッチに分けて並列に埋め込み、バッチごとにベクトルDBとマニフェストへ書き込むので、
+        途中で失敗しても同じドキュメントを再度渡せば書き込み済みのバッチを飛ばして続きから取り込む
+        （古いチャンクの削除は追加がすべて終わってから行う）。
+        同じファイルの取り込みが並行した場合は、先に始めたものが終わるまで待ってから差分をとる。
+        
+        Args:
+            markdown_text: Markdown形式のテキスト
+            metadata: メタデータ（filename, file_id, etc.）
+            progress: バッチを書き込むたびに (書き込み済みチャンク数, 全チャンク数) で呼ばれる関数
+            batch_chunks: 1バッチの最大チャンク数（省略時は RAG_EMBED_BATCH_CHUNKS）
+            batch_tokens: 1バッチの最大トークン数（省略時は RAG_EMBED_BATCH_TOKENS）
+            concurrency: 同時に埋め込むバッチ数（省略時は RAG_EMBED_CONCURRENCY）
+        
+        Returns:
+            dict: {
+                'chunks': チャンク数,
+                'added': 埋め込んで書き込んだチャンク数,
+                'skipped': 登録済みで変わらなかったチャンク数,
+                'removed': 削除したチャンク数,
+                'batches': 書き込んだバッチ数,
+                'seconds': 所要時間,
+                'chunks_per_sec': 処理速度（追加したチャンク数 / 秒）,
+                'embedding': 埋め込みキャッシュのレポート（hits, misses, hit_ratio, saved_usd など）
+            }
+        """
+        with _ingest_lock(self.persist_directory, self.user_id, self._file_key(metadata)):
+            return self._ingest(markdown_text, metadata, progress, batch_chunks, batch_tokens, concurrency)
+    
+    def _ingest(self, markdown_text: str, metadata: Dict, progress: Optional[Callable[[int, int], None]],
+                batch_chunks: Optional[int], batch_tokens: Optional[int], concurrency: Optional[int]) -> Dict:
+        """ingest の本体（同じファイルのロックを取った状態で呼ぶ）"""
+        started = time.perf_counter()
+        label = metadata.get("filename", "")
+        file_key = self._file_key(metadata)
+        
         # チャンク分割
         chunks = self.text_splitter.split_text(markdown_text)
+        hashes = [content_hash(chunk) for chunk in chunks]
+        metadatas = [
+            {
+                **metadata,
+                "user_id": self.user_id,
+                "chunk_index": i
+            }
+            for i in range(len(chunks))
+        ]
         
-        # Document オブジェクト作成
-        documents = [
-            Document(
-                page_content=chunk,
-                metadata={
-                    **metadata,
-                    "user_id": self.user_id,
-                    "chunk_index": i
-                }
+        # マニフェスト導入前からのファイルも一覧に残るよう、テナントの最初の取り込みで記録しておく
+        if not self.manifest.files(self.user_id):
+            self._backfill_files()
+        
+        # マニフェストとの差分
+        old = self.manifest.chunks(self.user_id, file_key)
+        if not old and metadata.get("file_id") is not None:
+            # マニフェスト導入前に登録されたチャンクは差分をとれないので入れ替える
+            self.vectorstore._collection.delete(
+                where={"$and": [{"user_id": self.user_id}, {"file_id": metadata["file_id"]}]}
             )
-            for i, chunk in enumerate(chunks)
-        ]
+        diff = diff_chunks(old, hashes)
+        used = set(diff["keep"].values()) | set(diff["remove"])
+        ids = {index: self._chunk_id(file_key, hashes[index], used) for index in diff["add"]}
         
-        # ベクトルDBに保存
-        self.vectorstore.add_documents(documents)
-        self.vectorstore.persist()
+        # 位置だけ変わったチャンクはメタデータのチャンク番号を直す（埋め込みは不要）
+        if diff["moved"]:
+            moved_ids = list(diff["moved"])
+            self.vectorstore._collection.update(
+                ids=moved_ids,
+                metadatas=[metadatas[diff["moved"][vector_id]] for vector_id in moved_ids]
+            )
+            self.manifest.move(self.user_id, file_key, diff["moved"])
         
-        return len(chunks)
+        batches = self._batches(diff["add"], chunks, batch_chunks or EMBED_BATCH_CHUNKS,
+                                batch_tokens or EMBED_BATCH_TOKENS)
+        
+        # 埋め込みは並列、ベクトルDBとマニフェストへの書き込みはこのスレッドでバッチごとに行う
+        report = self.embeddings.new_report(label)
+        committed = len(diff["keep"])
+        written = 0
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, concurrency or EMBED_CONCURRENCY),
+                                    thread_name_prefix="rag-embed") as pool:
+                futures = {
+                    pool.submit(self.embeddings.embed_batch, [chunks[i] for i in batch], report): batch
+                    for batch in batches
+                }
+                try:
+                    for future in as_completed(futures):
+                        batch = futures[future]
+                        vectors = future.result()
+                        self.vectorstore._collection.upsert(
+                            ids=[ids[i] for i in batch],
+                            embeddings=vectors,
+                            documents=[chunks[i] for i in batch],
+                            metadatas=[metadatas[i] for i in batch]
+                        )
+                        self.manifest.add(self.user_id, file_key, [(hashes[i], ids[i], i) for i in batch])
+                        committed += len(batch)
+                        written += 1
+                        if progress:
+                            progress(committed, len(chunks))
+                except Exception:
+                    for future in futures:
+                        future.cancel()
+                    raise
+        except Exception as e:
+            logger.error(f"Ingestion of {label} stopped at {committed}/{len(chunks)} chunks "
+                         f"(re-run to resume): {e}")
+            if written or diff["moved"]:
+                self._writes.mark()
+            raise
+        finally:
+            self.embeddings.finish_report(report)
+        
+        # なくなったチャンクを削除
+        if diff["remove"]:
+            self.vectorstore.delete(ids=diff["remove"])
+            self.manifest.remove(self.user_id, diff["remove"])
+        self.manifest.set_file(self.user_id, file_key, label, len(chunks))
+        self._writes.mark()
+        self.manifest.record(len(diff["add"]), len(diff["keep"]), len(diff["remove"]))
+        
+        seconds = time.perf_counter() - started
+        chunks_per_sec = round(len(diff["add"]) / seconds, 1) if seconds > 0 else 0.0
+        logger.info(f"Ingested {label}: {len(diff['add'])} chunks added in {written} batches, "
+                    f"{len(diff['keep'])} unchanged, {len(diff['remove'])} removed, {chunks_per_sec} chunks/sec")
+        
+        return {
+            "chunks": len(chunks),
+            "added": len(diff["add"]),
+            "skipped": len(diff["keep"]),
+            "removed": len(diff["remove"]),
+            "batches": written,
+            "seconds": round(seconds, 3),
+            "chunks_per_sec": chunks_per_sec,
+            "embedding": report
+        }
     
     def search(self, query: str, top_k: int = 5) -> List[Document]:
         """
@@ -104,19 +434,69 @@ class RAGSystem:
         
         return results
     
-    def qa(self, question: str, top_k: int = 5) -> Dict:
+    # 回答生成の指示（全ての質問で同じ文字列にして、プロバイダー側のプロンプトキャッシュに載せる）
+    SYSTEM_PROMPT = """与えられたコンテキストの情報を元に質問に答えてください。
+
+【回答形式】
+1. 質問に対する明確な回答
+2. 回答の根拠となるドキュメント名
+3. 該当箇所の引用（簡潔に）
+
+回答は簡潔に、正確に。"""
+    
+    @classmethod
+    def _build_messages(cls, question: str, docs: List[Document]) -> List[Dict]:
+        """
+        検索結果から回答生成用のメッセージを作成
+        固定の指示を先頭に、検索結果を文書内の順序で並べ、質問を最後に置く
+        （同じ検索結果なら質問の直前までが同じ文字列になる）
+        """
+        ordered = sorted(docs, key=lambda doc: (str(doc.metadata.get('file_id', doc.metadata.get('filename', ''))),
+                                                doc.metadata.get('chunk_index', 0)))
+        # コンテキスト作成
+        context = "\n\n".join([
+            f"[ドキュメント {i+1}]\n"
+            f"ファイル名: {doc.metadata.get('filename', '不明')}\n"
+            f"内容:\n{doc.page_content}"
+            for i, doc in enumerate(ordered)
+        ])
+        
+        return [
+            {"role": "system", "content": cls.SYSTEM_PROMPT},
+            {"role": "user", "content": f"""【コンテキスト】
+{context}
+
+【質問】
+{question}"""},
+        ]
+    
+    @staticmethod
+    def _sources(docs: List[Document]) -> List[Dict]:
+        """ソース情報"""
+        return [
+            {
+                "filename": doc.metadata.get('filename', '不明'),
+                "chunk": doc.page_content[:100] + "..."
+            }
+            for doc in docs
+        ]
+    
+    def qa(self, question: str, top_k: int = 5, model: str = "gpt-4o", max_tokens: int = 1024) -> Dict:
         """
         質疑応答
         
         Args:
             question: 質問
             top_k: 検索する関連ドキュメント数
+            model: 回答に使うモデル
+            max_tokens: 回答の最大トークン数
         
         Returns:
             dict: {
                 'answer': 回答,
                 'sources': ソース情報,
-                'cost': コスト
+                'cost': コスト,
+                'usage': トークン数
             }
         """
         # 関連ドキュメント検索
@@ -126,101 +506,124 @@ class RAGSystem:
             return {
                 "answer": "関連する情報が見つかりませんでした。",
                 "sources": [],
-                "cost": 0
+                "cost": 0,
+                "usage": None
             }
         
-        # コンテキスト作成
-        context = "\n\n".join([
-            f"[ドキュメント {i+1}]\n"
-            f"ファイル名: {doc.metadata.get('filename', '不明')}\n"
-            f"内容:\n{doc.page_content}"
-            for i, doc in enumerate(docs)
-        ])
-        
-        # GPT-4oで回答生成
-        prompt = f"""以下の情報を元に質問に答えてください。
-
-【コンテキスト】
-{context}
-
-【質問】
-{question}
-
-【回答形式】
-1. 質問に対する明確な回答
-2. 回答の根拠となるドキュメント名
-3. 該当箇所の引用（簡潔に）
-
-回答は簡潔に、正確に。"""
-        
-        response = self.client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=1024
+        # 回答生成（同時実行数の制限・リトライはLLMゲートウェイで行う）
+        response = get_gateway().chat(
+            self.api_key,
+            model=model,
+            messages=self._build_messages(question, docs),
+            max_tokens=max_tokens
         )
         
         answer = response.choices[0].message.content
-        
-        # コスト計算
-        cost = (response.usage.prompt_tokens / 1_000_000 * 2.5) + \
-               (response.usage.completion_tokens / 1_000_000 * 10)
-        
-        # ソース情報
-        sources = [
-            {
-                "filename": doc.metadata.get('filename', '不明'),
-                "chunk": doc.page_content[:100] + "..."
-            }
-            for doc in docs
-        ]
+        usage = {
+            "prompt_tokens": response.usage.prompt_tokens,
+            "completion_tokens": response.usage.completion_tokens,
+            "cached_tokens": cached_prompt_tokens(response.usage)
+        }
+        cost = estimate_cost(model, usage["prompt_tokens"], usage["completion_tokens"], usage["cached_tokens"])
         
         return {
             "answer": answer,
-            "sources": sources,
-            "cost": round(cost, 4)
+            "sources": self._sources(docs),
+            "cost": round(cost, 4),
+            "usage": usage
         }
     
-    def get_all_documents(self) -> List[str]:
+    def qa_stream(self, question: str, top_k: int = 5, model: str = "gpt-4o",
+                  max_tokens: int = 1024) -> Iterator[Dict]:
         """
-        登録されている全ドキュメントのファイル名を取得
+        質疑応答（ストリーミング）
+        検索結果のソース情報を最初に返し、続いて回答を受信した順に返す
+        
+        Args:
+            question: 質問
+            top_k: 検索する関連ドキュメント数
+            model: 回答に使うモデル
+            max_tokens: 回答の最大トークン数
+        
+        Yields:
+            dict: {'type': 'sources', 'sources': ソース情報}
+                  {'type': 'token', 'text': 回答の断片}（複数回）
+                  {'type': 'done', 'answer': 回答全体, 'cost': コスト, 'usage': トークン数}
         """
-        # Chromaから全メタデータを取得
-        all_docs = self.vectorstore.get()
+        # 関連ドキュメント検索
+        docs = self.search(question, top_k=top_k)
+        yield {"type": "sources", "sources": self._sources(docs)}
         
-        if not all_docs or 'metadatas' not in all_docs:
-            return []
+        if not docs:
+            answer = "関連する情報が見つかりませんでした。"
+            yield {"type": "token", "text": answer}
+            yield {"type": "done", "answer": answer, "cost": 0, "usage": None}
+            return
         
-        # ユニークなファイル名を抽出
-        filenames = set()
-        for metadata in all_docs['metadatas']:
-            if metadata.get('user_id') == self.user_id:
-                filename = metadata.get('filename')
-                if filename:
-                    filenames.add(filename)
+        # 最後のチャンクで使用トークン数を受け取る（stream_options.include_usage）
+        parts = []
+        usage = None
+        for chunk in get_gateway().stream(
+            self.api_key,
+            model=model,
+            messages=self._build_messages(question, docs),
+            max_tokens=max_tokens,
+            extra_body={"stream_options": {"include_usage": True}}
+        ):
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+                yield {"type": "token", "text": chunk.choices[0].delta.content}
+            chunk_usage = getattr(chunk, 'usage', None)
+            if chunk_usage:
+                usage = chunk_usage if isinstance(chunk_usage, dict) else chunk_usage.model_dump()
         
-        return sorted(list(filenames))
+        # 使用量チャンクが返らなかった場合はコスト不明（None）
+        cost = round(estimate_cost(model, usage['prompt_tokens'], usage['completion_tokens'],
+                                   cached_prompt_tokens(usage)), 4) if usage else None
+        yield {"type": "done", "answer": "".join(parts), "cost": cost, "usage": usage}
+    
+    def get_all_documents(self) -> List[str]:
+        """
+        登録されている全ドキュメントのファイル名を取得（マニフェストから、ファイル数に比例）
+        """
+        files = self.manifest.files(self.user_id)
+        if not files:
+            files = self._backfill_files()
+        return sorted({file["filename"] for file in files})
+    
+    def _backfill_files(self) -> List[Dict]:
+        """
+        マニフェスト導入前に登録されたテナントのファイル一覧をベクトルDBから作って記録する
+        （このテナントのメタデータだけを取得する）
+        """
+        found = self.vectorstore.get(where={"user_id": self.user_id}, include=["metadatas"])
+        counts, names = {}, {}
+        for metadata in found.get("metadatas") or []:
+            filename = metadata.get("filename")
+            if not filename:
+                continue
+            file_key = self._file_key(metadata)
+            counts[file_key] = counts.get(file_key, 0) + 1
+            names[file_key] = filename
+        for file_key, count in counts.items():
+            self.manifest.set_file(self.user_id, file_key, names[file_key], count)
+        return [{"file_key": file_key, "filename": names[file_key], "chunk_count": count}
+                for file_key, count in counts.items()]
     
     def delete_document(self, filename: str):
         """
-        特定のドキュメントを削除
+        特定のドキュメントを削除（このテナントのこのファイル名のチャンクだけを対象にする）
         
         Args:
             filename: 削除するファイル名
         """
         # Chromaから該当ドキュメントを削除
-        all_docs = self.vectorstore.get()
-        
-        if not all_docs or 'ids' not in all_docs:
-            return
-        
-        ids_to_delete = []
-        for i, metadata in enumerate(all_docs['metadatas']):
-            if metadata.get('user_id') == self.user_id and metadata.get('filename') == filename:
-                ids_to_delete.append(all_docs['ids'][i])
-        
-        if ids_to_delete:
-            self.vectorstore.delete(ids=ids_to_delete)
-            self.vectorstore.persist()
+        self.vectorstore._collection.delete(
+            where={"$and": [{"user_id": self.user_id}, {"filename": filename}]}
+        )
+        for file_key in self.manifest.file_keys(self.user_id, filename):
+            self.manifest.remove_file(self.user_id, file_key)
+        self._writes.mark()
 
 # 使用例
 if __name__ == "__main__":
@@ -40,15 +40,21 @@ class SafeCustomerBot:
             'wait': '\n\nただいま確認いたしますので、少々お待ちください。'
         }
     
-    def safe_response(self, user_message: str) -> str:
-        """安全な応答を生成"""
+    def safe_response(self, user_message: str, results: List[Tuple[str, str, float]] = None) -> str:
+        """安全な応答を生成
+        
+        Args:
+            user_message: ユーザーのメッセージ
+            results: 検索済みの結果 [(doc_id, 抜粋, スコア)]（省略時は内蔵の検索エンジンで検索）
+        """
         try:
             # 緊急チェック
             if self.is_emergency(user_message):
                 return self._emergency_response()
             
             # 検索実行
-            results = self.search_engine.search(user_message, limit=3)
+            if results is None:
+                results = self.search_engine.search(user_message, limit=3)
             
             if results:
                 return self._found_response(results)
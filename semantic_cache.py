@@ -0,0 +1,269 @@
+"""
+セマンティック回答キャッシュ
+回答済みの質問を埋め込みベクトルにしてテナントごとに保持し、
+言い回しが違うだけの質問（コサイン類似度がしきい値以上）にはOpenAIを呼ばずにキャッシュから回答する
+- 埋め込み: OpenAI text-embedding-3-small（RAGSystemと同じモデル）またはローカルのハッシュ埋め込み
+  embed_query(text) を持つオブジェクトなら差し替え可能（LangChainのEmbeddingsも可）
+- 近傍検索: テナントごとの正規化済み行列との内積（NumPy）
+- ドキュメントバージョンが変わったテナントのエントリは破棄
+"""
+
+import hashlib
+import logging
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class OpenAIQueryEmbedder:
+    """OpenAI Embeddings API による質問の埋め込み"""
+
+    def __init__(self, client, model: str = 'text-embedding-3-small', timeout: Optional[float] = None,
+                 max_retries: Optional[int] = None):
+        """
+        Args:
+            client: openai.OpenAI クライアント
+            model: 埋め込みモデル
+            timeout: 1回の呼び出しの最大秒数（省略時はクライアントの設定）
+            max_retries: SDKのリトライ回数（省略時はクライアントの設定）
+        """
+        options = {}
+        if timeout is not None:
+            options['timeout'] = timeout
+        if max_retries is not None:
+            options['max_retries'] = max_retries
+        # 共有クライアントの接続プールはそのまま使う
+        self.client = client.with_options(**options) if options else client
+        self.model = model
+
+    def embed_query(self, text: str) -> List[float]:
+        response = self.client.embeddings.create(input=[text], model=self.model)
+        return response.data[0].embedding
+
+
+class LocalHashEmbedder:
+    """文字n-gramのハッシュによるローカル埋め込み（API呼び出しなし）"""
+
+    def __init__(self, dim: int = 512, ngram_range=(1, 3)):
+        """
+        Args:
+            dim: ベクトルの次元数
+            ngram_range: 使用する文字n-gramの長さの範囲
+        """
+        self.dim = dim
+        self.ngram_range = ngram_range
+
+    def embed_query(self, text: str) -> List[float]:
+        text = unicodedata.normalize('NFKC', text or '').lower()
+        text = ''.join(ch for ch in text if unicodedata.category(ch)[0] not in 'PZC')
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for n in range(self.ngram_range[0], self.ngram_range[1] + 1):
+            for i in range(len(text) - n + 1):
+                digest = hashlib.blake2b(text[i:i + n].encode('utf-8'), digest_size=8).digest()
+                bucket = int.from_bytes(digest[:4], 'little') % self.dim
+                sign = 1.0 if digest[4] & 1 else -1.0
+                vector[bucket] += sign * n
+        return vector.tolist()
+
+
+class _TenantVectors:
+    """1テナント分の質問ベクトルと回答"""
+
+    def __init__(self, version, dim: int):
+        self.version = version
+        self.matrix = np.zeros((0, dim), dtype=np.float32)
+        self.languages = np.zeros(0, dtype=object)
+        self.expires_at = np.zeros(0, dtype=np.float64)
+        self.questions = []
+        self.answers = []
+
+
+class SemanticAnswerCache:
+    """質問の埋め込みの類似度による回答キャッシュ"""
+
+    def __init__(self, embedder, threshold: float = 0.92, max_per_tenant: int = 500,
+                 ttl: float = 86400.0, max_tenants: int = 1000):
+        """
+        キャッシュ初期化
+
+        Args:
+            embedder: embed_query(text) を持つ埋め込みオブジェクト
+            threshold: キャッシュから回答するコサイン類似度の下限
+            max_per_tenant: テナントごとに保持する最大件数（超過時は古いものから削除）
+            ttl: 回答の有効期間（秒）
+            max_tenants: 保持する最大テナント数（超過時は最も古く使われたテナントから削除）
+        """
+        self.embedder = embedder
+        self.threshold = threshold
+        self.max_per_tenant = max_per_tenant
+        self.ttl = ttl
+        self.max_tenants = max_tenants
+
+        self._tenants = OrderedDict()  # user_id -> _TenantVectors
+        self._vectors = OrderedDict()  # 質問文 -> 正規化済みベクトル（検索と保存で埋め込みを使い回す）
+        self._lock = threading.Lock()
+        self._stats = {
+            'lookups': 0,
+            'hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'embed_calls': 0,
+            'embed_errors': 0,
+            'embed_ms_total': 0.0,
+        }
+
+    def _embed(self, text: str) -> Optional[np.ndarray]:
+        """質問文を正規化済みベクトルに変換（直近の質問は再計算しない）"""
+        with self._lock:
+            vector = self._vectors.get(text)
+            if vector is not None:
+                self._vectors.move_to_end(text)
+                return vector
+
+        started = time.perf_counter()
+        try:
+            vector = np.asarray(self.embedder.embed_query(text), dtype=np.float32)
+        except Exception as e:
+            logger.warning(f"Question embedding failed: {e}")
+            with self._lock:
+                self._stats['embed_errors'] += 1
+            return None
+
+        norm = float(np.linalg.norm(vector))
+        if norm == 0.0:
+            return None
+        vector /= norm
+
+        with self._lock:
+            self._stats['embed_calls'] += 1
+            self._stats['embed_ms_total'] += (time.perf_counter() - started) * 1000
+            self._vectors[text] = vector
+            while len(self._vectors) > 256:
+                self._vectors.popitem(last=False)
+        return vector
+
+    def _tenant(self, user_id, version, dim: int, create: bool) -> Optional[_TenantVectors]:
+        tenant = self._tenants.get(user_id)
+        if tenant is not None and (tenant.version != version or tenant.matrix.shape[1] != dim):
+            # ドキュメントが変わった（または埋め込みの次元が変わった）テナントは作り直す
+            del self._tenants[user_id]
+            tenant = None
+        if tenant is None and create:
+            tenant = self._tenants[user_id] = _TenantVectors(version, dim)
+            while len(self._tenants) > self.max_tenants:
+                self._tenants.popitem(last=False)
+        if tenant is not None:
+            self._tenants.move_to_end(user_id)
+        return tenant
+
+    def lookup(self, user_id, language: str, question: str, version) -> Optional[Dict]:
+        """
+        類似した質問の回答を検索
+
+        Args:
+            user_id: テナント（ユーザー）ID
+            language: 回答言語
+            question: 質問文
+            version: テナントのドキュメントバージョン
+
+        Returns:
+            dict: answer, similarity, question（一致した質問）。しきい値未満ならNone
+        """
+        # 比較対象がなくても、保存時に使い回すため埋め込みは計算しておく
+        vector = self._embed(question)
+        now = time.time()
+        with self._lock:
+            self._stats['lookups'] += 1
+            tenant = self._tenant(user_id, version, len(vector), create=False) if vector is not None else None
+            if tenant is None or not tenant.answers:
+                self._stats['misses'] += 1
+                return None
+
+            similarities = tenant.matrix @ vector
+            mask = (tenant.languages == language) & (tenant.expires_at > now)
+            similarities = np.where(mask, similarities, -1.0)
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+
+            if similarity < self.threshold:
+                self._stats['misses'] += 1
+                return None
+
+            self._stats['hits'] += 1
+            return {
+                'answer': tenant.answers[best],
+                'similarity': round(similarity, 4),
+                'question': tenant.questions[best],
+            }
+
+    def store(self, user_id, language: str, question: str, version, answer: str):
+        """
+        回答済みの質問を保存
+
+        Args:
+            user_id: テナント（ユーザー）ID
+            language: 回答言語
+            question: 質問文
+            version: 回答生成時のドキュメントバージョン
+            answer: AI回答
+        """
+        if not answer:
+            return
+        vector = self._embed(question)
+        if vector is None:
+            return
+
+        with self._lock:
+            tenant = self._tenant(user_id, version, len(vector), create=True)
+            tenant.matrix = np.vstack([tenant.matrix, vector[np.newaxis, :]])
+            tenant.languages = np.append(tenant.languages, np.array([language], dtype=object))
+            tenant.expires_at = np.append(tenant.expires_at, time.time() + self.ttl)
+            tenant.questions.append(question)
+            tenant.answers.append(answer)
+
+            overflow = len(tenant.answers) - self.max_per_tenant
+            if overflow > 0:
+                tenant.matrix = tenant.matrix[overflow:]
+                tenant.languages = tenant.languages[overflow:]
+                tenant.expires_at = tenant.expires_at[overflow:]
+                del tenant.questions[:overflow]
+                del tenant.answers[:overflow]
+            self._stats['stores'] += 1
+
+    def invalidate(self, user_id=None):
+        """
+        テナントのエントリを破棄（ファイルのアップロード・削除時に呼ぶ）
+
+        Args:
+            user_id: テナント（ユーザー）ID（省略時は全件）
+        """
+        with self._lock:
+            if user_id is None:
+                self._tenants.clear()
+            else:
+                self._tenants.pop(user_id, None)
+
+    def stats(self) -> Dict:
+        """統計情報を取得"""
+        with self._lock:
+            lookups = self._stats['lookups']
+            embed_calls = self._stats['embed_calls']
+            return {
+                'lookups': lookups,
+                'hits': self._stats['hits'],
+                'misses': self._stats['misses'],
+                'hit_rate': round(self._stats['hits'] / lookups * 100, 1) if lookups else 0.0,
+                'stores': self._stats['stores'],
+                'embed_calls': embed_calls,
+                'embed_errors': self._stats['embed_errors'],
+                'embed_ms_avg': round(self._stats['embed_ms_total'] / embed_calls, 1) if embed_calls else 0.0,
+                'tenants': len(self._tenants),
+                'entries': sum(len(tenant.answers) for tenant in self._tenants.values()),
+                'threshold': self.threshold,
+            }
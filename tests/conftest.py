@@ -0,0 +1,22 @@
+import os
+import sys
+
+# モジュールはリポジトリ直下に置かれている
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import importlib
+
+import pytest
+
+
+@pytest.fixture(scope='session')
+def main_module(tmp_path_factory):
+    """main.py を一時ディレクトリで読み込む（DB・app.log をリポジトリに作らない）"""
+    workdir = tmp_path_factory.mktemp('main')
+    previous = os.getcwd()
+    os.environ['DATABASE_PATH'] = str(workdir / 'manual_bot.db')
+    os.chdir(workdir)
+    try:
+        return importlib.import_module('main')
+    finally:
+        os.chdir(previous)
@@ -0,0 +1,19 @@
+"""normalize_question: 表記ゆれの統一と数字の区別"""
+
+from answer_cache import normalize_question
+
+
+def test_unifies_width_case_and_punctuation():
+    assert normalize_question('チェックインは何時？') == normalize_question('ﾁｪｯｸｲﾝは何時?')
+    assert normalize_question('Wi-Fi の パスワード') == normalize_question('wifiのパスワード')
+
+
+def test_keeps_separators_inside_numbers():
+    assert normalize_question('3.5階') != normalize_question('35階')
+    assert normalize_question('10:30に行きます') != normalize_question('1030に行きます')
+    assert normalize_question('１０：３０') == normalize_question('10:30')
+    assert normalize_question('302 303号室') != normalize_question('302303号室')
+
+
+def test_drops_punctuation_next_to_numbers():
+    assert normalize_question('…10時。') == normalize_question('10時')
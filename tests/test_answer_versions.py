@@ -0,0 +1,77 @@
+"""生成中にドキュメントバージョンが上がっても、回答は生成に使ったバージョンで保存される"""
+
+import types
+
+import pytest
+
+
+class RecordingCache:
+    def __init__(self):
+        self.stored = []
+
+    def put(self, user_id, language, query, version, answer):
+        self.stored.append(version)
+
+    def store(self, user_id, language, query, version, answer):
+        self.stored.append(version)
+
+
+class Versions:
+    def __init__(self):
+        self.version = 1
+
+    def get(self, user_id):
+        return self.version
+
+    def bump(self, user_id):
+        self.version += 1
+        return self.version
+
+
+@pytest.fixture
+def app(main_module, monkeypatch):
+    versions = Versions()
+    answers, semantic = RecordingCache(), RecordingCache()
+    monkeypatch.setattr(main_module, 'document_versions', versions)
+    monkeypatch.setattr(main_module, 'answer_cache', answers)
+    monkeypatch.setattr(main_module, 'semantic_cache', semantic)
+    monkeypatch.setattr(main_module, 'OPENAI_API_KEY', 'sk-test')
+
+    class Gateway:
+        def chat(self, api_key, **kwargs):
+            # ファイルのアップロードが生成中に完了する
+            versions.bump(1)
+            message = types.SimpleNamespace(content='15時からです')
+            return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)], usage=None)
+
+    monkeypatch.setattr(main_module, 'get_llm_gateway', lambda: Gateway())
+    return main_module, versions, answers, semantic
+
+
+def test_answer_is_stored_under_the_version_it_was_built_from(app):
+    main, versions, answers, semantic = app
+    route = main.model_router.route('チェックインは何時？', None)
+
+    answer = main.generate_ai_response('チェックインは何時？', 'マニュアル', 'ja', user_id=1, route=route,
+                                       document_version=versions.get(1))
+
+    assert answer == '15時からです'
+    assert versions.get(1) == 2
+    assert answers.stored == [1] and semantic.stored == [1]
+
+
+def test_pipeline_carries_the_version_read_before_retrieval(app, monkeypatch):
+    main, versions, answers, semantic = app
+    monkeypatch.setattr(main, 'semantic_cache', None)
+    monkeypatch.setattr(main, 'build_system_prompt', lambda *args, **kwargs: 'マニュアル')
+    ctx = types.SimpleNamespace(user_id=1, language='ja', message_text='チェックインは何時？', response=None,
+                                route=main.model_router.route('チェックインは何時？', None), fallback=False,
+                                cache_hit=None, document_version=None)
+
+    answers.get = lambda *args: None
+    main.stage_answer_cache(ctx)
+    main.stage_retrieve(ctx)
+    main.stage_generate(ctx)
+
+    assert ctx.response == '15時からです'
+    assert answers.stored == [1]
@@ -0,0 +1,65 @@
+"""LineAccountResolver: キャッシュと検索中の無効化"""
+
+from line_account_cache import LineAccountResolver
+
+
+def test_caches_positive_and_negative_results():
+    calls = []
+    links = {'U1': 7}
+
+    def lookup(line_user_id):
+        calls.append(line_user_id)
+        return links.get(line_user_id)
+
+    resolver = LineAccountResolver(lookup)
+    assert resolver.resolve('U1') == 7
+    assert resolver.resolve('U1') == 7
+    assert resolver.resolve('U2') is None
+    assert resolver.resolve('U2') is None
+    assert calls == ['U1', 'U2']
+    assert resolver.stats()['negative_hits'] == 1
+
+
+def test_invalidate_during_lookup_drops_stale_result():
+    links = {}
+    resolver = None
+
+    def lookup(line_user_id):
+        result = links.get(line_user_id)
+        # 検索結果を読んだ直後に連携が作成され、無効化される
+        links[line_user_id] = 7
+        resolver.invalidate(line_user_id)
+        return result
+
+    resolver = LineAccountResolver(lookup)
+    assert resolver.resolve('U1') is None
+    assert resolver.stats()['size'] == 0
+    assert resolver.resolve('U1') == 7
+
+
+def test_clear_during_lookup_drops_stale_result():
+    links = {}
+    resolver = None
+
+    def lookup(line_user_id):
+        result = links.get(line_user_id)
+        links[line_user_id] = 7
+        resolver.invalidate()
+        return result
+
+    resolver = LineAccountResolver(lookup)
+    assert resolver.resolve('U1') is None
+    assert resolver.stats()['size'] == 0
+
+
+def test_invalidating_another_key_keeps_result():
+    resolver = None
+
+    def lookup(line_user_id):
+        resolver.invalidate('U2')
+        return 7
+
+    resolver = LineAccountResolver(lookup)
+    assert resolver.resolve('U1') == 7
+    assert resolver.stats()['size'] == 1
+    assert resolver._invalidated_at == {} and not resolver._lookups
@@ -0,0 +1,203 @@
+"""RAGSystem.ingest: 差分の取り込み・チャンクIDの割り当て・失敗後の再実行"""
+
+import threading
+import time
+from collections import Counter
+
+import pytest
+
+from embedding_backends import LocalHashEmbeddingBackend
+from embedding_cache import CachedEmbeddings, EmbeddingCache
+from rag_manifest import ChunkManifest
+from write_behind import WriteBehind
+
+rag_system = pytest.importorskip('rag_system', reason='langchain / langchain_community are not installed')
+
+
+class FakeCollection:
+    """Chromaのコレクションのうち ingest が使う操作だけ"""
+
+    def __init__(self):
+        self.rows = {}  # id -> (document, metadata)
+        self.fail_upserts_after = None
+
+    @staticmethod
+    def _match(metadata, where):
+        if '$and' in where:
+            return all(FakeCollection._match(metadata, item) for item in where['$and'])
+        return all(metadata.get(key) == value for key, value in where.items())
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        if self.fail_upserts_after is not None:
+            if self.fail_upserts_after == 0:
+                raise RuntimeError('vector store unavailable')
+            self.fail_upserts_after -= 1
+        for vector_id, document, metadata in zip(ids, documents, metadatas):
+            self.rows[vector_id] = (document, metadata)
+
+    def update(self, ids, metadatas):
+        for vector_id, metadata in zip(ids, metadatas):
+            self.rows[vector_id] = (self.rows[vector_id][0], metadata)
+
+    def delete(self, ids=None, where=None):
+        for vector_id in list(self.rows):
+            if (ids and vector_id in ids) or (where and self._match(self.rows[vector_id][1], where)):
+                del self.rows[vector_id]
+
+
+class FakeVectorStore:
+    def __init__(self):
+        self._collection = FakeCollection()
+
+    def get(self, where=None, include=None):
+        rows = self._collection.rows
+        ids = [vector_id for vector_id in rows if not where or FakeCollection._match(rows[vector_id][1], where)]
+        return {'ids': ids, 'metadatas': [rows[vector_id][1] for vector_id in ids]}
+
+    def delete(self, ids=None):
+        self._collection.delete(ids=ids)
+
+
+class ParagraphSplitter:
+    """空行区切りで1段落を1チャンクにする"""
+
+    @staticmethod
+    def split_text(text):
+        return [paragraph for paragraph in text.split('\n\n') if paragraph]
+
+
+@pytest.fixture
+def rag(tmp_path):
+    system = rag_system.RAGSystem.__new__(rag_system.RAGSystem)
+    system.user_id = 1
+    system.embedding_backend = 'local'
+    system.persist_directory = str(tmp_path)
+    system.embeddings = CachedEmbeddings(LocalHashEmbeddingBackend(dim=64),
+                                         EmbeddingCache(str(tmp_path / 'embeddings.db')), model='test')
+    system.manifest = ChunkManifest(str(tmp_path / 'manifest.db'))
+    system.vectorstore = FakeVectorStore()
+    system.text_splitter = ParagraphSplitter()
+    system._writes = WriteBehind(lambda: None, max_ops=1000, max_seconds=3600)
+    return system
+
+
+def ingest(rag, paragraphs, **kwargs):
+    options = {'batch_chunks': 1, 'concurrency': 1}
+    options.update(kwargs)
+    return rag.ingest('\n\n'.join(paragraphs), {'filename': 'manual.md', 'file_id': 7}, **options)
+
+
+def assert_consistent(rag, paragraphs):
+    """ベクトルDB・マニフェストがちょうど新しいチャンク列と一致する（重複も取り残しもない）"""
+    rows = rag.vectorstore._collection.rows
+    manifest = rag.manifest.chunks(1, '7')
+    assert Counter(document for document, _ in rows.values()) == Counter(paragraphs)
+    assert {vector_id for _, vector_id, _ in manifest} == set(rows)
+    assert sorted(index for _, _, index in manifest) == list(range(len(paragraphs)))
+    for chunk_hash, vector_id, index in manifest:
+        document, metadata = rows[vector_id]
+        assert document == paragraphs[index]
+        assert metadata['chunk_index'] == index
+    assert rag.manifest.files(1) == [{'file_key': '7', 'filename': 'manual.md', 'chunk_count': len(paragraphs)}]
+
+
+def test_reingesting_the_same_file_embeds_nothing(rag):
+    paragraphs = ['チェックインは15時', '朝食は7時から', '駐車場は20台']
+    first = ingest(rag, paragraphs)
+    second = ingest(rag, paragraphs)
+
+    assert (first['added'], first['skipped'], first['removed']) == (3, 0, 0)
+    assert (second['added'], second['skipped'], second['removed']) == (0, 3, 0)
+    assert_consistent(rag, paragraphs)
+
+
+def test_duplicate_chunk_text_gets_distinct_ids(rag):
+    paragraphs = ['同じ段落', 'ちがう段落', '同じ段落']
+    report = ingest(rag, paragraphs)
+
+    assert report['added'] == 3
+    assert len(rag.vectorstore._collection.rows) == 3
+    assert_consistent(rag, paragraphs)
+
+    # 重複の片方を消すと1件だけ削除する
+    report = ingest(rag, ['同じ段落', 'ちがう段落'])
+    assert (report['added'], report['skipped'], report['removed']) == (0, 2, 1)
+    assert_consistent(rag, ['同じ段落', 'ちがう段落'])
+
+    # 重複を増やすと増えた分だけ追加し、既存のIDと衝突しない
+    paragraphs = ['同じ段落', '同じ段落', 'ちがう段落', '同じ段落']
+    report = ingest(rag, paragraphs)
+    assert (report['added'], report['skipped'], report['removed']) == (2, 2, 0)
+    assert_consistent(rag, paragraphs)
+
+
+def test_moved_chunks_keep_their_vectors(rag):
+    ingest(rag, ['第1章', '第2章', '第3章'])
+    ids_before = {rows[0]: vector_id for vector_id, rows in rag.vectorstore._collection.rows.items()}
+
+    paragraphs = ['はじめに', '第1章', '第3章', '第2章']
+    report = ingest(rag, paragraphs)
+
+    assert (report['added'], report['skipped'], report['removed']) == (1, 3, 0)
+    ids_after = {rows[0]: vector_id for vector_id, rows in rag.vectorstore._collection.rows.items()}
+    for paragraph in ('第1章', '第2章', '第3章'):
+        assert ids_after[paragraph] == ids_before[paragraph]
+    assert_consistent(rag, paragraphs)
+
+
+def test_rerun_after_partial_failure_leaves_no_duplicates_or_orphans(rag):
+    ingest(rag, ['A', 'B', 'C'])
+
+    paragraphs = ['A', 'C', 'D', 'E', 'F', 'G']
+    collection = rag.vectorstore._collection
+    collection.fail_upserts_after = 2
+    with pytest.raises(RuntimeError):
+        ingest(rag, paragraphs)
+
+    # 書き込めたバッチはマニフェストに記録され、古いチャンク（B）はまだ消さない
+    documents = Counter(document for document, _ in collection.rows.values())
+    assert documents['B'] == 1
+    assert sum(documents.values()) == 5
+    assert len(rag.manifest.chunks(1, '7')) == 5
+
+    collection.fail_upserts_after = None
+    report = ingest(rag, paragraphs)
+
+    assert (report['added'], report['skipped'], report['removed']) == (2, 4, 1)
+    assert_consistent(rag, paragraphs)
+
+
+def test_rerun_after_failure_before_any_batch(rag):
+    ingest(rag, ['A', 'B'])
+
+    rag.vectorstore._collection.fail_upserts_after = 0
+    with pytest.raises(RuntimeError):
+        ingest(rag, ['B', 'X'])
+    rag.vectorstore._collection.fail_upserts_after = None
+
+    report = ingest(rag, ['B', 'X'])
+    assert (report['added'], report['skipped'], report['removed']) == (1, 1, 1)
+    assert_consistent(rag, ['B', 'X'])
+
+
+def test_concurrent_ingests_of_the_same_file_are_serialized(rag):
+    collection = rag.vectorstore._collection
+    upsert = collection.upsert
+
+    def slow_upsert(*args, **kwargs):
+        time.sleep(0.02)
+        upsert(*args, **kwargs)
+
+    collection.upsert = slow_upsert
+    paragraphs = ['A', 'B', 'C']
+    reports = []
+    threads = [threading.Thread(target=lambda: reports.append(ingest(rag, paragraphs))) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # 後から始めた取り込みは先の取り込みの結果と差分をとる
+    assert sorted((report['added'], report['skipped']) for report in reports) == [(0, 3), (3, 0)]
+    assert_consistent(rag, paragraphs)
+    assert rag_system._ingest_locks == {}
@@ -0,0 +1,73 @@
+"""diff_chunks と ChunkManifest: 再登録時のチャンクの差分"""
+
+from rag_manifest import ChunkManifest, diff_chunks
+
+
+def rows(*items):
+    """(本文ハッシュ, ベクトルID) の並びを (本文ハッシュ, ベクトルID, チャンク番号) にする"""
+    return [(chunk_hash, vector_id, index) for index, (chunk_hash, vector_id) in enumerate(items)]
+
+
+def test_unchanged_file_reuses_every_vector():
+    diff = diff_chunks(rows(('a', 'id-a'), ('b', 'id-b')), ['a', 'b'])
+    assert diff == {'keep': {0: 'id-a', 1: 'id-b'}, 'add': [], 'remove': [], 'moved': {}}
+
+
+def test_new_file_adds_every_chunk():
+    diff = diff_chunks([], ['a', 'b'])
+    assert diff == {'keep': {}, 'add': [0, 1], 'remove': [], 'moved': {}}
+
+
+def test_edited_chunk_is_replaced():
+    diff = diff_chunks(rows(('a', 'id-a'), ('b', 'id-b'), ('c', 'id-c')), ['a', 'x', 'c'])
+    assert diff['keep'] == {0: 'id-a', 2: 'id-c'}
+    assert diff['add'] == [1]
+    assert diff['remove'] == ['id-b']
+    assert diff['moved'] == {}
+
+
+def test_inserted_chunk_moves_the_following_ones():
+    diff = diff_chunks(rows(('a', 'id-a'), ('b', 'id-b')), ['new', 'a', 'b'])
+    assert diff['keep'] == {1: 'id-a', 2: 'id-b'}
+    assert diff['add'] == [0]
+    assert diff['remove'] == []
+    assert diff['moved'] == {'id-a': 1, 'id-b': 2}
+
+
+def test_reordered_chunks_are_moved_not_re_embedded():
+    diff = diff_chunks(rows(('a', 'id-a'), ('b', 'id-b')), ['b', 'a'])
+    assert diff['add'] == [] and diff['remove'] == []
+    assert diff['moved'] == {'id-b': 0, 'id-a': 1}
+
+
+def test_duplicate_text_is_matched_in_order():
+    old = rows(('dup', 'id-1'), ('x', 'id-x'), ('dup', 'id-2'))
+
+    # 同じ本文が1つ減ったら後ろの方を消す
+    diff = diff_chunks(old, ['dup', 'x'])
+    assert diff['keep'] == {0: 'id-1', 1: 'id-x'}
+    assert diff['remove'] == ['id-2']
+
+    # 同じ本文が1つ増えたら増えた分だけ埋め込む
+    diff = diff_chunks(old, ['dup', 'x', 'dup', 'dup'])
+    assert diff['keep'] == {0: 'id-1', 1: 'id-x', 2: 'id-2'}
+    assert diff['add'] == [3]
+    assert diff['remove'] == []
+
+
+def test_manifest_rows_are_scoped_by_tenant_and_file(tmp_path):
+    manifest = ChunkManifest(str(tmp_path / 'manifest.db'))
+    manifest.add(1, 'f1', [('a', 'id-a', 0), ('b', 'id-b', 1)])
+    manifest.add(2, 'f1', [('a', 'other-tenant', 0)])
+
+    manifest.move(1, 'f1', {'id-b': 0, 'id-a': 1})
+    assert manifest.chunks(1, 'f1') == [('b', 'id-b', 0), ('a', 'id-a', 1)]
+
+    manifest.remove(1, ['id-a'])
+    assert manifest.chunks(1, 'f1') == [('b', 'id-b', 0)]
+    assert manifest.chunks(2, 'f1') == [('a', 'other-tenant', 0)]
+
+    manifest.set_file(1, 'f1', 'manual.pdf', 1)
+    assert manifest.file_keys(1, 'manual.pdf') == ['f1']
+    manifest.remove_file(1, 'f1')
+    assert manifest.chunks(1, 'f1') == [] and manifest.files(1) == []
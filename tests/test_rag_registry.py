@@ -0,0 +1,154 @@
+"""RAGRegistry: テナントごとのインスタンスの使い回し・LRUでの破棄・初期化の失敗"""
+
+import threading
+import types
+
+import pytest
+
+from rag_registry import RAGRegistry
+
+
+class FakeRAG:
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.closed = 0
+
+    def close(self):
+        self.closed += 1
+
+
+def test_instance_is_built_once_and_reused():
+    built = []
+    registry = RAGRegistry(lambda user_id: built.append(user_id) or FakeRAG(user_id), max_instances=2)
+
+    with registry.acquire(1) as first:
+        pass
+    with registry.acquire(1) as second:
+        pass
+
+    assert first is second and built == [1]
+    assert registry.stats()['hits'] == 1 and registry.stats()['misses'] == 1
+
+
+def test_least_recently_used_instance_is_closed():
+    registry = RAGRegistry(FakeRAG, max_instances=2)
+    instances = {}
+    for user_id in (1, 2, 1, 3):
+        with registry.acquire(user_id) as rag:
+            instances[user_id] = rag
+
+    assert instances[2].closed == 1
+    assert instances[1].closed == 0 and instances[3].closed == 0
+    assert registry.stats()['instances'] == 2 and registry.stats()['evictions'] == 1
+
+
+def test_instance_evicted_while_in_use_is_closed_on_release():
+    registry = RAGRegistry(FakeRAG, max_instances=1)
+
+    with registry.acquire(1) as held:
+        with registry.acquire(2):
+            pass
+        # 上限を超えて外されたが、使用中なので閉じない
+        assert held.closed == 0
+        assert registry.stats()['evictions'] == 1
+
+        # 外されたテナントの次の取得では新しいインスタンスを作る
+        with registry.acquire(1) as rebuilt:
+            assert rebuilt is not held
+            assert held.closed == 0
+
+    assert held.closed == 1
+    assert rebuilt.closed == 0
+
+
+def test_invalidate_in_use_closes_on_release():
+    registry = RAGRegistry(FakeRAG, max_instances=4)
+    with registry.acquire(1) as held:
+        registry.invalidate(1)
+        assert held.closed == 0
+    assert held.closed == 1
+    assert registry.stats()['instances'] == 0
+
+
+def test_failed_build_is_not_cached():
+    attempts = []
+
+    def factory(user_id):
+        attempts.append(user_id)
+        if len(attempts) == 1:
+            raise RuntimeError('chroma unavailable')
+        return FakeRAG(user_id)
+
+    registry = RAGRegistry(factory, max_instances=2)
+    with pytest.raises(RuntimeError):
+        with registry.acquire(1):
+            pass
+
+    stats = registry.stats()
+    assert stats['init_errors'] == 1 and stats['instances'] == 0 and stats['in_use'] == 0
+
+    with registry.acquire(1) as rag:
+        assert isinstance(rag, FakeRAG)
+    assert attempts == [1, 1]
+
+
+def test_waiters_on_a_failed_build_get_the_error():
+    building = threading.Event()
+    release = threading.Event()
+
+    def factory(user_id):
+        building.set()
+        release.wait(5)
+        raise RuntimeError('chroma unavailable')
+
+    registry = RAGRegistry(factory, max_instances=2)
+    errors = []
+
+    def acquire():
+        try:
+            with registry.acquire(1):
+                pass
+        except RuntimeError as e:
+            errors.append(e)
+
+    builder = threading.Thread(target=acquire)
+    builder.start()
+    assert building.wait(5)
+    waiter = threading.Thread(target=acquire)
+    waiter.start()
+    release.set()
+    builder.join(5)
+    waiter.join(5)
+
+    assert len(errors) == 2
+    assert registry.stats()['in_use'] == 0 and registry.stats()['instances'] == 0
+
+
+def test_chroma_client_is_stopped_when_the_last_instance_closes(tmp_path, monkeypatch):
+    rag_system = pytest.importorskip('rag_system', reason='langchain / langchain_community are not installed')
+    stopped = []
+
+    class FakeChroma:
+        def __init__(self, persist_directory, embedding_function):
+            system = types.SimpleNamespace(stop=lambda: stopped.append(persist_directory))
+            self._client = types.SimpleNamespace(_system=system, _identifier=persist_directory)
+
+        def persist(self):
+            pass
+
+    monkeypatch.setattr(rag_system, 'Chroma', FakeChroma)
+    registry = RAGRegistry(
+        lambda user_id: rag_system.RAGSystem(user_id, persist_directory=str(tmp_path), embedding_backend='local'),
+        max_instances=1)
+
+    with registry.acquire(1) as held:
+        with registry.acquire(2):
+            pass
+        with registry.acquire(1):
+            pass
+        # テナント2は閉じた。テナント1は作り直したインスタンスとクライアントを共有しているので止めない
+        assert stopped == [held.persist_directory.replace('user_1', 'user_2')]
+
+    registry.close()
+    assert sorted(stopped) == sorted([held.persist_directory.replace('user_1', 'user_2'), held.persist_directory])
+    assert rag_system.open_store_count() == 0
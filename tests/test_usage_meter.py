@@ -0,0 +1,169 @@
+"""UsageMeter: プラン上限の判定・差分の書き込み・ワーカー間の同期"""
+
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+from usage_meter import UsageMeter
+
+PLANS = {
+    'starter': {'files': 1, 'api_calls': 10, 'messages': 10},
+    'pro': {'files': 20, 'api_calls': 100, 'messages': 100},
+}
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / 'usage.db')
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, plan TEXT)")
+    conn.execute('''CREATE TABLE usage_tracking (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        month TEXT NOT NULL,
+        files_uploaded INTEGER DEFAULT 0,
+        api_calls_made INTEGER DEFAULT 0,
+        messages_sent INTEGER DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(user_id, month)
+    )''')
+    conn.execute("INSERT INTO users (id, plan) VALUES (1, 'starter')")
+    conn.commit()
+    conn.close()
+    return path
+
+
+def make_meter(db_path, **kwargs):
+    # バックグラウンドの書き込みは起こさず、flush() を明示的に呼んで確かめる
+    options = {'flush_interval': 3600, 'sync_interval': 3600, 'tolerance': 2}
+    options.update(kwargs)
+    return UsageMeter(db_path, PLANS, **options)
+
+
+def stored_messages(db_path, user_id=1):
+    conn = sqlite3.connect(db_path)
+    try:
+        row = conn.execute('SELECT messages_sent FROM usage_tracking WHERE user_id = ? AND month = ?',
+                           (user_id, datetime.now().strftime('%Y-%m'))).fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else 0
+
+
+def test_limit_boundary(db_path):
+    meter = make_meter(db_path)
+    for _ in range(9):
+        meter.record(1, 'messages')
+    assert meter.check(1, 'messages')
+
+    meter.record(1, 'messages')
+    assert not meter.check(1, 'messages')
+    meter.shutdown()
+
+
+def test_unknown_user_is_denied(db_path):
+    meter = make_meter(db_path)
+    assert not meter.check(999, 'messages')
+    meter.shutdown()
+
+
+def test_flush_does_not_double_count(db_path):
+    # sync_interval=0: 判定のたびにDBを再読込する
+    meter = make_meter(db_path, sync_interval=0)
+    for _ in range(3):
+        meter.record(1, 'messages')
+
+    assert meter.flush() == 1
+    assert meter.flush() == 0
+    assert stored_messages(db_path) == 3
+
+    # 書き込み済みの差分はDBの値として一度だけ数える（3 + 6 = 9 < 10）
+    for _ in range(6):
+        meter.record(1, 'messages')
+    assert meter.check(1, 'messages')
+    meter.record(1, 'messages')
+    assert not meter.check(1, 'messages')
+
+    meter.shutdown()
+    assert stored_messages(db_path) == 10
+
+
+def test_failed_flush_is_retried_once(db_path, monkeypatch):
+    meter = make_meter(db_path)
+    for _ in range(4):
+        meter.record(1, 'messages')
+
+    def broken_connection():
+        raise sqlite3.OperationalError('database is locked')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(meter, '_get_connection', broken_connection)
+        with pytest.raises(sqlite3.OperationalError):
+            meter.flush()
+
+    assert meter.flush() == 1
+    assert stored_messages(db_path) == 4
+    meter.shutdown()
+
+
+def test_near_limit_check_sees_other_worker(db_path):
+    worker_a = make_meter(db_path)
+    worker_b = make_meter(db_path)
+
+    for _ in range(8):
+        worker_a.record(1, 'messages')
+    worker_a.flush()
+    assert worker_b.check(1, 'messages')
+
+    # どちらも未書き込みの1件ずつで上限に達する
+    worker_a.record(1, 'messages')
+    worker_b.record(1, 'messages')
+    assert worker_a.check(1, 'messages')      # B の1件はまだ見えない（tolerance 以内）
+    assert not worker_b.check(1, 'messages')  # 残り枠が少ないので A の分を書き込み済みとして再読込
+    assert not worker_a.check(1, 'messages')
+
+    worker_a.shutdown()
+    worker_b.shutdown()
+    assert stored_messages(db_path) == 10
+
+
+def test_unsynced_usage_per_worker_is_bounded_by_tolerance(db_path):
+    worker_a = make_meter(db_path, tolerance=3)
+    worker_b = make_meter(db_path, tolerance=3)
+    assert worker_b.check(1, 'messages')
+
+    for _ in range(3):
+        worker_a.record(1, 'messages')
+    # A は tolerance 件加算したので判定時に書き込んで同期する
+    assert worker_a.check(1, 'messages')
+    assert stored_messages(db_path) == 3
+
+    for _ in range(4):
+        worker_b.record(1, 'messages')
+    # B は tolerance を超えたので同期し、A の3件を含めて判定する（3 + 4 = 7）
+    assert worker_b.check(1, 'messages')
+    assert stored_messages(db_path) == 7
+    for _ in range(3):
+        worker_b.record(1, 'messages')
+    assert not worker_b.check(1, 'messages')
+
+    worker_a.shutdown()
+    worker_b.shutdown()
+
+
+def test_plan_change_applies_after_invalidate(db_path):
+    meter = make_meter(db_path)
+    meter.record(1, 'files')
+    assert not meter.check(1, 'files')
+
+    conn = sqlite3.connect(db_path)
+    conn.execute("UPDATE users SET plan = 'pro' WHERE id = 1")
+    conn.commit()
+    conn.close()
+
+    # プランはキャッシュされている
+    assert not meter.check(1, 'files')
+    meter.invalidate_plan(1)
+    assert meter.check(1, 'files')
+    meter.shutdown()
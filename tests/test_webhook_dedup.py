@@ -0,0 +1,54 @@
+"""WebhookEventDeduper: 重複の除外と、処理に失敗したイベントの再配信"""
+
+import pytest
+
+from webhook_dedup import WebhookEventDeduper
+
+
+@pytest.fixture
+def deduper(tmp_path):
+    return WebhookEventDeduper(str(tmp_path / 'events.db'))
+
+
+def test_redelivery_of_processed_event_is_skipped(deduper):
+    assert deduper.claim_many(['e1', 'e2']) == {'e1', 'e2'}
+    assert deduper.claim_many(['e1'], redelivered=1) == set()
+    assert deduper.all_seen(['e1', 'e2'])
+
+
+def test_released_event_is_claimed_again(deduper, tmp_path):
+    deduper.claim_many(['e1', 'e2'])
+    deduper.release(['e1'])
+
+    assert not deduper.seen('e1')
+    assert deduper.claim_many(['e1', 'e2'], redelivered=2) == {'e1'}
+    # 別のワーカー（メモリは空、DBは共有）でも同じ
+    other = WebhookEventDeduper(str(tmp_path / 'events.db'))
+    assert other.claim_many(['e1', 'e2']) == set()
+    assert deduper.stats()['released'] == 1
+
+
+def test_failed_handling_is_processed_on_redelivery(main_module, deduper, monkeypatch):
+    monkeypatch.setattr(main_module, 'webhook_deduper', deduper)
+    handled = []
+
+    def handle(event):
+        if not handled:
+            handled.append('failed')
+            raise RuntimeError('worker crashed')
+        handled.append(event['webhookEventId'])
+
+    events = [{'webhookEventId': 'e1'}]
+    jobs = [(None, main_module.release_claim_on_failure('e1', handle), (event,))
+            for event in main_module.filter_new_events(events, ['e1'])]
+    with pytest.raises(RuntimeError):
+        main_module.run_events_concurrently(jobs)
+
+    # LINEの再配信（isRedelivery）は処理される
+    redelivered = main_module.filter_new_events(events, ['e1'], redelivered=1)
+    assert redelivered == events
+    main_module.run_events_concurrently([(None, main_module.release_claim_on_failure('e1', handle), (redelivered[0],))])
+    assert handled == ['failed', 'e1']
+
+    # 処理に成功した後の再配信は除外される
+    assert main_module.filter_new_events(events, ['e1'], redelivered=1) == []
@@ -0,0 +1,46 @@
+"""WebhookDispatcher: 投入の拒否とキュー深さの戻し"""
+
+import threading
+import types
+
+from webhook_dispatcher import WebhookDispatcher
+
+
+def make_event(user_id):
+    return types.SimpleNamespace(source=types.SimpleNamespace(user_id=user_id), reply_token=None)
+
+
+def test_full_queue_rejects_events():
+    started, release = threading.Event(), threading.Event()
+    dispatcher = WebhookDispatcher(lambda event: started.set() or release.wait(5), workers=1, max_queue=1)
+
+    # 1件目は実行中、2件目が待機中でキューが埋まる
+    assert dispatcher.submit(make_event('U1')) is True
+    assert started.wait(5)
+    assert dispatcher.submit(make_event('U1')) is True
+    assert dispatcher.submit(make_event('U2')) is False
+    release.set()
+    dispatcher.shutdown()
+
+    stats = dispatcher.stats()
+    assert stats['rejected'] == 1 and stats['processed'] == 2 and stats['queue_depth'] == 0
+
+
+def test_submit_after_shutdown_is_rejected():
+    dispatcher = WebhookDispatcher(lambda event: None, workers=1)
+    dispatcher.shutdown()
+
+    assert dispatcher.submit(make_event('U1')) is False
+    assert dispatcher.stats()['queue_depth'] == 0
+
+
+def test_pool_rejection_rolls_back_the_queue_depth():
+    dispatcher = WebhookDispatcher(lambda event: None, workers=1, max_queue=2)
+    # 停止フラグを立てる前にプールだけが止まった場合
+    dispatcher._executor.shutdown()
+
+    for _ in range(3):
+        assert dispatcher.submit(make_event('U1')) is False
+
+    stats = dispatcher.stats()
+    assert stats['queue_depth'] == 0 and stats['enqueued'] == 0 and stats['rejected'] == 3
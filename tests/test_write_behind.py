@@ -0,0 +1,67 @@
+"""WriteBehind: 変更回数・終了時のフラッシュ"""
+
+import os
+import subprocess
+import sys
+import textwrap
+
+from write_behind import WriteBehind
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_flushes_after_max_ops():
+    flushes = []
+    writes = WriteBehind(lambda: flushes.append(1), max_ops=3, max_seconds=3600)
+    writes.mark()
+    writes.mark()
+    assert flushes == []
+    writes.mark()
+    assert flushes == [1]
+    assert writes.flush() is False
+
+
+def test_failed_flush_keeps_pending_changes():
+    calls = []
+
+    def flush():
+        calls.append(1)
+        if len(calls) == 1:
+            raise OSError('disk full')
+
+    writes = WriteBehind(flush, max_ops=100, max_seconds=3600)
+    writes.mark(2)
+    assert writes.flush() is False
+    assert writes.stats()['pending'] == 2
+    assert writes.flush() is True
+    assert writes.stats()['pending'] == 0
+
+
+def test_sigterm_flushes_pending_changes_at_exit(tmp_path):
+    marker = tmp_path / 'flushed'
+    script = textwrap.dedent(f'''
+        import os, signal, sys, threading, time
+        sys.path.insert(0, {ROOT!r})
+        import write_behind
+
+        write_behind.install_sigterm_handler()
+        instances = []
+
+        # RAGSystem と同じく、メインスレッド以外で作る
+        def build():
+            instances.append(write_behind.WriteBehind(lambda: open({str(marker)!r}, 'w').close(),
+                                                      max_ops=100, max_seconds=3600))
+
+        thread = threading.Thread(target=build)
+        thread.start()
+        thread.join()
+        instances[0].mark()
+
+        # シグナルが届いたときにメインスレッドがロックを持っていてもデッドロックしない
+        with write_behind._instances_lock:
+            os.kill(os.getpid(), signal.SIGTERM)
+            time.sleep(5)
+    ''')
+    result = subprocess.run([sys.executable, '-c', script], timeout=30)
+    assert result.returncode == 128 + 15
+    assert marker.exists()
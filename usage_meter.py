@@ -0,0 +1,343 @@
+"""
+使用量メーター（Write-behind）
+ユーザー×月ごとの使用量カウンタをメモリに保持してプラン上限を判定し、
+差分をまとめて一定間隔（またはシャットダウン時）にusage_trackingへ書き込む
+
+複数のgunicornワーカー間の整合性:
+- 各ワーカーは「DBの値 + 自プロセスの未書き込み差分」で判定する
+- 前回のDB同期から tolerance 件加算するか sync_interval 秒経過したら、差分を書き込んでDBを再読込する
+  （他ワーカーから見えない使用量は1ワーカーあたり最大 tolerance 件）
+- 残り枠が tolerance 以下になったキーは、判定のたびに差分を書き込んでDBを再読込する
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# 上限種別 → usage_tracking のカラム
+USAGE_COLUMNS = {
+    'files': 'files_uploaded',
+    'api_calls': 'api_calls_made',
+    'messages': 'messages_sent',
+}
+
+
+class _Counter:
+    """ユーザー×月のカウンタ"""
+
+    __slots__ = ('base', 'pending', 'synced_at', 'unsynced')
+
+    def __init__(self):
+        self.base = {column: 0 for column in USAGE_COLUMNS.values()}
+        self.pending = {column: 0 for column in USAGE_COLUMNS.values()}
+        self.synced_at = 0.0
+        # 他ワーカーから見えていない加算量（前回のDB同期の時点で未書き込みだった分を含む）
+        self.unsynced = 0
+
+    def used(self, column: str) -> int:
+        return self.base[column] + self.pending[column]
+
+    def has_pending(self) -> bool:
+        return any(self.pending.values())
+
+
+class UsageMeter:
+    """使用量カウンタのメモリ保持・上限判定・バッチ書き込み"""
+
+    def __init__(self, db_path: str, plans: Dict, flush_interval: float = 5.0,
+                 sync_interval: float = 10.0, tolerance: int = 20, plan_ttl: float = 60.0):
+        """
+        メーター初期化
+
+        Args:
+            db_path: SQLiteデータベースのパス
+            plans: プラン設定（PLANS）
+            flush_interval: 差分をDBへ書き込む間隔（秒）
+            sync_interval: 他ワーカーの書き込みを取り込むためDBを再読込する間隔（秒）
+            tolerance: 他ワーカーとの同期なしに加算できる量（残り枠がこれ以下なら判定ごとに同期）
+            plan_ttl: ユーザーのプランをキャッシュする期間（秒）
+        """
+        self.db_path = db_path
+        self.plans = plans
+        self.flush_interval = flush_interval
+        self.sync_interval = sync_interval
+        self.tolerance = tolerance
+        self.plan_ttl = plan_ttl
+
+        self._counters = {}  # (user_id, month) -> _Counter
+        self._plans = {}  # user_id -> (plan, expires_at)
+        self._lock = threading.RLock()
+        # DB再読込と書き込みを直列化（読込中に書き込んだ差分を上書きしないため）
+        self._io_lock = threading.Lock()
+        self._flusher = None
+        self._stop = threading.Event()
+
+        self._stats = {
+            'checks': 0,
+            'records': 0,
+            'db_reads': 0,
+            'flushes': 0,
+            'rows_flushed': 0,
+            'near_limit_syncs': 0,
+        }
+
+    def _get_connection(self):
+        """データベース接続取得"""
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def _current_month() -> str:
+        return datetime.now().strftime('%Y-%m')
+
+    def _ensure_flusher(self):
+        """バックグラウンド書き込みスレッドを遅延起動（gunicornのfork後に起動させるため）"""
+        if self._flusher is not None or self.flush_interval <= 0:
+            return
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, name='usage-meter-flush', daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"使用量の書き込みエラー: {e}")
+
+    def get_plan(self, user_id) -> Optional[str]:
+        """ユーザーのプランを取得（キャッシュ付き）"""
+        now = time.monotonic()
+        with self._lock:
+            cached = self._plans.get(user_id)
+            if cached and cached[1] > now:
+                return cached[0]
+
+        conn = self._get_connection()
+        try:
+            row = conn.execute('SELECT plan FROM users WHERE id = ?', (user_id,)).fetchone()
+        finally:
+            conn.close()
+
+        plan = row['plan'] if row else None
+        with self._lock:
+            self._plans[user_id] = (plan, now + self.plan_ttl)
+        return plan
+
+    def _sync(self, key, counter: _Counter):
+        """DBの値を再読込（自プロセスの未書き込み差分はそのまま保持）"""
+        with self._io_lock:
+            user_id, month = key
+            conn = self._get_connection()
+            try:
+                row = conn.execute('''
+                    SELECT files_uploaded, api_calls_made, messages_sent
+                    FROM usage_tracking
+                    WHERE user_id = ? AND month = ?
+                ''', (user_id, month)).fetchone()
+            finally:
+                conn.close()
+
+            with self._lock:
+                for column in USAGE_COLUMNS.values():
+                    counter.base[column] = (row[column] or 0) if row else 0
+                counter.synced_at = time.monotonic()
+                # まだ書き込んでいない差分は他ワーカーから見えないままなので数え続ける
+                counter.unsynced = sum(counter.pending.values())
+                self._stats['db_reads'] += 1
+
+    def _get_counter(self, user_id, month: str) -> _Counter:
+        """カウンタを取得（sync_intervalを過ぎていればDBを再読込）"""
+        key = (user_id, month)
+        with self._lock:
+            counter = self._counters.get(key)
+            if counter is None:
+                counter = self._counters[key] = _Counter()
+            stale = time.monotonic() - counter.synced_at > self.sync_interval
+
+        if stale:
+            self._sync(key, counter)
+        return counter
+
+    def check(self, user_id, limit_type: str = 'files') -> bool:
+        """
+        プラン上限内かどうかを判定（check_usage_limit 相当）
+
+        Args:
+            user_id: ユーザーID
+            limit_type: 'files' / 'api_calls' / 'messages'
+
+        Returns:
+            bool: 上限内ならTrue
+        """
+        self._ensure_flusher()
+        with self._lock:
+            self._stats['checks'] += 1
+
+        plan = self.get_plan(user_id)
+        if not plan:
+            return False
+
+        limit = self.plans[plan][limit_type]
+        if limit == -1:
+            return True
+
+        column = USAGE_COLUMNS.get(limit_type)
+        if not column:
+            return False
+
+        month = self._current_month()
+        counter = self._get_counter(user_id, month)
+
+        with self._lock:
+            used = counter.used(column)
+            near_limit = limit - used <= self.tolerance
+            needs_sync = near_limit or counter.unsynced >= self.tolerance
+
+        if needs_sync:
+            # 自分の差分を書き込み、他ワーカーの分も含めた最新値で判定
+            self.flush(keys=[(user_id, month)])
+            self._sync((user_id, month), counter)
+            with self._lock:
+                if near_limit:
+                    self._stats['near_limit_syncs'] += 1
+                used = counter.used(column)
+
+        return used < limit
+
+    def record(self, user_id, usage_type: str = 'files', amount: int = 1):
+        """
+        使用量を加算（update_usage 相当。DBへの書き込みは次回フラッシュ時）
+
+        Args:
+            user_id: ユーザーID
+            usage_type: 'files' / 'api_calls' / 'messages'
+            amount: 加算量
+        """
+        column = USAGE_COLUMNS.get(usage_type)
+        if not column:
+            return
+
+        self._ensure_flusher()
+        key = (user_id, self._current_month())
+        with self._lock:
+            counter = self._counters.get(key)
+            if counter is None:
+                counter = self._counters[key] = _Counter()
+            counter.pending[column] += amount
+            counter.unsynced += amount
+            self._stats['records'] += 1
+
+        if self.flush_interval <= 0:
+            self.flush(keys=[key])
+
+    def flush(self, keys=None) -> int:
+        """
+        未書き込みの差分を1トランザクションでまとめて書き込み
+
+        Args:
+            keys: 対象の (user_id, month) リスト（省略時は全件）
+
+        Returns:
+            int: 書き込んだ行数
+        """
+        with self._io_lock:
+            return self._flush(keys)
+
+    def _flush(self, keys) -> int:
+        with self._lock:
+            targets = keys if keys is not None else list(self._counters.keys())
+            batch = []
+            for key in targets:
+                counter = self._counters.get(key)
+                if counter is None or not counter.has_pending():
+                    continue
+                batch.append((key, dict(counter.pending)))
+                for column in counter.pending:
+                    counter.pending[column] = 0
+
+        if not batch:
+            return 0
+
+        rows = [
+            (user_id, month,
+             delta['files_uploaded'], delta['api_calls_made'], delta['messages_sent'],
+             delta['files_uploaded'], delta['api_calls_made'], delta['messages_sent'])
+            for (user_id, month), delta in batch
+        ]
+
+        try:
+            conn = self._get_connection()
+            try:
+                conn.executemany('''
+                    INSERT INTO usage_tracking (user_id, month, files_uploaded, api_calls_made, messages_sent)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(user_id, month) DO UPDATE SET
+                    files_uploaded = files_uploaded + ?,
+                    api_calls_made = api_calls_made + ?,
+                    messages_sent = messages_sent + ?,
+                    updated_at = CURRENT_TIMESTAMP
+                ''', rows)
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception:
+            # 書き込み失敗時は差分を戻して次回に再試行
+            with self._lock:
+                for key, delta in batch:
+                    counter = self._counters.setdefault(key, _Counter())
+                    for column, value in delta.items():
+                        counter.pending[column] += value
+            raise
+
+        current_month = self._current_month()
+        with self._lock:
+            for key, delta in batch:
+                counter = self._counters.get(key)
+                if counter is not None:
+                    for column, value in delta.items():
+                        counter.base[column] += value
+            # 前月以前のカウンタは書き込み済みなら破棄
+            for key in [k for k, c in self._counters.items() if k[1] != current_month and not c.has_pending()]:
+                del self._counters[key]
+            self._stats['flushes'] += 1
+            self._stats['rows_flushed'] += len(rows)
+
+        return len(rows)
+
+    def invalidate_plan(self, user_id=None):
+        """プランのキャッシュを破棄（プラン変更時）"""
+        with self._lock:
+            if user_id is None:
+                self._plans.clear()
+            else:
+                self._plans.pop(user_id, None)
+
+    def shutdown(self):
+        """書き込みスレッドを停止し、残りの差分を書き込む"""
+        self._stop.set()
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"シャットダウン時の使用量書き込みエラー: {e}")
+
+    def stats(self) -> Dict:
+        """統計情報を取得"""
+        with self._lock:
+            pending = sum(1 for c in self._counters.values() if c.has_pending())
+            return {
+                **self._stats,
+                'counters': len(self._counters),
+                'pending_counters': pending,
+                'flush_interval': self.flush_interval,
+                'sync_interval': self.sync_interval,
+                'tolerance': self.tolerance,
+            }
@@ -3,7 +3,7 @@ import secrets
 import time
 from datetime import datetime, timedelta
 import json
-import requests
+from http_clients import get_session
 
 class UserManager:
     def __init__(self):
@@ -39,7 +39,7 @@ class UserManager:
     
     def get_dynamic_customers(self):
         try:
-            response = requests.get(f"{self.payment_system_url}/api/customers", timeout=3)
+            response = get_session().get(f"{self.payment_system_url}/api/customers", timeout=3)
             return response.json() if response.status_code == 200 else []
         except:
             return []
@@ -0,0 +1,188 @@
+"""
+Webhook重複配信の検出
+LINEの webhookEventId をキーに処理済みイベントを記録し、再配信を処理前に除外する
+SQLiteテーブル（ワーカー間で共有）+ メモリ上のフロントキャッシュ（TTL付き）
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Set
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookEventDeduper:
+    """webhookEventId による重複イベント検出"""
+
+    def __init__(self, db_path: str, ttl: float = 86400.0, memory_size: int = 10000,
+                 purge_interval: float = 600.0):
+        """
+        初期化
+
+        Args:
+            db_path: SQLiteデータベースのパス
+            ttl: 処理済みイベントを記録しておく期間（秒）
+            memory_size: メモリに保持する最大イベント数
+            purge_interval: 期限切れレコードを削除する間隔（秒）
+        """
+        self.db_path = db_path
+        self.ttl = ttl
+        self.memory_size = memory_size
+        self.purge_interval = purge_interval
+
+        self._seen = OrderedDict()  # event_id -> expires_at
+        self._lock = threading.Lock()
+        self._last_purge = time.time()
+        self._stats = {
+            'claimed': 0,
+            'duplicates': 0,
+            'redeliveries': 0,
+            'fast_path_hits': 0,
+            'released': 0,
+        }
+
+        self._init_table()
+
+    def _get_connection(self):
+        """データベース接続取得"""
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def _init_table(self):
+        """処理済みイベントテーブル初期化"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS webhook_events (
+                event_id TEXT PRIMARY KEY,
+                received_at REAL NOT NULL
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_webhook_events_received_at ON webhook_events(received_at)')
+        conn.commit()
+        conn.close()
+
+    def _remember(self, event_id: str, now: float):
+        self._seen[event_id] = now + self.ttl
+        self._seen.move_to_end(event_id)
+        while len(self._seen) > self.memory_size:
+            self._seen.popitem(last=False)
+
+    def seen(self, event_id: str) -> bool:
+        """
+        メモリ上で処理済みかどうかを判定（DBアクセスなし）
+
+        Args:
+            event_id: webhookEventId
+
+        Returns:
+            bool: このプロセスで処理済みならTrue
+        """
+        if not event_id:
+            return False
+        with self._lock:
+            expires_at = self._seen.get(event_id)
+            if expires_at is None:
+                return False
+            if expires_at < time.time():
+                del self._seen[event_id]
+                return False
+            return True
+
+    def all_seen(self, event_ids: Iterable[str]) -> bool:
+        """全イベントが処理済みならTrue（即座に200を返すための高速判定）"""
+        event_ids = list(event_ids)
+        if not event_ids or not all(self.seen(event_id) for event_id in event_ids):
+            return False
+        with self._lock:
+            self._stats['fast_path_hits'] += 1
+            self._stats['duplicates'] += len(event_ids)
+        return True
+
+    def claim_many(self, event_ids: Iterable[str], redelivered: int = 0) -> Set[str]:
+        """
+        未処理のイベントを処理済みとして登録（1トランザクション）
+
+        Args:
+            event_ids: webhookEventId のリスト
+            redelivered: うち再配信（deliveryContext.isRedelivery）のイベント数
+
+        Returns:
+            set: 今回新たに登録できた（＝処理すべき）イベントID
+        """
+        now = time.time()
+        event_ids = [event_id for event_id in event_ids if event_id]
+        candidates = [event_id for event_id in event_ids if not self.seen(event_id)]
+
+        claimed = set()
+        if candidates:
+            conn = self._get_connection()
+            try:
+                cursor = conn.cursor()
+                for event_id in candidates:
+                    cursor.execute(
+                        'INSERT OR IGNORE INTO webhook_events (event_id, received_at) VALUES (?, ?)',
+                        (event_id, now)
+                    )
+                    if cursor.rowcount == 1:
+                        claimed.add(event_id)
+                conn.commit()
+            finally:
+                conn.close()
+
+        with self._lock:
+            for event_id in event_ids:
+                self._remember(event_id, now)
+            self._stats['claimed'] += len(claimed)
+            self._stats['duplicates'] += len(event_ids) - len(claimed)
+            self._stats['redeliveries'] += redelivered
+
+        self._maybe_purge(now)
+        return claimed
+
+    def release(self, event_ids: Iterable[str]):
+        """
+        登録を取り消す（処理に失敗したイベントを、LINEの再配信時にもう一度処理できるようにする）
+
+        Args:
+            event_ids: claim_many で登録した webhookEventId のリスト
+        """
+        event_ids = [event_id for event_id in event_ids if event_id]
+        if not event_ids:
+            return
+        with self._lock:
+            for event_id in event_ids:
+                self._seen.pop(event_id, None)
+            self._stats['released'] += len(event_ids)
+
+        conn = self._get_connection()
+        try:
+            conn.executemany('DELETE FROM webhook_events WHERE event_id = ?', [(event_id,) for event_id in event_ids])
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _maybe_purge(self, now: float):
+        """期限切れレコードを定期的に削除"""
+        with self._lock:
+            if now - self._last_purge < self.purge_interval:
+                return
+            self._last_purge = now
+
+        try:
+            conn = self._get_connection()
+            conn.execute('DELETE FROM webhook_events WHERE received_at < ?', (now - self.ttl,))
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            logger.warning(f"処理済みイベントの削除に失敗しました: {e}")
+
+    def stats(self) -> Dict:
+        """統計情報を取得"""
+        with self._lock:
+            return {
+                **self._stats,
+                'memory_entries': len(self._seen),
+            }
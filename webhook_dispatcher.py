@@ -0,0 +1,173 @@
+"""
+LINE Webhook 非同期ディスパッチャー
+署名検証後すぐに200を返し、イベント処理はバックグラウンドのワーカープールで行う
+同じ送信元のイベントは受信順に処理する
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict
+
+from keyed_executor import KeyedSerialExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def event_key(event):
+    """イベントの直列化キー（送信元のユーザー・グループ・ルーム）"""
+    source = getattr(event, 'source', None)
+    if source is None:
+        return None
+    return (getattr(source, 'user_id', None)
+            or getattr(source, 'group_id', None)
+            or getattr(source, 'room_id', None))
+
+
+class WebhookDispatcher:
+    """有界キュー + キー単位直列ワーカープールによるWebhookイベント処理"""
+
+    def __init__(self, handle_event: Callable, workers: int = 4, max_queue: int = 100,
+                 reply_token_ttl: float = 50.0, key_func: Callable = event_key):
+        """
+        ディスパッチャー初期化
+
+        Args:
+            handle_event: イベント1件を処理する関数
+            workers: ワーカースレッド数
+            max_queue: 未処理イベントの最大数（超過時は submit が False を返す）
+            reply_token_ttl: リプライトークンの有効期限（秒）。これより古いイベントは破棄
+            key_func: 処理順序を保証するキーを返す関数（同じキーのイベントは投入順に処理）
+        """
+        self.handle_event = handle_event
+        self.workers = workers
+        self.max_queue = max_queue
+        self.reply_token_ttl = reply_token_ttl
+        self.key_func = key_func
+
+        self._executor = KeyedSerialExecutor(max_workers=workers, thread_name_prefix='webhook-worker')
+        self._pending = 0
+        self._stopping = False
+        self._lock = threading.Lock()
+
+        # メトリクス
+        self._counters = {
+            'enqueued': 0,
+            'processed': 0,
+            'failed': 0,
+            'rejected': 0,
+            'dropped_expired': 0,
+        }
+        self._max_depth = 0
+        self._wait_times = deque(maxlen=1000)
+        self._process_times = deque(maxlen=1000)
+
+    def submit(self, event) -> bool:
+        """
+        イベントをキューに投入
+
+        Args:
+            event: LINE Webhookイベント
+
+        Returns:
+            bool: 投入できた場合True（キュー満杯・停止中はFalse）
+        """
+        with self._lock:
+            if self._stopping:
+                self._counters['rejected'] += 1
+                return False
+            if self._pending >= self.max_queue:
+                self._counters['rejected'] += 1
+                logger.warning(f"Webhookキューが満杯です（{self.max_queue}件）")
+                return False
+            self._pending += 1
+            self._counters['enqueued'] += 1
+            self._max_depth = max(self._max_depth, self._pending)
+
+        future = self._executor.submit(self.key_func(event), self._run, event, time.monotonic())
+        # _run は例外を外に出さないため、この時点で例外があればプールへの投入自体に失敗している（停止後など）
+        if future.done() and future.exception() is not None:
+            with self._lock:
+                self._pending -= 1
+                self._counters['enqueued'] -= 1
+                self._counters['rejected'] += 1
+            logger.error(f"Webhookイベントをワーカーに投入できませんでした: {future.exception()}")
+            return False
+        return True
+
+    def is_expired(self, event) -> bool:
+        """リプライトークンが期限切れかどうか（イベントのtimestampから判定）"""
+        if not getattr(event, 'reply_token', None):
+            return False
+
+        timestamp = getattr(event, 'timestamp', None)
+        if not timestamp:
+            return False
+
+        age = time.time() - timestamp / 1000.0
+        return age > self.reply_token_ttl
+
+    def _run(self, event, enqueued_at: float):
+        """ワーカースレッドでイベント1件を処理"""
+        wait_time = time.monotonic() - enqueued_at
+        with self._lock:
+            self._pending -= 1
+            self._wait_times.append(wait_time)
+
+        if self.is_expired(event):
+            with self._lock:
+                self._counters['dropped_expired'] += 1
+            logger.warning(f"リプライトークン期限切れのイベントを破棄しました（待機 {wait_time:.2f}秒）")
+            return
+
+        started_at = time.monotonic()
+        try:
+            self.handle_event(event)
+            status = 'processed'
+        except Exception as e:
+            logger.error(f"Webhookイベント処理エラー: {e}")
+            status = 'failed'
+
+        with self._lock:
+            self._counters[status] += 1
+            self._process_times.append(time.monotonic() - started_at)
+
+    def shutdown(self):
+        """新規受付を停止し、キューに残ったイベントを処理してから終了"""
+        with self._lock:
+            if self._stopping:
+                return
+            self._stopping = True
+        self._executor.shutdown(wait=True)
+        logger.info("Webhookワーカー停止")
+
+    @staticmethod
+    def _percentile(values, pct: float) -> float:
+        if not values:
+            return 0.0
+        ordered = sorted(values)
+        index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def stats(self) -> Dict:
+        """キュー深さ・待機時間などのメトリクスを取得"""
+        with self._lock:
+            wait_times = list(self._wait_times)
+            process_times = list(self._process_times)
+            counters = dict(self._counters)
+            max_depth = self._max_depth
+            depth = self._pending
+
+        return {
+            **counters,
+            'workers': self.workers,
+            'active_keys': self._executor.active_keys(),
+            'queue_depth': depth,
+            'queue_max_depth': max_depth,
+            'queue_capacity': self.max_queue,
+            'wait_ms_avg': round(sum(wait_times) / len(wait_times) * 1000, 1) if wait_times else 0.0,
+            'wait_ms_p95': round(self._percentile(wait_times, 95) * 1000, 1),
+            'wait_ms_max': round(max(wait_times) * 1000, 1) if wait_times else 0.0,
+            'process_ms_p95': round(self._percentile(process_times, 95) * 1000, 1),
+        }
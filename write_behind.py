@@ -0,0 +1,220 @@
+"""
+書き込みの遅延まとめ（write-behind）
+ベクトルDBの persist() のような重いフラッシュを操作ごとに行わず、
+max_ops 回の変更または最初の未反映の変更から max_seconds 秒経過した時点でまとめて1回行う
+- 期限の確認はプロセスで1本の共有スレッドが行う
+- プロセス終了時（atexit）に未反映の変更をすべてフラッシュする
+  SIGTERM で atexit が走らずに終了しないよう、メインスレッドで install_sigterm_handler() を呼んでおく
+- フラッシュの所要時間（p50/p95）を集計する
+"""
+
+import atexit
+import logging
+import signal
+import sys
+import threading
+import time
+import weakref
+from typing import Callable, Dict, Optional
+
+from message_pipeline import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+_instances = weakref.WeakSet()
+_instances_lock = threading.Lock()
+_ticker = None
+_signal_hooked = False
+
+
+class WriteBehind:
+    """変更回数と経過時間でフラッシュをまとめる"""
+
+    def __init__(self, flush: Callable[[], None], max_ops: int = 20, max_seconds: float = 5.0,
+                 name: str = '', window: int = 1000):
+        """
+        初期化
+
+        Args:
+            flush: 未反映の変更を書き出す関数（例: vectorstore.persist）
+            max_ops: この回数の変更がたまったら即座にフラッシュ（1なら毎回）
+            max_seconds: 最初の未反映の変更からこの秒数でフラッシュ
+            name: ログに使う名前
+            window: フラッシュ時間のパーセンタイル計算に使う直近のサンプル数
+        """
+        self._flush = flush
+        self.max_ops = max_ops
+        self.max_seconds = max_seconds
+        self.name = name
+
+        self._pending = 0
+        self._dirty_since = None
+        self._lock = threading.Lock()        # 未反映の変更数
+        self._flush_lock = threading.Lock()  # フラッシュの直列化
+        self._latency = LatencyHistogram(window)
+        self._stats = {
+            'operations': 0,
+            'flushes': 0,
+            'flush_errors': 0,
+            'by_ops': 0,
+            'by_time': 0,
+            'explicit': 0,
+        }
+
+        _register(self)
+
+    def mark(self, ops: int = 1):
+        """
+        変更を記録（max_ops に達したらこのスレッドでフラッシュする）
+
+        Args:
+            ops: 変更の回数
+        """
+        with self._lock:
+            self._pending += ops
+            self._stats['operations'] += ops
+            if self._dirty_since is None:
+                self._dirty_since = time.monotonic()
+            due = self._pending >= self.max_ops
+        if due:
+            self._run('by_ops')
+
+    def due(self, now: Optional[float] = None) -> bool:
+        """経過時間によるフラッシュの期限が来ているか"""
+        with self._lock:
+            return (self._dirty_since is not None
+                    and (now or time.monotonic()) - self._dirty_since >= self.max_seconds)
+
+    def flush(self) -> bool:
+        """
+        未反映の変更をすぐにフラッシュ（テスト・終了処理用）
+
+        Returns:
+            bool: フラッシュしたか（未反映の変更がなければFalse）
+        """
+        return self._run('explicit')
+
+    def _run(self, reason: str) -> bool:
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return False
+                pending = self._pending
+                self._pending = 0
+                self._dirty_since = None
+            started = time.perf_counter()
+            try:
+                self._flush()
+            except BaseException as e:
+                # 次の機会に再度フラッシュする（終了シグナルで中断された場合は atexit で）
+                with self._lock:
+                    self._pending += pending
+                    if self._dirty_since is None:
+                        self._dirty_since = time.monotonic()
+                    self._stats['flush_errors'] += 1
+                if not isinstance(e, Exception):
+                    raise
+                logger.error(f"Flush failed for {self.name or 'write-behind'}: {e}")
+                return False
+            seconds = time.perf_counter() - started
+            with self._lock:
+                self._latency.add(seconds)
+                self._stats['flushes'] += 1
+                self._stats[reason] += 1
+        return True
+
+    def stats(self) -> Dict:
+        """統計情報を取得"""
+        with self._lock:
+            return {
+                **self._stats,
+                'pending': self._pending,
+                'flush_latency': self._latency.snapshot(),
+            }
+
+
+def _register(instance: WriteBehind):
+    """共有スレッドと終了時のフックを（初回だけ）用意して登録する"""
+    global _ticker
+    with _instances_lock:
+        _instances.add(instance)
+        if _ticker is None:
+            _ticker = threading.Thread(target=_tick, name='write-behind', daemon=True)
+            _ticker.start()
+            atexit.register(flush_all)
+
+
+def _tick(interval: float = 0.5):
+    """期限の来たインスタンスをフラッシュし続ける"""
+    while True:
+        time.sleep(interval)
+        now = time.monotonic()
+        with _instances_lock:
+            instances = list(_instances)
+        for instance in instances:
+            if instance.due(now):
+                instance._run('by_time')
+
+
+def _exit_on_sigterm(signum, frame):
+    """
+    SIGTERM をメインスレッドの SystemExit に変える
+    ハンドラ内ではロックを取らない（メインスレッドがロックを保持したまま割り込まれているかもしれない）。
+    スタックが巻き戻ってロックが解放された後、atexit の flush_all がフラッシュする
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    sys.exit(128 + signum)
+
+
+def install_sigterm_handler() -> bool:
+    """
+    SIGTERM で atexit が走らずに終了しないようにする（メインスレッドのモジュール初期化から呼ぶ）
+    既定のハンドラのままの場合だけ入れる（gunicorn などが独自のハンドラを入れている場合は
+    そちらの正常終了で atexit が呼ばれる）
+
+    Returns:
+        bool: ハンドラを入れたか
+    """
+    global _signal_hooked
+    if _signal_hooked:
+        return True
+    if threading.current_thread() is not threading.main_thread():
+        logger.warning("install_sigterm_handler() must be called from the main thread")
+        return False
+    try:
+        if signal.getsignal(signal.SIGTERM) != signal.SIG_DFL:
+            return False
+        signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    except (ValueError, OSError):
+        return False
+    _signal_hooked = True
+    return True
+
+
+def flush_all() -> int:
+    """
+    全インスタンスの未反映の変更をフラッシュ
+
+    Returns:
+        int: フラッシュしたインスタンスの数
+    """
+    with _instances_lock:
+        instances = list(_instances)
+    return sum(1 for instance in instances if instance.flush())
+
+
+def stats_all() -> Dict:
+    """全インスタンスの合計とフラッシュ時間"""
+    with _instances_lock:
+        instances = list(_instances)
+    totals = {'instances': len(instances), 'operations': 0, 'flushes': 0, 'flush_errors': 0, 'pending': 0}
+    latency = LatencyHistogram()
+    for instance in instances:
+        with instance._lock:
+            for key in ('operations', 'flushes', 'flush_errors'):
+                totals[key] += instance._stats[key]
+            totals['pending'] += instance._pending
+            for sample in instance._latency._samples:
+                latency.add(sample)
+    totals['flush_latency'] = latency.snapshot()
+    return totals